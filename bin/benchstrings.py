@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+'''This script measures the performance of the functions escaping or
+   normalizing strings (escapeXml, escapeXhtml, normalizeString), that are
+   called for every dynamic value in PX and POD renderings and for every
+   indexed value. It also checks that they produce the same results as
+   simple, char-by-char reference implementations.'''
+
+# ------------------------------------------------------------------------------
+import sys, time, unicodedata
+from appy.shared.xml_parser import escapeXml, escapeXhtml, \
+     XML_SPECIAL_CHARS_NO_APOS
+from appy.shared.utils import normalizeString, extractIgnore, fileNameIgnore,\
+     alphaRex, alphanumRex
+
+# ------------------------------------------------------------------------------
+usage = '''Usage: python benchstrings.py [factor]
+
+factor multiplies the number of times every function is called (default: 1).'''
+
+# Reference implementations ----------------------------------------------------
+def refEscapeXml(s, format='xml', nsText='text'):
+    res = isinstance(s, unicode) and u'' or ''
+    odf = format == 'odf'
+    for c in s:
+        if c in XML_SPECIAL_CHARS_NO_APOS: res += XML_SPECIAL_CHARS_NO_APOS[c]
+        elif odf and (c == '\n'): res += '<%s:line-break/>' % nsText
+        elif odf and (c == '\t'): res += '<%s:tab/>' % nsText
+        elif odf and (c == '\r'): pass
+        else: res += c
+    return res
+
+def refEscapeXhtml(s):
+    res = isinstance(s, unicode) and u'' or ''
+    for c in s:
+        if c in XML_SPECIAL_CHARS_NO_APOS: res += XML_SPECIAL_CHARS_NO_APOS[c]
+        elif c == '\n': res += '<br/>'
+        elif c == '\r': pass
+        else: res += c
+    return res
+
+def refNormalizeString(s, usage='fileName'):
+    strNeeded = isinstance(s, str)
+    if isinstance(s, str):
+        try:
+            s = s.decode('utf-8')
+        except UnicodeDecodeError:
+            s = s.decode('latin-1')
+    elif not isinstance(s, unicode): s = unicode(s)
+    if usage == 'extractedText':
+        s = u''.join([(c in extractIgnore) and u' ' or c for c in s])
+    s = unicodedata.normalize('NFKD', s).encode('ascii', 'ignore')
+    if usage == 'fileName':
+        res = ''.join([c for c in s if c not in fileNameIgnore])
+    elif usage.startswith('alpha'):
+        rex = (usage == 'alpha') and alphaRex or alphanumRex
+        res = ''.join([c for c in s if rex.match(c)])
+    else:
+        res = s
+    if strNeeded: res = res.encode('utf-8')
+    return res
+
+# ------------------------------------------------------------------------------
+class StringsBenchmark:
+    '''Calls every function on a series of inputs and prints, for every one,
+       the time spent by the function and by its reference implementation.'''
+    # Inputs: (name, value, number of calls)
+    inputs = (
+      ('ascii', u'Hello world, this is a simple value', 20000),
+      ('special', u'<b>Tom & Jerry</b> said "hi"\n\tand left.\r\n', 20000),
+      ('accented', u'Élève appliqué, déjà à l’école (ça va), 10°C', 20000),
+      ('str', 'Caf\xc3\xa9 <cr\xc3\xa8me> & "sucre"', 20000),
+      ('large', u'Lorem ipsum <dolor> sit amet & "consectetur", élit.\n'*2000,
+       5))
+    # The functions to test: (name, function, reference function, args)
+    functions = (
+      ('escapeXml', escapeXml, refEscapeXml, ()),
+      ('escapeXml(odf)', escapeXml, refEscapeXml, ('odf',)),
+      ('escapeXhtml', escapeXhtml, refEscapeXhtml, ()),
+      ('normalize(fileName)', normalizeString, refNormalizeString, ()),
+      ('normalize(extractedText)', normalizeString, refNormalizeString,
+       ('extractedText',)),
+      ('normalize(alphanum)', normalizeString, refNormalizeString,
+       ('alphanum',)),
+      ('normalize(noAccents)', normalizeString, refNormalizeString,
+       ('noAccents',)))
+
+    def __init__(self, factor=1):
+        self.factor = factor
+        self.errors = 0
+
+    def time(self, function, value, args, number):
+        start = time.time()
+        for i in xrange(number): function(value, *args)
+        return time.time() - start
+
+    def run(self):
+        for name, function, reference, args in self.functions:
+            for inputName, value, number in self.inputs:
+                number *= self.factor
+                res = function(value, *args)
+                expected = reference(value, *args)
+                if (res != expected) or (type(res) != type(expected)):
+                    print('%s: wrong result for input "%s".' % (name,inputName))
+                    self.errors += 1
+                    continue
+                spent = self.time(function, value, args, number)
+                # The reference implementation is slow on large inputs
+                refSpent = self.time(reference, value, args,
+                                     max(number / 10, 1)) * 10
+                print('%-26s %-9s %8.2f us (reference: %8.2f us)' % \
+                      (name, inputName, spent * 1000000 / number,
+                       refSpent * 1000000 / number))
+        if self.errors: print('%d error(s).' % self.errors)
+        else: print('All results are identical to the reference ones.')
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    nbOfArgs = len(sys.argv)
+    if nbOfArgs not in (1, 2):
+        print(usage)
+        sys.exit()
+    factor = (nbOfArgs == 2) and int(sys.argv[1]) or 1
+    StringsBenchmark(factor).run()
+# ------------------------------------------------------------------------------
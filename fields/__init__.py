@@ -28,6 +28,29 @@ from page import Page
 # In this file, names "list" and "dict" refer to sub-modules. To use Python
 # builtin types, use __builtins__['list'] and __builtins__['dict']
 
+# ------------------------------------------------------------------------------
+def i18nCacheKey(labelType):
+    '''Returns the cache key (see appy.px.Px.objectKey) of a PX rendering the
+       translation of the current field's label of this p_labelType ("label",
+       "descr"...). The result is cached until the Translation object for the
+       user language, or the English one, is modified: labels missing in the
+       user language are translated in English. It is not cached if the
+       field's i18n mapping is dynamic.'''
+    def getTranslation(context):
+        field = context.get('field')
+        ztool = context.get('ztool')
+        if not field or not ztool or not context.get('lang'): return
+        if callable(field.mapping[labelType]): return
+        return getattr(ztool, context['lang'], None)
+    getObjectKey = Px.objectKey(getTranslation, ('field',))
+    def getKey(context):
+        res = getObjectKey(context)
+        if (res is None) or (context['lang'] == 'en'): return res
+        english = getattr(context['ztool'], 'en', None)
+        if english is None: return
+        return res + (english.modified,)
+    return getKey
+
 # ------------------------------------------------------------------------------
 class Field:
     '''Basic abstract class for defining any field'''
@@ -194,11 +217,13 @@ class Field:
 
     # Displays a field label
     pxLabel = Px('''<label if="field.hasLabel and field.renderLabel(layoutType)"
-     lfor=":field.name">::_('label', field=field)</label>''')
+     lfor=":field.name">::_('label', field=field)</label>''',
+     cacheKey=i18nCacheKey('label'))
 
     # Displays a field description
     pxDescription = Px('''<span if="field.hasDescr"
-     class="discreet">::_('descr', field=field)</span>''')
+     class="discreet">::_('descr', field=field)</span>''',
+     cacheKey=i18nCacheKey('descr'))
 
     # Displays a field help
     pxHelp = Px('''<acronym title=":_('help', field=field)"><img
@@ -15,7 +15,7 @@
 # Appy. If not, see <http://www.gnu.org/licenses/>.
 
 # ------------------------------------------------------------------------------
-import time, os, os.path
+import time, os, os.path, threading
 from file import FileInfo
 from appy import Object
 from appy.fields import Field
@@ -23,8 +23,9 @@ from appy.px import Px
 from appy.gen.layout import Table
 from appy.gen import utils as gutils
 from appy.pod import PodError
-from appy.pod.renderer import Renderer
+from appy.pod.renderer import Renderer, PodTemplate
 from appy.shared import utils as sutils
+from appy.shared.cache import LruCache
 
 # Error messages ---------------------------------------------------------------
 POD_ERROR = 'An error occurred while generating the document. Please contact ' \
@@ -64,6 +65,10 @@ class Pod(Field):
     # Parameters needed to perform a query for query-related pods
     queryParams = ('className', 'search', 'sortKey', 'sortOrder',
                    'filterKey', 'filterValue')
+    # Parsed POD templates, shared by all pod fields, keyed by path. The lock
+    # prevents several threads from replacing the same template at once.
+    podTemplates = LruCache(100)
+    podTemplatesLock = threading.Lock()
 
     # Getting a pod value is something special: disable the standard Appy
     # machinery for this.
@@ -394,6 +399,20 @@ class Pod(Field):
             res = self.getTemplatePath(diskFolder, elems[0])
         return res
 
+    def getPodTemplate(self, path):
+        '''Returns the PodTemplate instance for the template at p_path. It is
+           parsed once and reused for every document to compute, until the
+           template file changes.'''
+        Pod.podTemplatesLock.acquire()
+        try:
+            res = Pod.podTemplates.get(path)
+            if not res or not res.isUpToDate():
+                res = PodTemplate(path)
+                Pod.podTemplates.set(path, res)
+            return res
+        finally:
+            Pod.podTemplatesLock.release()
+
     def getDownloadName(self, obj, template, format, queryRelated):
         '''Gets the name of the pod result as will be seen by the user that will
            download it. Ensure the returned name is not too long for the OS that
@@ -594,7 +613,8 @@ class Pod(Field):
             stylesMapping = self.callMethod(obj, self.stylesMapping)
         else:
             stylesMapping = self.stylesMapping
-        rendererParams = {'template': templatePath, 'context': podContext,
+        rendererParams = {'template': self.getPodTemplate(templatePath),
+          'context': podContext,
           'result': result, 'stylesMapping': stylesMapping,
           'imageResolver': ztool.getApp(), 'overwriteExisting': True,
           'forceOoCall': self.forceOoCall}
@@ -603,6 +623,12 @@ class Pod(Field):
             rendererParams['pythonWithUnoPath'] = cfg.unoEnabledPython
         if cfg.libreOfficePort:
             rendererParams['ooPort'] = cfg.libreOfficePort
+        if cfg.converterService:
+            rendererParams['converterService'] = cfg.converterService
+        if cfg.conversionCache:
+            rendererParams['conversionCache'] = cfg.conversionCache
+        if cfg.imageCache:
+            rendererParams['imageCache'] = cfg.imageCache
         # Launch the renderer
         try:
             renderer = Renderer(**rendererParams)
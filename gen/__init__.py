@@ -145,6 +145,17 @@ class Config:
     unoEnabledPython = '/usr/bin/python'
     # On what port does LibreOffice run ?
     libreOfficePort = 2002
+    # If a converter service runs (see appy.pod.converter.ConverterService),
+    # specify here its address (a port on localhost or the path to a Unix
+    # socket): LibreOffice will be called through it, and the 2 parameters
+    # hereabove will be ignored.
+    converterService = None
+    # Set here an instance of appy.shared.cache.ConversionCache if documents
+    # converted by LibreOffice must be cached.
+    conversionCache = None
+    # Set here an instance of appy.shared.cache.ImageCache if images imported
+    # into POD results must be cached.
+    imageCache = None
     # Monitoring configuration. Update this instance (whose class is in
     # appy.gen.monitoring)) for changing the default configuration.
     monitoring = Monitoring()
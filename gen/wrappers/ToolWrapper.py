@@ -441,9 +441,27 @@ class ToolWrapper(AbstractWrapper):
     def convert(self, fileName, format):
         '''Launches a UNO-enabled Python interpreter as defined in the tool for
            converting, using LibreOffice in server mode, a file named p_fileName
-           into an output p_format.'''
-        convScript = '%s/pod/converter.py' % os.path.dirname(appy.__file__)
+           into an output p_format. If a converter service is configured, it
+           is called instead. If a conversion cache is configured, LibreOffice
+           is not called for a file that was already converted.'''
+        cfg = self.o.getProductConfig(True)
+        if not cfg.conversionCache: return self.runConverter(fileName, format)
+        from appy.pod.converter import getResultPath
+        return cfg.conversionCache.convert(fileName,
+          getResultPath(fileName, format),
+          lambda: self.runConverter(fileName, format), format) or ('', '')
+
+    def runConverter(self, fileName, format):
+        '''Converts p_fileName into p_format (see m_convert)'''
         cfg = self.o.getProductConfig(True)
+        if cfg.converterService:
+            from appy.pod.converter import callService, ConverterError
+            try:
+                callService(cfg.converterService, fileName, format)
+            except ConverterError, ce:
+                return '', str(ce)
+            return '', ''
+        convScript = '%s/pod/converter.py' % os.path.dirname(appy.__file__)
         cmd = [cfg.unoEnabledPython, convScript, fileName, format,
                '-p%d' % cfg.libreOfficePort]
         self.log('executing %s...' % str(cmd))
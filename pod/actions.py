@@ -17,6 +17,8 @@
 # ------------------------------------------------------------------------------
 from appy import Object
 from appy.pod import PodError
+import sys
+from appy.pod.profiler import Profiler
 from appy.shared.utils import Traceback
 from appy.pod.elements import *
 
@@ -29,22 +31,96 @@ TABLE_NOT_ONE_CELL = "The table you wanted to populate with '%s' " \
                      "can\'t be dumped with the '-' option because it has " \
                      "more than one cell in it."
 
+def lookAhead(elems):
+    '''Yields a tuple (item, b_isLast) for every item from iterable p_elems,
+       whose length may be unknown (ie, a generator).'''
+    elems = iter(elems)
+    try:
+        previous = elems.next()
+    except StopIteration:
+        return
+    for item in elems:
+        yield previous, False
+        previous = item
+    yield previous, True
+
+class LoopState(object):
+    '''Status of a loop being walked, stored in the "loop" object of the
+       context (see ForAction.initialiseLoop). Only the index of the currently
+       walked element (nb) is updated at every iteration: attributes "first",
+       "last", "odd" and "even" are computed from it when they are
+       requested.'''
+    __slots__ = ('length', 'nb', 'isLast')
+
+    def __init__(self, length, isLast=None):
+        # The total number of walked elements (0 if unknown)
+        self.length = length
+        # The index (starting at 0) of the currently walked element
+        self.nb = -1
+        # If the length is unknown (ie, elements are produced by a generator),
+        # the loop sets this attribute to tell if the current element is the
+        # last one. Else, it is None.
+        self.isLast = isLast
+
+    def getFirst(self): return self.nb == 0
+    first = property(getFirst)
+
+    def getLast(self):
+        if self.isLast is None: return self.nb == (self.length - 1)
+        return self.isLast
+    last = property(getLast)
+
+    def getEven(self): return (self.nb % 2) == 0
+    even = property(getEven)
+
+    def getOdd(self): return (self.nb % 2) == 1
+    odd = property(getOdd)
+
+    def get(self, name, default=None): return getattr(self, name, default)
+    def __getitem__(self, k): return getattr(self, k)
+
 class EvaluationError(Exception):
-    def __init__(self, originalError, *args, **kwargs):
-        Exception.__init__(self, *args, **kwargs)
+    '''Raised when the evaluation of an expression or statement fails with
+       p_originalError. If p_excInfo (as returned by sys.exc_info) is given,
+       the p_last lines of the original traceback complete the message. They
+       are formatted only if the message is needed: errors caught by the
+       calling code cost nothing more.'''
+    def __init__(self, originalError, message, excInfo=None, last=None):
+        Exception.__init__(self, message)
         self.originalError = originalError
+        self.excInfo = excInfo
+        self.last = last
+
+    def __unicode__(self):
+        res = self.args[0]
+        if not isinstance(res, unicode): res = res.decode('utf-8')
+        if self.excInfo:
+            tb = Traceback.get(self.last, self.excInfo).decode('utf-8')
+            res = u'%s\n%s' % (res, tb)
+        return res
+
+    def __str__(self): return self.__unicode__().encode('utf-8')
 
 # ------------------------------------------------------------------------------
 class BufferAction:
     '''Abstract class representing a action (=statement) that must be performed
        on the content of a buffer (if, for...).'''
-    def __init__(self, name, buffer, expr, elem, minus, source, fromInfo):
+    kind = None # The kind of action, as shown by the profiler
+
+    def __init__(self, name, buffer, expr, elem, minus, source, fromInfo,
+                 codes=None):
         self.name = name # Actions may be named. Currently, the name of an
         # action is only used for giving a name to "if" actions; thanks to this
         # name, "else" actions that are far away may reference their "if".
         self.buffer = buffer # The object of the action
         self.expr = expr # Python expression to evaluate (may be None in the
         # case of a NullAction or ElseAction, for example)
+        # Compiled version of self.expr: a tuple (code, errorCode), computed
+        # once, at parse time (see m_compileExprs), excepted if already given
+        # in p_codes.
+        self.codes = codes
+        if (codes is None) and (expr is not None):
+            self.codes = compileExprs(expr)
         self.elem = elem # The element within the buffer that is the object
         # of the action.
         self.minus = minus # If True, the main elem(s) must not be dumped
@@ -53,11 +129,20 @@ class BufferAction:
         # the action (='fromExpr')
         if fromInfo:
             self.fromPlus, self.fromExpr = fromInfo
+            self.fromCode = compileExpr(self.fromExpr)
         else:
-            self.fromPlus = self.fromExpr = None
+            self.fromPlus = self.fromExpr = self.fromCode = None
         # Several actions may co-exist for the same buffer, as a chain of
         # BufferAction instances, defined via the following attribute.
         self.subAction = None
+        # px-only: the line and column of the action within the PX, captured
+        # at parse time.
+        self.line = self.column = None
+
+    def getStatement(self):
+        '''Returns the Python source of this action, as shown by the
+           profiler (see appy.pod.profiler).'''
+        return self.expr or ''
 
     def getExceptionLine(self, e):
         '''Gets the line describing exception p_e, containing the exception
@@ -68,19 +153,15 @@ class BufferAction:
         '''Manage the encountered error: dump it into the buffer or raise an
            exception.'''
         if self.buffer.env.raiseOnError:
+            excInfo = None
             if not self.buffer.pod:
-                # Add in the error message the line nb where the errors occurs
-                # within the PX.
-                locator = self.buffer.env.parser.locator
-                # The column number may not be given
-                col = locator.getColumnNumber()
-                if col == None: col = ''
-                else: col = ', column %d' % col
-                errorMessage += ' (line %s%s)' % (locator.getLineNumber(), col)
-                # Integrate the traceback (at least, its last lines)
-                errorMessage += '\n' + Traceback.get(6).decode('utf-8')
+                # Add in the error message the location of the action within
+                # the PX, and the end of the traceback.
+                location = getLocation(self.line, self.column)
+                if location: errorMessage += ' %s' % location
+                if originalError: excInfo = sys.exc_info()
             if originalError:
-                raise EvaluationError(originalError, errorMessage)
+                raise EvaluationError(originalError, errorMessage, excInfo, 6)
             raise Exception(errorMessage)
         # Create a temporary buffer to dump the error. If I reuse this buffer to
         # dump the error (what I did before), and we are, at some depth, in a
@@ -91,25 +172,11 @@ class BufferAction:
         PodError.dump(tempBuffer, errorMessage, withinElement=self.elem)
         tempBuffer.evaluate(result, context)
 
-    def _evalExpr(self, expr, context):
-        '''Evaluates p_expr with p_context. p_expr can contain an error expr,
-           in the form "someExpr|errorExpr". If it is the case, if the "normal"
-           expr raises an error, the "error" expr is evaluated instead.'''
-        if '|' not in expr:
-            res = eval(expr, context)
-        else:
-            expr, errorExpr = expr.rsplit('|', 1)
-            try:
-                res = eval(expr, context)
-            except Exception:
-                res = eval(errorExpr, context)
-        return res
-
-    def evaluateExpression(self, result, context, expr):
-        '''Evaluates expression p_expr with the current p_context. Returns a
-           tuple (result, errorOccurred).'''
+    def evaluateExpression(self, result, context, expr, codes):
+        '''Evaluates expression p_expr, compiled in p_codes, with the current
+           p_context. Returns a tuple (result, errorOccurred).'''
         try:
-            res = self._evalExpr(expr, context)
+            res = evalExprs(codes, context)
             error = False
         except Exception, e:
             res = None
@@ -121,19 +188,28 @@ class BufferAction:
     def execute(self, result, context):
         '''Executes this action given some p_context and add the result to
            p_result.'''
-        # Check that if minus is set, we have an element which can accept it
-        if self.minus and isinstance(self.elem, Table) and \
-           (not self.elem.tableInfo.isOneCell()):
-            self.manageError(result, context, TABLE_NOT_ONE_CELL % self.expr)
-        else:
-            error = False
-            # Evaluate self.expr in eRes
-            eRes = None
-            if self.expr:
-                eRes,error = self.evaluateExpression(result, context, self.expr)
-            if not error:
-                # Trigger action-specific behaviour
-                self.do(result, context, eRes)
+        profiler = context.get(Profiler.contextKey)
+        if profiler:
+            profiler.enter(profiler.getKey(self.kind, self.getStatement(),
+                                           self.line))
+        try:
+            # Check that if minus is set, we have an element which can accept
+            # it.
+            if self.minus and isinstance(self.elem, Table) and \
+               (not self.elem.tableInfo.isOneCell()):
+                self.manageError(result, context, TABLE_NOT_ONE_CELL %self.expr)
+            else:
+                error = False
+                # Evaluate self.expr in eRes
+                eRes = None
+                if self.expr:
+                    eRes, error = self.evaluateExpression(result, context,
+                                                          self.expr, self.codes)
+                if not error:
+                    # Trigger action-specific behaviour
+                    self.do(result, context, eRes)
+        finally:
+            if profiler: profiler.leave()
 
     def evaluateBuffer(self, result, context):
         if self.source == 'buffer':
@@ -143,7 +219,7 @@ class BufferAction:
             feRes = None
             error = False
             try:
-                feRes = eval(self.fromExpr, context)
+                feRes = eval(self.fromCode, context)
             except Exception, e:
                 msg = FROM_EVAL_ERROR% (self.fromExpr, self.getExceptionLine(e))
                 self.manageError(result, context, msg, e)
@@ -155,7 +231,7 @@ class BufferAction:
                 else:
                     # We must keep the root tag within self.buffer and dump the
                     # result into it.
-                    content = self.buffer.content
+                    content = self.buffer.getContent()
                     result.write(content[:content.find('>') + 1])
                     result.write(feRes)
                     result.write(content[content.rfind('<'):])
@@ -170,6 +246,7 @@ class BufferAction:
 class IfAction(BufferAction):
     '''Action that determines if we must include the content of the buffer in
        the result or not.'''
+    kind = 'if'
     def do(self, result, context, exprRes):
         if exprRes:
             if self.subAction:
@@ -186,6 +263,7 @@ class ElseAction(IfAction):
        action works exactly like an "if" action, excepted that instead of
        defining a conditional expression, it is based on the negation of the
        conditional expression of the last defined "if" action.'''
+    kind = 'else'
 
     def __init__(self, name, buff, expr, elem, minus, src, fromInfo, ifAction):
         IfAction.__init__(self, name, buff, None, elem, minus, src, fromInfo)
@@ -194,17 +272,23 @@ class ElseAction(IfAction):
     def do(self, result, context, exprRes):
         # This action is executed if the tied "if" action is not executed.
         ifAction = self.ifAction
-        iRes,error = ifAction.evaluateExpression(result, context, ifAction.expr)
+        iRes, error = ifAction.evaluateExpression(result, context,
+                                                  ifAction.expr, ifAction.codes)
         IfAction.do(self, result, context, not iRes)
 
 class ForAction(BufferAction):
     '''Actions that will include the content of the buffer as many times as
        specified by the action parameters.'''
+    kind = 'for'
 
-    def __init__(self, name, buff, expr, elem, minus, iter, src, fromInfo):
-        BufferAction.__init__(self, name, buff, expr, elem, minus, src,fromInfo)
+    def __init__(self, name, buff, expr, elem, minus, iter, src, fromInfo,
+                 codes=None):
+        BufferAction.__init__(self, name, buff, expr, elem, minus, src,
+                              fromInfo, codes)
         self.iter = iter # Name of the iterator variable used in the each loop
 
+    def getStatement(self): return '%s in %s' % (self.iter, self.expr)
+
     def initialiseLoop(self, context, elems):
         '''Initialises information about the loop, before entering into it. It
            is possible that this loop overrides an outer loop whose iterator
@@ -231,20 +315,22 @@ class ForAction(BufferAction):
         #   * loop.elem.length to know the total length of myListOfElements
         #   * loop.elem.nb     to know the index of the current elem within
         #                      myListOfElements.
-        if 'loop' not in context:
-            context['loop'] = Object()
+        # curLoop is a LoopState instance.
+        if 'loop' in context:
+            loops = context['loop']
+        else:
+            loops = context['loop'] = Object()
         try:
-            total = len(elems)
+            curLoop = LoopState(len(elems))
         except Exception:
-            total = 0
-        curLoop = Object(length=total)
+            # p_elems has no length: the loop will have to look one element
+            # ahead to know if the current one is the last one.
+            curLoop = LoopState(0, False)
         # Does this loop overrides an outer loop whose iterator has the same
         # name ?
-        outerLoop = None
-        if hasattr(context['loop'], self.iter):
-            outerLoop = getattr(context['loop'], self.iter)
+        outerLoop = getattr(loops, self.iter, None)
         # Put this loop in the global object "loop".
-        setattr(context['loop'], self.iter, curLoop)
+        setattr(loops, self.iter, curLoop)
         return curLoop, outerLoop
 
     def do(self, result, context, elems):
@@ -275,20 +361,17 @@ class ForAction(BufferAction):
             initialColIndex = self.elem.colIndex
             currentColIndex = initialColIndex
             rowAttributes = self.elem.tableInfo.curRowAttrs
-            # If p_elems is empty, dump an empty cell to avoid having the wrong
-            # number of cells for the current row.
-            if not elems:
-                result.dumpElement(Cell.OD.elem)
-        # Enter the "for" loop
+        # Enter the "for" loop. Every iteration is directly dumped into
+        # p_result. p_elems is walked only once and does not need to have a
+        # length: it can be a generator producing a huge number of items.
         loop, outerLoop = self.initialiseLoop(context, elems)
+        lookingAhead = loop.isLast is not None
+        if lookingAhead: elems = lookAhead(elems)
         i = -1
         for item in elems:
             i += 1
             loop.nb = i
-            loop.first = i == 0
-            loop.last = i == (loop.length-1)
-            loop.even = (i%2)==0
-            loop.odd = not loop.even
+            if lookingAhead: item, loop.isLast = item
             context[self.iter] = item
             # Cell: add a new row if we are at the end of a row
             if isCell and (currentColIndex == nbOfColumns):
@@ -304,10 +387,15 @@ class ForAction(BufferAction):
             # Cell: increment the current column index
             if isCell:
                 currentColIndex += 1
+        empty = i == -1
+        # Cell: if p_elems is empty, dump an empty cell to avoid having the
+        # wrong number of cells for the current row.
+        if isCell and empty:
+            result.dumpElement(Cell.OD.elem)
         # Cell: leave the last row with the correct number of cells, excepted
         # if the user has specified himself "columnsRepeated": it is his
         # responsibility to produce the correct number of cells.
-        if isCell and elems and not customColumnsRepeated:
+        if isCell and not empty and not customColumnsRepeated:
             wrongNbOfCells = (currentColIndex-1) - initialColIndex
             if wrongNbOfCells < 0: # Too few cells for last row
                 for i in range(abs(wrongNbOfCells)):
@@ -341,26 +429,42 @@ class ForAction(BufferAction):
         if hasHiddenVariable:
             context[self.iter] = hiddenVariable
         else:
-            if elems:
+            if not empty:
                 if self.iter in context: # May not be the case on error
                     del context[self.iter]
 
 class NullAction(BufferAction):
     '''Action that does nothing. Used in conjunction with a "from" clause, it
        allows to insert in a buffer arbitrary odt content.'''
+    kind = 'null'
     def do(self, result, context, exprRes):
         self.evaluateBuffer(result, context)
 
 class VariablesAction(BufferAction):
     '''Action that allows to define a set of variables somewhere in the
        template.'''
-    def __init__(self, name, buff, elem, minus, variables, src, fromInfo):
+    kind = 'var'
+    def __init__(self, name, buff, elem, minus, variables, src, fromInfo,
+                 compiled=None):
         # We do not use the default Buffer.expr attribute for storing the Python
         # expression, because here we will have several expressions, one for
         # every defined variable.
         BufferAction.__init__(self,name, buff, None, elem, minus, src, fromInfo)
         # Definitions of variables: ~[(s_name, s_expr)]~
         self.variables = variables
+        # Compiled expressions of these variables: ~[(s_name, s_expr, codes)]~
+        if compiled is None:
+            compiled = [(name, expr, compileExprs(expr)) \
+                        for name, expr in variables]
+        self.compiled = compiled
+        # The names of the variables to remove from the context after the
+        # execution of this buffer (global variables excepted).
+        self.names = [name for name, expr in variables \
+                      if not name.startswith('@')]
+
+    def getStatement(self):
+        return ';'.join(['%s=%s' % (name, expr) \
+                         for name, expr in self.variables])
 
     def do(self, result, context, exprRes):
         '''Evaluate the variables' expressions: because there are several
@@ -372,9 +476,9 @@ class VariablesAction(BufferAction):
            values.
         '''
         hidden = None
-        for name, expr in self.variables:
+        for name, expr, codes in self.compiled:
             # Evaluate variable expression in vRes
-            vRes, error = self.evaluateExpression(result, context, expr)
+            vRes, error = self.evaluateExpression(result, context, expr, codes)
             if error: return
             # Replace the value of global variables
             if name.startswith('@'):
@@ -397,8 +501,7 @@ class VariablesAction(BufferAction):
         # Restore hidden variables if any
         if hidden: context.update(hidden)
         # Delete not-hidden variables
-        for name, expr in self.variables:
-            if name.startswith('@'): continue
+        for name in self.names:
             if hidden and (name in hidden): continue
             del context[name]
 # ------------------------------------------------------------------------------
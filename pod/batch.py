@@ -0,0 +1,131 @@
+# ------------------------------------------------------------------------------
+# This file is part of Appy, a framework for building applications in the Python
+# language. Copyright (C) 2007 Gaetan Delannay
+
+# Appy is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+
+# Appy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# Appy. If not, see <http://www.gnu.org/licenses/>.
+
+# ------------------------------------------------------------------------------
+import multiprocessing
+from appy import Object
+from appy.pod.renderer import Renderer, PodTemplate
+from appy.shared.utils import Traceback
+
+# ------------------------------------------------------------------------------
+BAD_TEMPLATE = 'The template of a batch must be a file name or a PodTemplate ' \
+               'whose template is a file name.'
+NO_OO_PORTS = 'At least one LibreOffice port must be given.'
+OO_PORT_PARAM = 'LibreOffice ports must be given in parameter "ooPorts".'
+
+# The PodTemplate used by the current worker process (see m_initWorker)
+template = None
+
+def initWorker(path, raiseOnError):
+    '''Called once in every worker process: the template is parsed only once
+       per process.'''
+    global template
+    template = PodTemplate(path, raiseOnError)
+
+def renderDocument(task):
+    '''Renders, in a worker process, the document described by p_task, a tuple
+       (i_index, context, s_result, i_ooPort, d_rendererParams). If the
+       context is callable, it is a loader that is called to get the real
+       context. Returns a tuple (i_index, s_result, s_error), s_error being
+       None if the document was successfully rendered.'''
+    index, context, result, ooPort, params = task
+    # By default, existing results are overwritten
+    params = dict({'overwriteExisting': True}, **params)
+    try:
+        if callable(context): context = context()
+        Renderer(template, context, result, ooPort=ooPort, **params).run()
+        return index, result, None
+    except Exception:
+        return index, result, Traceback.get()
+
+# ------------------------------------------------------------------------------
+class BatchRenderer:
+    '''Renders one POD template with a series of contexts, producing one
+       document per context, in parallel, in a pool of processes.'''
+
+    def __init__(self, template, getResult, processes=None, ooPorts=(2002,),
+                 raiseOnError=False, **rendererParams):
+        '''* p_template is the path to the POD template, or a PodTemplate whose
+             template is a path. Every worker process parses it once.
+           * p_getResult is a function that receives the index of a context
+             and the context itself (as given to m_run) and returns the path
+             of the document to produce for it.
+           * p_processes is the number of worker processes. If None, it is
+             the number of CPUs. If 0, documents are rendered sequentially, in
+             the current process.
+           * If the result of rendering must be converted by LibreOffice (ie,
+             it is a PDF), you may run several LibreOffice instances in server
+             mode and give their ports in p_ooPorts: documents are dispatched
+             among them.
+           * p_raiseOnError and other p_rendererParams (stylesMapping,
+             forceOoCall, pythonWithUnoPath...) are passed to every Renderer.
+             They must be picklable. Unless p_rendererParams contains
+             overwriteExisting=False, existing results are overwritten.'''
+        if isinstance(template, PodTemplate):
+            raiseOnError = template.raiseOnError
+            template = template.template
+        if not isinstance(template, basestring):
+            raise Exception(BAD_TEMPLATE)
+        if not ooPorts: raise Exception(NO_OO_PORTS)
+        if 'ooPort' in rendererParams: raise Exception(OO_PORT_PARAM)
+        self.template = template
+        self.getResult = getResult
+        self.processes = processes
+        self.ooPorts = ooPorts
+        self.raiseOnError = raiseOnError
+        self.rendererParams = rendererParams
+
+    def getTasks(self, contexts):
+        '''Produces the tasks to give to m_renderDocument for these
+           p_contexts.'''
+        ports = self.ooPorts
+        i = -1
+        for context in contexts:
+            i += 1
+            yield (i, context, self.getResult(i, context), ports[i%len(ports)],
+                   self.rendererParams)
+
+    def run(self, contexts):
+        '''Renders a document for every context from p_contexts, an iterable.
+           Every context must be picklable, or be a picklable callable (ie, a
+           module-level function, or a functools.partial on such a function)
+           that will be called, in the worker process, to get the real
+           context. This method is a generator: for every produced document, as
+           soon as it is produced, it yields an object with these attributes:
+           * index   the index of the context within p_contexts;
+           * result  the path to the document;
+           * error   None if the document was successfully produced, or the
+                     traceback of the error that occurred.'''
+        tasks = self.getTasks(contexts)
+        if self.processes == 0:
+            initWorker(self.template, self.raiseOnError)
+            for task in tasks:
+                index, result, error = renderDocument(task)
+                yield Object(index=index, result=result, error=error)
+            return
+        pool = multiprocessing.Pool(self.processes, initWorker,
+                                    (self.template, self.raiseOnError))
+        try:
+            for index, result, error in pool.imap_unordered(renderDocument,
+                                                            tasks):
+                yield Object(index=index, result=result, error=error)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+# ------------------------------------------------------------------------------
@@ -15,11 +15,11 @@
 # Appy. If not, see <http://www.gnu.org/licenses/>.
 
 # ------------------------------------------------------------------------------
-import re, sys
+import re, sys, copy
 from xml.sax.saxutils import quoteattr
 from appy.shared.xml_parser import xmlPrologue, escapeXml
 from appy.pod import PodError
-from appy.shared.utils import Traceback
+from appy.pod.profiler import Profiler
 from appy.pod.elements import *
 from appy.pod.actions import IfAction, ElseAction, ForAction, VariablesAction, \
                              NullAction, EvaluationError
@@ -74,38 +74,25 @@ NULL_ACTION_ERROR = 'There was a problem with this action. Possible causes: ' \
 
 # ------------------------------------------------------------------------------
 class BufferIterator:
+    '''Walks, in ascending order of their indexes, the elements and sub-buffers
+       of a MemoryBuffer.'''
     def __init__(self, buffer):
         self.buffer = buffer
-        self.remainingSubBufferIndexes = self.buffer.subBuffers.keys()
-        self.remainingElemIndexes = self.buffer.elements.keys()
-        self.remainingSubBufferIndexes.sort()
-        self.remainingElemIndexes.sort()
+        # Tuples (index, i_kind) for all sub-buffers and elements: the kind (0
+        # for a sub-buffer, 1 for an element) decides which one comes first if
+        # both are at the same index. The list is reversed: the next tuple is
+        # popped from its end.
+        indexes = [(index, 0) for index in buffer.subBuffers.iterkeys()]
+        indexes += [(index, 1) for index in buffer.elements.iterkeys()]
+        indexes.sort(reverse=True)
+        self.remaining = indexes
 
-    def hasNext(self):
-        return self.remainingSubBufferIndexes or self.remainingElemIndexes
+    def hasNext(self): return bool(self.remaining)
 
     def next(self):
-        nextSubBufferIndex = None
-        if self.remainingSubBufferIndexes:
-            nextSubBufferIndex = self.remainingSubBufferIndexes[0]
-        nextExprIndex = None
-        if self.remainingElemIndexes:
-            nextExprIndex = self.remainingElemIndexes[0]
-        # Compute min between nextSubBufferIndex and nextExprIndex
-        if (nextSubBufferIndex != None) and (nextExprIndex != None):
-            res = min(nextSubBufferIndex, nextExprIndex)
-        elif (nextSubBufferIndex == None) and (nextExprIndex != None):
-            res = nextExprIndex
-        elif (nextSubBufferIndex != None) and (nextExprIndex == None):
-            res = nextSubBufferIndex
-        # Update "remaining" lists
-        if res == nextSubBufferIndex:
-            self.remainingSubBufferIndexes = self.remainingSubBufferIndexes[1:]
-            resDict = self.buffer.subBuffers
-        elif res == nextExprIndex:
-            self.remainingElemIndexes = self.remainingElemIndexes[1:]
-            resDict = self.buffer.elements
-        return res, resDict[res]
+        index, kind = self.remaining.pop()
+        if kind: return index, self.buffer.elements[index]
+        return index, self.buffer.subBuffers[index]
 
 # ------------------------------------------------------------------------------
 class Buffer:
@@ -127,10 +114,7 @@ class Buffer:
         return subBuffer
 
     def removeLastSubBuffer(self):
-        subBufferIndexes = self.subBuffers.keys()
-        subBufferIndexes.sort()
-        lastIndex = subBufferIndexes.pop()
-        del self.subBuffers[lastIndex]
+        del self.subBuffers[max(self.subBuffers.iterkeys())]
 
     def write(self, something): pass # To be overridden
 
@@ -215,11 +199,20 @@ class Buffer:
 
 # ------------------------------------------------------------------------------
 class FileBuffer(Buffer):
-    def __init__(self, env, result):
+    def __init__(self, env, result, bufferSize=65536):
         Buffer.__init__(self, env, None)
+        # p_result is the name of the file to write, or a file-like object
         self.result = result
-        self.content = file(result, 'w')
+        if isinstance(result, basestring):
+            self.content = file(result, 'w')
+        else:
+            self.content = result
         self.content.write(xmlPrologue)
+        # Chunks are not written individually into the file: they are grouped
+        # in blocks of (at least) p_bufferSize chars, encoded at once.
+        self.bufferSize = bufferSize
+        self.chunks = []
+        self.size = 0
 
     # getLength is used to manage insertions into sub-buffers. But in the case
     # of a FileBuffer, we will only have 1 sub-buffer at a time, and we don't
@@ -227,17 +220,42 @@ class FileBuffer(Buffer):
     def getLength(self): return 0
 
     def write(self, something):
+        self.chunks.append(something)
+        self.size += len(something)
+        if self.size >= self.bufferSize: self.flush()
+
+    def flush(self):
+        '''Writes the currently buffered chunks into the file'''
+        if not self.chunks: return
         try:
-            self.content.write(something.encode('utf-8'))
+            res = u''.join(self.chunks).encode('utf-8')
         except UnicodeDecodeError:
-            self.content.write(something)
+            # Some chunks are already encoded, non-ASCII strings
+            res = ''.join([(isinstance(chunk, unicode) and \
+                            chunk.encode('utf-8') or chunk) \
+                           for chunk in self.chunks])
+        self.content.write(res)
+        self.chunks = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        # A file-like object given as result is left open for its owner
+        if isinstance(self.result, basestring): self.content.close()
 
     def addExpression(self, expression, tiedHook=None):
         # At 2013-02-06, this method was not called within the whole test suite.
+        expr = Expression(expression, self.pod)
+        if tiedHook: tiedHook.tiedExpression = expr
+        self.dumpExpression(expr, expression, self.env.context)
+
+    def dumpExpression(self, expr, expression, context):
+        '''Evaluates Expression p_expr (whose source is p_expression) with
+           p_context and dumps the result into this buffer.'''
+        profiler = context.get(Profiler.contextKey)
+        if profiler: profiler.enter(profiler.getKey('expr', expression))
         try:
-            expr = Expression(expression, self.pod)
-            if tiedHook: tiedHook.tiedExpression = expr
-            res, escape = expr.evaluate(self.env.context)
+            res, escape = expr.evaluate(context)
             if escape: self.dumpContent(res)
             else: self.write(res)
         except Exception, e:
@@ -246,18 +264,173 @@ class FileBuffer(Buffer):
                               dumpTb=False)
             else:
                 raise Exception(EVAL_EXPR_ERROR % (expression, e))
+        finally:
+            if profiler: profiler.leave()
 
     def addAttributes(self):
         # Into a FileBuffer, it is not possible to insert Attributes. Every
         # Attributes instance is tied to an Expression; because dumping
         # expressions directly into FileBuffer instances seems to be a rather
-        # theorical case (see comment inside the previous method), it does not
+        # theorical case (see comment inside m_addExpression), it does not
         # seem to be a real problem.
         pass
 
+    def evaluateBuffer(self, buffer, context):
+        '''Sub-buffer p_buffer is completely parsed: evaluate it with
+           p_context into this buffer, by executing its action or, if it has
+           no action, by evaluating its content.'''
+        if buffer.action:
+            buffer.action.execute(self, context)
+        else:
+            buffer.evaluate(self, context)
+
     def pushSubBuffer(self, subBuffer): pass
     def getRootBuffer(self): return self
 
+# ------------------------------------------------------------------------------
+class TemplateBuffer(FileBuffer):
+    '''pod-only: the root buffer used for parsing a reusable POD template (see
+       appy.pod.renderer.PodTemplate). A FileBuffer evaluates sub-buffers as
+       soon as they are parsed. A TemplateBuffer records them instead, with
+       the static content found in-between, as a list of nodes. m_render
+       replays these nodes into a FileBuffer, as many times as needed, with
+       any context, possibly by several threads at once: once recorded, the
+       nodes and the buffers they contain are never modified. Every node is a
+       tuple (type, value):
+       * (TEXT,       s_content) [content encoded in utf-8]
+       * (EXPRESSION, (Expression, s_expression))
+       * (BUFFER,     MemoryBuffer)'''
+    TEXT = 0
+    EXPRESSION = 1
+    BUFFER = 3
+
+    def __init__(self, env):
+        Buffer.__init__(self, env, None)
+        self.nodes = []
+        # Chunks of static content not added into self.nodes yet
+        self.chunks = []
+
+    def flush(self):
+        '''Adds, into self.nodes, the static content written so far'''
+        if not self.chunks: return
+        self.nodes.append((self.TEXT, ''.join(self.chunks)))
+        self.chunks = []
+
+    def close(self): self.flush()
+
+    def write(self, something):
+        if isinstance(something, unicode): something = something.encode('utf-8')
+        self.chunks.append(something)
+
+    def dumpExpression(self, expr, expression, context):
+        self.flush()
+        self.nodes.append((self.EXPRESSION, (expr, expression)))
+
+    def evaluateBuffer(self, buffer, context):
+        self.flush()
+        if not buffer.action:
+            # p_buffer will be emptied and reused by the parser: record a copy
+            clone = MemoryBuffer(self.env, self)
+            clone.chunks = list(buffer.chunks)
+            clone.length = buffer.length
+            clone.elements = buffer.elements
+            clone.subBuffers = buffer.subBuffers
+            buffer = clone
+        self.freezeTables(buffer)
+        self.prepare(buffer)
+        self.nodes.append((self.BUFFER, buffer))
+
+    def prepare(self, buffer):
+        '''Performs, on p_buffer and its sub-buffers, the changes that their
+           evaluation would perform the first time, so that evaluating them
+           does not modify them anymore.'''
+        buffer.getContent()
+        # Find the action that will evaluate the buffer content
+        action = buffer.action
+        while action and action.subAction: action = action.subAction
+        if action and action.minus and (action.source == 'buffer'):
+            buffer.removeAutomaticExpressions()
+        for subBuffer in buffer.subBuffers.itervalues():
+            self.prepare(subBuffer)
+
+    def freezeTables(self, buffer, copies=None):
+        '''Cells and tables from p_buffer hold info about their table, as
+           an OdTable instance. If this table is still being parsed, this info
+           may still change (ie, the current row). Because p_buffer would have
+           been evaluated by a FileBuffer at this time, its elements are linked
+           to copies of the current OdTable instances.'''
+        if copies is None:
+            if not self.env.tableStack: return
+            copies = {}
+            for table in self.env.tableStack:
+                copies[id(table)] = copy.copy(table)
+        elems = buffer.elements.values()
+        action = buffer.action
+        while action:
+            elems.append(action.elem)
+            action = action.subAction
+        for elem in elems:
+            info = getattr(elem, 'tableInfo', None)
+            if info and (id(info) in copies): elem.tableInfo = copies[id(info)]
+        for subBuffer in buffer.subBuffers.itervalues():
+            self.freezeTables(subBuffer, copies)
+
+    def render(self, result, context):
+        '''Renders the recorded nodes into p_result, a FileBuffer, with this
+           p_context.'''
+        for kind, value in self.nodes:
+            if kind == 0: # TEXT
+                result.write(value)
+            elif kind == 1: # EXPRESSION
+                result.dumpExpression(value[0], value[1], context)
+            else: # BUFFER
+                result.evaluateBuffer(value, context)
+
+# ------------------------------------------------------------------------------
+class StreamBuffer(Buffer):
+    '''px-only: a result buffer that does not store its content. Every chunk
+       of content is directly passed to a p_sink, that can be a list (chunks
+       are appended to it) or a file-like object (its method "write" is called
+       with every chunk, like a Zope RESPONSE).'''
+    def __init__(self, env, sink, encoding=None, bufferSize=0):
+        Buffer.__init__(self, env, None)
+        if isinstance(sink, list):
+            self.sink = sink.append
+        else:
+            self.sink = sink.write
+        # If an p_encoding is given, unicode chunks are encoded before being
+        # passed to the sink.
+        self.encoding = encoding
+        # If p_bufferSize is not 0, chunks are not passed individually to the
+        # sink: they are grouped in blocks of (at least) p_bufferSize chars.
+        self.bufferSize = bufferSize
+        self.chunks = []
+        self.size = 0
+        if not encoding and not bufferSize:
+            # Bypass m_write and directly pass chunks to the sink
+            self.write = self.sink
+
+    def getLength(self): return 0
+
+    def write(self, thing):
+        if self.bufferSize:
+            self.chunks.append(thing)
+            self.size += len(thing)
+            if self.size >= self.bufferSize: self.flush()
+        else:
+            if self.encoding and isinstance(thing, unicode):
+                thing = thing.encode(self.encoding)
+            self.sink(thing)
+
+    def flush(self):
+        '''Passes the currently buffered chunks to the sink.'''
+        if not self.chunks: return
+        res = u''.join(self.chunks)
+        if self.encoding: res = res.encode(self.encoding)
+        self.sink(res)
+        self.chunks = []
+        self.size = 0
+
 # ------------------------------------------------------------------------------
 class MemoryBuffer(Buffer):
     actionRex = re.compile('(?:(\w+)\s*\:\s*)?do\s+(\w+)(-)?' \
@@ -266,11 +439,24 @@ class MemoryBuffer(Buffer):
     varRex = re.compile('\s*(@?[\w\-_]+)\s*=\s*(.*)')
     fromRex = re.compile('from(\+)?\s+(.*)')
 
+    # Types of nodes within a frozen buffer (see m_freeze)
+    TEXT = 0
+    EXPRESSION = 1
+    ATTRIBUTE = 2
+    BUFFER = 3
+
     def __init__(self, env, parent):
         Buffer.__init__(self, env, parent)
-        self.content = u''
+        # The content is stored as a list of chunks, joined only when the
+        # content must be read (see m_getContent). Its total length is
+        # maintained in self.length.
+        self.chunks = []
+        self.length = 0
         self.elements = {}
         self.action = None
+        # px-only: once the buffer is completely parsed, it can be frozen into
+        # an ordered list of nodes (see m_freeze).
+        self.nodes = None
 
     def clone(self):
         '''Produces an empty buffer that is a clone of this one.'''
@@ -278,8 +464,8 @@ class MemoryBuffer(Buffer):
 
     def addSubBuffer(self, subBuffer=None):
         sb = Buffer.addSubBuffer(self, subBuffer)
-        self.content += ' ' # To avoid having several subbuffers referenced at
-                            # the same place within this buffer.
+        self.write(u' ') # To avoid having several subbuffers referenced at
+                          # the same place within this buffer.
         return sb
 
     def getRootBuffer(self):
@@ -288,9 +474,21 @@ class MemoryBuffer(Buffer):
         if self.parent: return self.parent.getRootBuffer()
         return self
 
-    def getLength(self): return len(self.content)
+    def getLength(self): return self.length
 
-    def write(self, thing): self.content += thing
+    def write(self, thing):
+        self.chunks.append(thing)
+        self.length += len(thing)
+
+    def getContent(self):
+        '''Returns the content of this buffer, as a single string'''
+        chunks = self.chunks
+        if len(chunks) != 1: chunks[:] = [u''.join(chunks)]
+        return chunks[0]
+
+    def setContent(self, content):
+        self.chunks = [content]
+        self.length = len(content)
 
     def getIndex(self, podElemName):
         res = -1
@@ -353,7 +551,7 @@ class MemoryBuffer(Buffer):
             # in the parent (if it is a temp buffer generated from a cut)
             del self.subBuffers[subIndex]
             self.subBuffers[self.getLength()] = subBuffer
-            self.content += u' '
+            self.write(u' ')
 
     def transferAllContent(self):
         '''Transfer all content to parent.'''
@@ -361,11 +559,11 @@ class MemoryBuffer(Buffer):
             # First unreference all elements
             for index in self.getElementIndexes(expressions=False):
                 del self.elements[index]
-            self.evaluate(self.parent, self.env.context)
+            self.parent.evaluateBuffer(self, self.env.context)
         else:
             # Transfer content in itself
             oldParentLength = self.parent.getLength()
-            self.parent.write(self.content)
+            for chunk in self.chunks: self.parent.write(chunk)
             # Transfer elements
             for index, podElem in self.elements.iteritems():
                 self.parent.elements[oldParentLength + index] = podElem
@@ -388,29 +586,30 @@ class MemoryBuffer(Buffer):
                 elem.colIndex = elem.tableInfo.curColIndex
         if elem == 'x':
             # See comment on similar statement in the method below.
-            self.content += u' '
+            self.write(u' ')
 
-    def addExpression(self, expression, tiedHook=None):
+    def addExpression(self, expression, tiedHook=None, line=None,
+                      column=None):
         # Create the POD expression
-        expr = Expression(expression, self.pod)
+        expr = Expression(expression, self.pod, line=line, column=column)
         if tiedHook: tiedHook.tiedExpression = expr
         self.elements[self.getLength()] = expr
         # To be sure that an expr and an elem can't be found at the same index
         # in the buffer.
-        self.content += u' '
+        self.write(u' ')
 
     def addAttributes(self):
         '''pod-only: adds an Attributes instance into this buffer.'''
         attrs = Attributes(self.env)
         self.elements[self.getLength()] = attrs
-        self.content += u' '
+        self.write(u' ')
         return attrs
 
     def addAttribute(self, name, expr):
         '''px-only: adds an Attribute instance into this buffer.'''
         attr = Attribute(name, expr)
         self.elements[self.getLength()] = attr
-        self.content += u' '
+        self.write(u' ')
         return attr
 
     def _getVariables(self, expr):
@@ -512,10 +711,12 @@ class MemoryBuffer(Buffer):
             PodError.dump(self, ppe, removeFirstLine=True)
         return res
 
-    def createPxAction(self, elem, actionType, statement):
+    def createPxAction(self, elem, actionType, statement, line=None,
+                       column=None):
         '''Creates a PX action and link it to this buffer. If an action is
            already linked to this buffer (in self.action), this action is
-           chained behind the last action via self.action.subAction.'''
+           chained behind the last action via self.action.subAction. p_line
+           and p_column locate the action within the PX.'''
         res = 0
         statement = statement.strip()
         if actionType == 'for':
@@ -531,6 +732,8 @@ class MemoryBuffer(Buffer):
             variables = self._getVariables(statement)
             action = VariablesAction('var', self, elem, False, variables,
                                      'buffer', None)
+        action.line = line
+        action.column = column
         # Is it the first action for this buffer or not?
         if not self.action:
             self.action = action
@@ -586,12 +789,13 @@ class MemoryBuffer(Buffer):
                 subBuffers[subIndex-index] = buf
             self.subBuffers = subBuffers
         # Manage content
+        content = self.getContent()
         if keepFirstPart:
-            res.write(self.content[index:])
-            self.content = self.content[:index]
+            res.write(content[index:])
+            self.setContent(content[:index])
         else:
-            res.write(self.content[:index])
-            self.content = self.content[index:]
+            res.write(content[:index])
+            self.setContent(content[index:])
         return res
 
     def getElementIndexes(self, expressions=True):
@@ -637,7 +841,8 @@ class MemoryBuffer(Buffer):
         if not removeMainElems: return 0
         # Find the start position of the deepest element to remove
         deepestElem = self.action.elem.DEEPEST_TO_REMOVE
-        pos = self.content.find('<%s' % deepestElem.elem)
+        content = self.getContent()
+        pos = content.find('<%s' % deepestElem.elem)
         pos = pos + len(deepestElem.elem)
         # Now we must find the position of the end of this start tag,
         # skipping potential attributes.
@@ -645,7 +850,7 @@ class MemoryBuffer(Buffer):
         endTagFound = False # Have we found the end of this tag ?
         while not endTagFound:
             pos += 1
-            nextChar = self.content[pos]
+            nextChar = content[pos]
             if (nextChar == '>') and not inAttrValue:
                 # Yes we have it
                 endTagFound = True
@@ -658,7 +863,8 @@ class MemoryBuffer(Buffer):
         if removeMainElems:
             ns = self.env.namespaces
             deepestElem = self.action.elem.DEEPEST_TO_REMOVE
-            pos = self.content.rfind('</%s>' % deepestElem.getFullName(ns))
+            pos = self.getContent().rfind('</%s>' % \
+                                          deepestElem.getFullName(ns))
             res = pos
         else:
             res = self.getLength()
@@ -671,10 +877,162 @@ class MemoryBuffer(Buffer):
            (m_getStartIndex).'''
         # Find the start position of the deepest element to remove
         deepestElem = self.action.elem.DEEPEST_TO_REMOVE
-        pos = self.content.find('<%s' % deepestElem.elem)
+        pos = self.getContent().find('<%s' % deepestElem.elem)
         for index in self.elements.keys():
             if index < pos: del self.elements[index]
 
+    def freeze(self):
+        '''px-only. Once parsing is complete, the content of this buffer and its
+           sub-buffers will not change anymore. This method converts it into a
+           flat list of nodes that will be walked, in this order, at every
+           evaluation, instead of sorting and slicing self.elements and
+           self.subBuffers every time. Every node is a tuple (type, value):
+           * (TEXT,       s_staticContent)
+           * (EXPRESSION, Expression)
+           * (ATTRIBUTE,  Attribute)
+           * (BUFFER,     MemoryBuffer) [the buffer is frozen as well]'''
+        nodes = []
+        content = self.getContent()
+        iter = BufferIterator(self)
+        currentIndex = 0
+        while iter.hasNext():
+            index, entry = iter.next()
+            if index > currentIndex:
+                nodes.append((self.TEXT, content[currentIndex:index]))
+            currentIndex = index + 1
+            if isinstance(entry, Expression):
+                nodes.append((self.EXPRESSION, entry))
+            elif isinstance(entry, Attribute):
+                nodes.append((self.ATTRIBUTE, entry))
+            elif entry.action:
+                entry.freeze()
+                nodes.append((self.BUFFER, entry))
+            elif entry.length:
+                nodes.append((self.TEXT, entry.getContent()))
+        # Like m_evaluate, dump the remaining content only if it is made of at
+        # least 2 chars.
+        if currentIndex < (len(content)-1):
+            nodes.append((self.TEXT, content[currentIndex:]))
+        self.nodes = nodes
+
+    def getFrozenData(self):
+        '''px-only: returns the content of this frozen buffer (see m_freeze)
+           as a structure made of lists, tuples, strings and code objects only,
+           that can be serialized with marshal. m_loadFrozenData performs the
+           reverse operation.'''
+        res = []
+        for kind, value in self.nodes:
+            if kind == self.TEXT:
+                res.append((kind, value))
+            elif kind == self.EXPRESSION:
+                res.append((kind, value.escapeXml, value.expr, value.errorExpr,
+                            (value.code, value.errorCode), value.line,
+                            value.column))
+            elif kind == self.ATTRIBUTE:
+                res.append((kind, value.name, value.expr, value.code))
+            else:
+                # Dump the chain of actions, and the sub-buffer itself
+                actions = []
+                action = value.action
+                while action:
+                    if isinstance(action, ForAction):
+                        actions.append(('for', action.line, action.column,
+                                        action.expr, action.codes,
+                                        action.iter))
+                    elif isinstance(action, VariablesAction):
+                        actions.append(('var', action.line, action.column,
+                                        action.compiled))
+                    else:
+                        actions.append(('if', action.line, action.column,
+                                        action.expr, action.codes))
+                    action = action.subAction
+                res.append((kind, value.action.elem, actions,
+                            value.getFrozenData()))
+        return res
+
+    def loadFrozenData(self, data):
+        '''px-only: the reverse of m_getFrozenData. Creates, in this (empty)
+           buffer, the nodes described in p_data.'''
+        nodes = []
+        for node in data:
+            kind = node[0]
+            if kind == self.TEXT:
+                nodes.append(node)
+            elif kind == self.EXPRESSION:
+                escapeXml, expr, errorExpr, codes, line, column = node[1:]
+                # Rebuild the expression as found in the PX
+                if errorExpr is not None: expr = '%s|%s' % (expr, errorExpr)
+                if not escapeXml: expr = ':%s' % expr
+                nodes.append((kind, Expression(expr, False, codes, line,
+                                                   column)))
+            elif kind == self.ATTRIBUTE:
+                nodes.append((kind, Attribute(*node[1:])))
+            else:
+                elem, actions, subData = node[1:]
+                sub = MemoryBuffer(self.env, self)
+                for info in actions:
+                    if info[0] == 'for':
+                        line, column, expr, codes, iter = info[1:]
+                        action = ForAction('for', sub, expr, elem, False, iter,
+                                           'buffer', None, codes)
+                    elif info[0] == 'var':
+                        line, column, compiled = info[1:]
+                        variables = [(name, expr) for name, expr, c in compiled]
+                        action = VariablesAction('var', sub, elem, False,
+                                         variables, 'buffer', None, compiled)
+                    else:
+                        line, column, expr, codes = info[1:]
+                        action = IfAction('if', sub, expr, elem, False,
+                                          'buffer', None, codes)
+                    action.line = line
+                    action.column = column
+                    if not sub.action:
+                        sub.action = action
+                    else:
+                        sub.action.addSubAction(action)
+                sub.loadFrozenData(subData)
+                nodes.append((kind, sub))
+        self.nodes = nodes
+
+    def evaluateExpression(self, result, context, expr):
+        '''Evaluates Expression p_expr with p_context and dumps the result into
+           p_result.'''
+        profiler = context.get(Profiler.contextKey)
+        if profiler:
+            profiler.enter(profiler.getKey('expr', expr.expr, expr.line))
+        try:
+            # px-only: a sub-PX directly dumps its content into p_result
+            subResult = None
+            if not self.pod: subResult = result
+            res, escape = expr.evaluate(context, subResult)
+            if escape: result.dumpContent(res)
+            elif res: result.write(res)
+        except EvaluationError, e:
+            # This exception has already been treated (see the "except" block
+            # below). Simply re-raise it when needed.
+            if self.env.raiseOnError: raise e
+        except Exception, e:
+            if not self.env.raiseOnError:
+                PodError.dump(result, EVAL_EXPR_ERROR % (expr.expr, e))
+            else:
+                location = getLocation(expr.line, expr.column)
+                raise EvaluationError(e, EVAL_EXPR_ERROR % (expr.expr,location),
+                                      sys.exc_info(), 5)
+        finally:
+            if profiler: profiler.leave()
+
+    def evaluateNodes(self, result, context):
+        '''px-only: evaluates this frozen buffer (see m_freeze).'''
+        for kind, value in self.nodes:
+            if kind == 0: # TEXT
+                result.write(value)
+            elif kind == 1: # EXPRESSION
+                self.evaluateExpression(result, context, value)
+            elif kind == 2: # ATTRIBUTE
+                result.write(value.evaluate(context))
+            else: # BUFFER
+                value.action.execute(result, context)
+
     reTagContent = re.compile('<(?P<p>[\w-]+):(?P<f>[\w-]+)(.*?)>.*</(?P=p):' \
                               '(?P=f)>', re.S)
     def evaluate(self, result, context, subElements=True,
@@ -684,35 +1042,25 @@ class MemoryBuffer(Buffer):
            it is a memory buffer.'''
         if not subElements:
             # Dump the root tag in this buffer, but not its content
-            res = self.reTagContent.match(self.content.strip())
-            if not res: result.write(self.content)
+            content = self.getContent()
+            res = self.reTagContent.match(content.strip())
+            if not res: result.write(content)
             else:
                 g = res.group
                 result.write('<%s:%s%s></%s:%s>' % (g(1),g(2),g(3),g(1),g(2)))
+        elif self.nodes is not None:
+            self.evaluateNodes(result, context)
         else:
             if removeMainElems: self.removeAutomaticExpressions()
+            content = self.getContent()
             iter = BufferIterator(self)
             currentIndex = self.getStartIndex(removeMainElems)
             while iter.hasNext():
                 index, evalEntry = iter.next()
-                result.write(self.content[currentIndex:index])
+                result.write(content[currentIndex:index])
                 currentIndex = index + 1
                 if isinstance(evalEntry, Expression):
-                    try:
-                        res, escape = evalEntry.evaluate(context)
-                        if escape: result.dumpContent(res)
-                        else: result.write(res)
-                    except EvaluationError, e:
-                        # This exception has already been treated (see the 
-                        # "except" block below). Simply re-raise it when needed.
-                        if self.env.raiseOnError: raise e
-                    except Exception, e:
-                        if not self.env.raiseOnError:
-                            PodError.dump(result, EVAL_EXPR_ERROR % (
-                                          evalEntry.expr, e))
-                        else:
-                            raise EvaluationError(e, EVAL_EXPR_ERROR % \
-                                        (evalEntry.expr, '\n'+Traceback.get(5)))
+                    self.evaluateExpression(result, context, evalEntry)
                 elif isinstance(evalEntry, Attributes) or \
                      isinstance(evalEntry, Attribute):
                     result.write(evalEntry.evaluate(context))
@@ -720,12 +1068,12 @@ class MemoryBuffer(Buffer):
                     if evalEntry.action:
                         evalEntry.action.execute(result, context)
                     else:
-                        result.write(evalEntry.content)
+                        result.write(evalEntry.getContent())
             stopIndex = self.getStopIndex(removeMainElems)
             if currentIndex < (stopIndex-1):
-                result.write(self.content[currentIndex:stopIndex])
+                result.write(content[currentIndex:stopIndex])
 
     def clean(self):
         '''Cleans the buffer content.'''
-        self.content = u''
+        self.setContent(u'')
 # ------------------------------------------------------------------------------
@@ -17,8 +17,14 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
 
 # ------------------------------------------------------------------------------
-import sys, os, os.path, time, signal
+import sys, os, os.path, time, signal, socket, json, threading, tempfile
 from optparse import OptionParser
+try:
+    import socketserver
+    import queue
+except ImportError:
+    import SocketServer as socketserver
+    import Queue as queue
 
 htmlFilters = {'odt': 'HTML (StarWriter)',
                'ods': 'HTML (StarCalc)',
@@ -60,9 +66,61 @@ BAD_RESULT_TYPE = 'Bad result type "%s". Available types are %s.'
 CANNOT_WRITE_RESULT = 'I cannot write result "%s". %s'
 CONNECT_ERROR = 'Could not connect to LibreOffice on port %d. UNO ' \
                 '(LibreOffice API) says: %s.'
+START_ERROR = 'LibreOffice could not be started on port %d.'
+SERVICE_ERROR = 'Could not call the converter service at "%s". %s'
+NO_RESPONSE = 'The service did not respond.'
+SERVICE_TIMEOUT = 'The service did not respond within %d seconds.'
 
 # Some constants ---------------------------------------------------------------
 DEFAULT_PORT = 2002
+# Max number of seconds to wait for a converter service to perform a conversion
+DEFAULT_SERVICE_TIMEOUT = 300
+
+# ------------------------------------------------------------------------------
+def getResultPath(docPath, resultType):
+    '''Returns the path of the file produced by the conversion of the document
+       at p_docPath into p_resultType. If the result type and the input type
+       are the same (ie the user wants to refresh indexes or some other action
+       and not perform a real conversion), the result file is named
+                           <inputFileName>.res.<resultType>.
+
+       Else, the result file is named like the input file but with a
+       different extension:
+                           <inputFileName>.<resultType>
+    '''
+    baseName, inputType = os.path.splitext(docPath)
+    if inputType[1:].lower() != resultType:
+        return '%s.%s' % (baseName, resultType)
+    return '%s.res.%s' % (baseName, resultType)
+
+def getDesktop(port):
+    '''Connects to LibreOffice running in server mode on this p_port and
+       returns its central desktop object.'''
+    if os.name == 'nt':
+        import socket
+    import uno
+    from com.sun.star.connection import NoConnectException
+    try:
+        # Get the uno component context from the PyUNO runtime
+        localContext = uno.getComponentContext()
+        # Create the UnoUrlResolver
+        resolver = localContext.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", localContext)
+        # Connect to the running office
+        loContext = resolver.resolve(
+            'uno:socket,host=localhost,port=%d;urp;StarOffice.' \
+            'ComponentContext' % port)
+        # Is seems that we can't define a timeout for this method.
+        # I need it because, for example, when a web server already listens
+        # to the given port (thus, not a LibreOffice instance), this method
+        # blocks.
+        smgr = loContext.ServiceManager
+        # Get the central desktop object
+        return smgr.createInstanceWithContext('com.sun.star.frame.Desktop',
+                                              loContext)
+    except NoConnectException:
+        e = sys.exc_info()[1]
+        raise ConverterError(CONNECT_ERROR % (port, e))
 
 # ------------------------------------------------------------------------------
 class Converter:
@@ -73,7 +131,7 @@ class Converter:
                         'openoffice.org 2': 'openof~1',
                         }
     def __init__(self, docPath, resultType, port=DEFAULT_PORT,
-                 templatePath=None):
+                 templatePath=None, desktop=None):
         self.port = port
         # The path to the document to convert
         self.docUrl, self.docPath = self.getFilePath(docPath)
@@ -81,8 +139,9 @@ class Converter:
         self.resultType = resultType
         self.resultFilter = self.getResultFilter()
         self.resultUrl = self.getResultUrl()
-        self.loContext = None
-        self.oo = None # The LibreOffice application object
+        # The LibreOffice application object. If p_desktop is given, the
+        # connection to LibreOffice is already established and is reused.
+        self.oo = desktop
         self.doc = None # The LibreOffice loaded document
         # The path to a LibreOffice template (ie, a ".ott" file) from which
         # styles can be imported
@@ -120,22 +179,10 @@ class Converter:
         return res
 
     def getResultUrl(self):
-        '''Returns the path of the result file in the format needed by LO. If
-           the result type and the input type are the same (ie the user wants to
-           refresh indexes or some other action and not perform a real
-           conversion), the result file is named
-                           <inputFileName>.res.<resultType>.
-
-           Else, the result file is named like the input file but with a
-           different extension:
-                           <inputFileName>.<resultType>
-        '''
+        '''Returns the path of the result file (see m_getResultPath) in the
+           format needed by LO.'''
         import unohelper
-        baseName = os.path.splitext(self.docPath)[0]
-        if self.resultType != self.inputType:
-            res = '%s.%s' % (baseName, self.resultType)
-        else:
-            res = '%s.res.%s' % (baseName, self.resultType)
+        res = getResultPath(self.docPath, self.resultType)
         try:
             f = open(res, 'w')
             f.write('Hello')
@@ -160,31 +207,7 @@ class Converter:
 
     def connect(self):
         '''Connects to LibreOffice'''
-        if os.name == 'nt':
-            import socket
-        import uno
-        from com.sun.star.connection import NoConnectException
-        try:
-            # Get the uno component context from the PyUNO runtime
-            localContext = uno.getComponentContext()
-            # Create the UnoUrlResolver
-            resolver = localContext.ServiceManager.createInstanceWithContext(
-                "com.sun.star.bridge.UnoUrlResolver", localContext)
-            # Connect to the running office
-            self.loContext = resolver.resolve(
-                'uno:socket,host=localhost,port=%d;urp;StarOffice.' \
-                'ComponentContext' % self.port)
-            # Is seems that we can't define a timeout for this method.
-            # I need it because, for example, when a web server already listens
-            # to the given port (thus, not a LibreOffice instance), this method
-            # blocks.
-            smgr = self.loContext.ServiceManager
-            # Get the central desktop object
-            self.oo = smgr.createInstanceWithContext(
-                'com.sun.star.frame.Desktop', self.loContext)
-        except NoConnectException:
-            e = sys.exc_info()[1]
-            raise ConverterError(CONNECT_ERROR % (self.port, e))
+        self.oo = getDesktop(self.port)
 
     def updateOdtDocument(self):
         '''If the input file is an ODT document, we will perform those tasks:
@@ -263,11 +286,247 @@ class Converter:
         self.doc.storeToURL(self.resultUrl, self.props(props))
 
     def run(self):
-        '''Connects to LO, does the job and disconnects'''
-        self.connect()
-        self.loadDocument()
-        self.convertDocument()
-        self.doc.close(True)
+        '''Connects to LO (if not already connected), does the job and
+           disconnects.'''
+        if not self.oo: self.connect()
+        try:
+            self.loadDocument()
+            self.convertDocument()
+        finally:
+            # With a reused connection, the document must be closed anyway
+            if self.doc: self.doc.close(True)
+
+# ------------------------------------------------------------------------------
+def getAddress(address):
+    '''Returns a tuple (family, address) for the socket of a converter service
+       listening at p_address. If p_address is an integer (or a string
+       containing an integer), it is a TCP port on localhost; else, it is the
+       path to a Unix socket.'''
+    if isinstance(address, int) or address.isdigit():
+        return socket.AF_INET, ('localhost', int(address))
+    return socket.AF_UNIX, address
+
+def callService(address, docPath, resultType, templatePath=None,
+                timeout=DEFAULT_SERVICE_TIMEOUT):
+    '''Asks the ConverterService listening at p_address (see m_getAddress) to
+       convert the document at p_docPath into p_resultType. The result is
+       written next to p_docPath, exactly like a Converter does. This function
+       does not require UNO. It raises a ConverterError if the conversion
+       failed, or if the service did not respond within p_timeout seconds
+       (the conversion is then still queued or running in the service).
+       Beware: the service converts any path sent by any local client (see
+       ConverterService).'''
+    request = {'doc': os.path.abspath(docPath), 'type': resultType,
+               'template': templatePath and os.path.abspath(templatePath)}
+    family, address_ = getAddress(address)
+    try:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address_)
+            sock.sendall(('%s\n' % json.dumps(request)).encode('utf-8'))
+            response = sock.makefile('rb').readline()
+        finally:
+            sock.close()
+    except socket.timeout:
+        raise ConverterError(SERVICE_ERROR % (address,
+                                              SERVICE_TIMEOUT % timeout))
+    except socket.error:
+        e = sys.exc_info()[1]
+        raise ConverterError(SERVICE_ERROR % (address, e))
+    if not response:
+        raise ConverterError(SERVICE_ERROR % (address, NO_RESPONSE))
+    error = json.loads(response.decode('utf-8'))['error']
+    if error: raise ConverterError(error)
+
+# ------------------------------------------------------------------------------
+class LoInstance:
+    '''A LibreOffice instance running in server mode on some port, to which a
+       UNO connection is kept open. If the path to the soffice executable is
+       given, the instance is launched, and relaunched when it crashed. Else,
+       the instance is managed elsewhere and is simply reconnected.'''
+    # Max number of seconds to wait for a launched instance to accept
+    # connections.
+    startTimeout = 60
+
+    def __init__(self, port, soffice=None):
+        self.port = port
+        self.soffice = soffice
+        self.process = None # The soffice process, if launched by me
+        self.desktop = None # The LibreOffice desktop object
+
+    def isAlive(self):
+        '''Is the instance started and still responding?'''
+        if not self.desktop: return
+        if self.process and (self.process.poll() is not None): return
+        try:
+            self.desktop.getComponents()
+            return True
+        except Exception:
+            return
+
+    def launch(self):
+        '''Launches soffice in server mode on self.port. Every instance gets its
+           own user profile: instances sharing a profile would conflict.'''
+        import subprocess, unohelper
+        profile = os.path.join(tempfile.gettempdir(), 'appyLo%d' % self.port)
+        cmd = [self.soffice, '--headless', '--invisible', '--nologo',
+               '--norestore', '--nodefault',
+               '-env:UserInstallation=%s' % \
+                 unohelper.systemPathToFileUrl(profile),
+               '--accept=socket,host=localhost,port=%d;urp;' % self.port]
+        self.process = subprocess.Popen(cmd)
+
+    def start(self):
+        '''(Re)starts the instance and connects to it'''
+        self.stop()
+        if not self.soffice:
+            self.desktop = getDesktop(self.port)
+            return
+        self.launch()
+        # Wait until the instance accepts connections
+        start = time.time()
+        while True:
+            try:
+                self.desktop = getDesktop(self.port)
+                return
+            except ConverterError:
+                if (self.process.poll() is not None) or \
+                   ((time.time() - start) > self.startTimeout):
+                    self.stop()
+                    raise ConverterError(START_ERROR % self.port)
+                time.sleep(0.5)
+
+    def stop(self):
+        '''Forgets the connection and kills the instance if I launched it'''
+        self.desktop = None
+        if not self.process: return
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def convert(self, job):
+        '''Performs this conversion p_job. Returns None if it succeeded, or an
+           error message.'''
+        # If an unexpected error occurs, the instance has probably crashed:
+        # it is restarted and the job is tried a second time.
+        for i in range(2):
+            try:
+                if not self.isAlive(): self.start()
+                Converter(job.docPath, job.resultType, self.port,
+                          job.templatePath, self.desktop).run()
+                return
+            except ConverterError:
+                return str(sys.exc_info()[1])
+            except Exception:
+                error = str(sys.exc_info()[1])
+                self.stop()
+        return error
+
+# ------------------------------------------------------------------------------
+class ConversionJob:
+    '''A conversion waiting, in the ConverterService queue, for a LibreOffice
+       instance to perform it.'''
+    def __init__(self, docPath, resultType, templatePath=None):
+        self.docPath = docPath
+        self.resultType = resultType
+        self.templatePath = templatePath
+        self.error = None
+        self.done = threading.Event()
+
+class ServiceHandler(socketserver.StreamRequestHandler):
+    '''Manages a connection to the ConverterService. A client sends, on a
+       single line, a JSON-encoded request, as built by m_callService. The
+       service responds, also on a single line, with a JSON-encoded dict
+       whose key "error" is None or an error message.'''
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line: break
+            try:
+                request = json.loads(line.decode('utf-8'))
+                error = self.server.service.convert(request['doc'],
+                                       request['type'], request.get('template'))
+            except Exception:
+                error = str(sys.exc_info()[1])
+            response = '%s\n' % json.dumps({'error': error})
+            self.wfile.write(response.encode('utf-8'))
+            self.wfile.flush()
+
+class TcpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if hasattr(socket, 'AF_UNIX'):
+    class UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+class ConverterService:
+    '''A long-running service owning a pool of LibreOffice instances, on a
+       range of ports, and keeping UNO connections to them open. Conversion
+       jobs, received on a local socket, are queued and performed by the
+       first available instance. This way, callers (see m_callService) do not
+       pay, for every document, the price of starting a UNO-enabled Python
+       interpreter and connecting to LibreOffice.
+
+       The service does not authenticate its clients: it converts any file
+       whose path is sent by any local client, and writes the result next to
+       it, with the rights of the user running the service. Prefer a Unix
+       socket, whose file permissions restrict who may connect, to a TCP
+       port, that any local user may reach.'''
+
+    def __init__(self, address, ports, soffice=None):
+        # The address (see m_getAddress) the service listens to
+        self.address = address
+        self.instances = [LoInstance(port, soffice) for port in ports]
+        self.jobs = queue.Queue()
+
+    def work(self, instance):
+        '''Performs, with this LibreOffice p_instance, jobs from the queue'''
+        while True:
+            job = self.jobs.get()
+            try:
+                job.error = instance.convert(job)
+            except Exception:
+                job.error = str(sys.exc_info()[1])
+            job.done.set()
+
+    def convert(self, docPath, resultType, templatePath=None):
+        '''Queues a conversion job and waits until it is performed. Returns
+           None or an error message.'''
+        job = ConversionJob(docPath, resultType, templatePath)
+        self.jobs.put(job)
+        # Waiting with a timeout allows the thread to be interrupted
+        while not job.done.is_set(): job.done.wait(1)
+        return job.error
+
+    def getServer(self):
+        family, address = getAddress(self.address)
+        if family == socket.AF_INET:
+            res = TcpServer(address, ServiceHandler)
+        else:
+            if os.path.exists(address): os.remove(address)
+            res = UnixServer(address, ServiceHandler)
+        res.service = self
+        return res
+
+    def run(self):
+        '''Starts the LibreOffice instances and serves requests until
+           interrupted.'''
+        for instance in self.instances:
+            instance.start()
+            worker = threading.Thread(target=self.work, args=(instance,))
+            worker.daemon = True
+            worker.start()
+        server = self.getServer()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            for instance in self.instances: instance.stop()
+            if server.address_family != socket.AF_INET:
+                os.remove(self.address)
 
 # ConverterScript-related messages ---------------------------------------------
 WRONG_NB_OF_ARGS = 'Wrong number of arguments.'
@@ -282,7 +541,10 @@ class ConverterScript:
             '   and   outputType is the output format, that must be one of\n' \
             '         %s.\n' \
             ' "python" should be a UNO-enabled Python interpreter (ie the ' \
-            '  one which is included in the LibreOffice distribution).' % \
+            '  one which is included in the LibreOffice distribution).\n' \
+            '       python converter.py -s address [options]\n' \
+            '   runs a converter service listening at this address (a port ' \
+            'on localhost or the path to a Unix socket).' % \
             str(FILE_TYPES.keys())
     def run(self):
         optParser = OptionParser(usage=ConverterScript.usage)
@@ -294,15 +556,52 @@ class ConverterScript:
                              default=None, metavar="TEMPLATE", type='string',
                              help="The path to a LibreOffice template from " \
                                   "which you may import styles.")
+        optParser.add_option("-s", "--serve", dest="serve", default=None,
+                             metavar="ADDRESS", type='string',
+                             help="Runs a converter service listening at " \
+                                  "this address.")
+        optParser.add_option("-n", "--instances", dest="instances", default=1,
+                             metavar="NUMBER", type='int',
+                             help="The number of LibreOffice instances used " \
+                                  "by the service, running on successive " \
+                                  "ports, starting at PORT.")
+        optParser.add_option("-o", "--soffice", dest="soffice", default=None,
+                             metavar="SOFFICE", type='string',
+                             help="The path to the soffice executable. If " \
+                                  "given, the service launches (and " \
+                                  "relaunches) its LibreOffice instances. " \
+                                  "Else, they must already run.")
+        optParser.add_option("-c", "--service", dest="service", default=None,
+                             metavar="ADDRESS", type='string',
+                             help="Performs the conversion via the " \
+                                  "converter service listening at this " \
+                                  "address.")
+        optParser.add_option("-w", "--timeout", dest="timeout",
+                             default=DEFAULT_SERVICE_TIMEOUT,
+                             metavar="SECONDS", type='int',
+                             help="The max number of seconds to wait for the " \
+                                  "converter service. Default is %d." % \
+                                  DEFAULT_SERVICE_TIMEOUT)
         (options, args) = optParser.parse_args()
+        if options.serve:
+            ports = range(options.port, options.port + options.instances)
+            try:
+                ConverterService(options.serve, ports, options.soffice).run()
+            except KeyboardInterrupt:
+                pass
+            return
         if len(args) != 2:
             sys.stderr.write(WRONG_NB_OF_ARGS)
             sys.stderr.write('\n')
             optParser.print_help()
             sys.exit(ERROR_CODE)
-        converter = Converter(args[0], args[1], options.port, options.template)
         try:
-            converter.run()
+            if options.service:
+                callService(options.service, args[0], args[1],
+                            options.template, options.timeout)
+            else:
+                Converter(args[0], args[1], options.port,
+                          options.template).run()
         except ConverterError:
             e = sys.exc_info()[1]
             sys.stderr.write(str(e))
@@ -17,12 +17,16 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
 # ------------------------------------------------------------------------------
-import os, os.path, time, shutil, struct, random, urlparse, imghdr
+import os, os.path, re, time, shutil, struct, random, urlparse, imghdr
+import threading, Queue
+from multiprocessing.pool import ThreadPool
+from ast import literal_eval
 from appy.pod import PodError
 from appy.pod.odf_parser import OdfEnvironment
 from appy.shared import mimeTypesExts
 from appy.shared.utils import FileWrapper, executeCommand
 from appy.shared.dav import Resource, ResourceError
+from appy.shared.cache import getKey, getFileDigest
 # The uuid module is there only if python >= 2.5
 try:
     import uuid
@@ -62,10 +66,10 @@ class DocImporter:
         self.linkNs = self.ns[OdfEnvironment.NS_XLINK]
         self.drawNs = self.ns[OdfEnvironment.NS_DRAW]
         self.svgNs = self.ns[OdfEnvironment.NS_SVG]
-        self.tempFolder = renderer.tempFolder
+        self.tempFolder = renderer.getTempFolder()
         self.importFolder = self.getImportFolder()
         # Create the import folder if it does not exist
-        if not os.path.exists(self.importFolder): os.mkdir(self.importFolder)
+        if not os.path.exists(self.importFolder): os.makedirs(self.importFolder)
         self.importPath = self.getImportPath(at, format)
         # A link to the global fileNames dict (explained in renderer.py)
         self.fileNames = renderer.fileNames
@@ -171,7 +175,10 @@ class PodImporter(DocImporter):
         renderer = r.__class__(self.importPath, self.context, resOdt,
                                pythonWithUnoPath=r.pyPath,
                                ooPort=r.ooPort, forceOoCall=r.forceOoCall,
-                               imageResolver=r.imageResolver)
+                               imageResolver=r.imageResolver,
+                               converterService=r.converterService,
+                               conversionCache=r.conversionCache,
+                               imageCache=r.imageCache)
         renderer.stylesManager.stylesMapping = r.stylesManager.stylesMapping
         renderer.run()
         # The POD result is in "resOdt". Import it into the main POD result
@@ -188,27 +195,121 @@ class PdfImporter(DocImporter):
     gsDevices = {'jpeg': 'jpg', 'jpeggray': 'jpg',
                  'png16m': 'png', 'pnggray': 'png'}
 
+    # Ghostscript resolution
+    dpi = '125'
+    # When rasterizing a PDF with several Ghostscript processes (see
+    # m_rasterize), every process converts at least this number of pages.
+    pagesPerProcess = 4
+    # A regex used for counting the pages of a PDF
+    rexPage = re.compile(r'/Type\s*/Page(?!s)')
+
     def getImportFolder(self): return '%s/docImports' % self.tempFolder
+
+    def getPageCount(self):
+        '''Returns the number of pages of the PDF to import, or 0 if it can't be
+           found by simply scanning the file (ie, page objects are stored in
+           compressed object streams).'''
+        f = file(self.importPath, 'rb')
+        try:
+            return len(PdfImporter.rexPage.findall(f.read()))
+        finally:
+            f.close()
+
+    def callGs(self, device, outputFile, pages=None):
+        '''Calls Ghostscript for converting the PDF to import into images whose
+           paths are given by p_outputFile. p_pages may be a tuple (first,
+           last) of page numbers: only these pages will be converted.'''
+        cmd = ['gs', '-dSAFER', '-dNOPAUSE', '-dBATCH', '-sDEVICE=%s' % device,
+               '-r%s' % PdfImporter.dpi, '-dTextAlphaBits=4',
+               '-dGraphicsAlphaBits=4', '-sOutputFile=%s' % outputFile]
+        if pages:
+            cmd += ['-dFirstPage=%d' % pages[0], '-dLastPage=%d' % pages[1]]
+        cmd.append(self.importPath)
+        executeCommand(cmd)
+
+    def rasterize(self, device, imagesFolder, imagePrefix, ext):
+        '''Splits the PDF into images with Ghostscript. If the renderer allows
+           it (see its attribute "pdfProcesses") and the PDF is large enough,
+           several Ghostscript processes run in parallel, each one converting
+           a range of pages.'''
+        processes = self.renderer.pdfProcesses
+        pageCount = (processes > 1) and self.getPageCount() or 0
+        perProcess = max(PdfImporter.pagesPerProcess,
+                         -(-pageCount // max(processes, 1)))
+        if pageCount <= perProcess:
+            self.callGs(device, '%s/%s%%d.%s' % (imagesFolder, imagePrefix,ext))
+            return
+        # Ghostscript numbers the images from 1 within every range
+        ranges = [(first, min(first + perProcess - 1, pageCount)) \
+                  for first in range(1, pageCount + 1, perProcess)]
+        def convert(pages):
+            prefix = '%s/%s-%d-' % (imagesFolder, imagePrefix, pages[0])
+            self.callGs(device, '%s%%d.%s' % (prefix, ext), pages)
+            for i in range(pages[0], pages[1] + 1):
+                path = '%s%d.%s' % (prefix, i - pages[0] + 1, ext)
+                if not os.path.exists(path): break
+                os.rename(path, '%s/%s%d.%s' % (imagesFolder,imagePrefix,i,ext))
+        pool = ThreadPool(min(processes, len(ranges)))
+        try:
+            pool.map(convert, ranges)
+        finally:
+            pool.close()
+            pool.join()
+
+    def getCachedPages(self, key, imagesFolder, imagePrefix, ext):
+        '''Dumps, in p_imagesFolder, the images corresponding to the PDF pages
+           stored in the image cache for this p_key. Returns False if not all
+           pages are in the cache.'''
+        cache = self.renderer.imageCache
+        entry = cache.getEntry(key)
+        if not entry: return False
+        paths = []
+        for i in range(1, int(entry[0][0]) + 1):
+            page = cache.getEntry('%s-%d' % (key, i))
+            if not page:
+                for path in paths: os.remove(path)
+                return False
+            path = '%s/%s%d.%s' % (imagesFolder, imagePrefix, i, ext)
+            f = file(path, 'wb')
+            f.write(page[1])
+            f.close()
+            paths.append(path)
+        return True
+
+    def setCachedPages(self, key, imagesFolder, imagePrefix, ext):
+        '''Stores, in the image cache, the images produced by Ghostscript'''
+        cache = self.renderer.imageCache
+        i = 0
+        while True:
+            path = '%s/%s%d.%s' % (imagesFolder, imagePrefix, i + 1, ext)
+            if not os.path.exists(path): break
+            i += 1
+            f = file(path, 'rb')
+            cache.setEntry('%s-%d' % (key, i), (ext,), f.read())
+            f.close()
+        # Store the number of pages last: the pages are complete once it is
+        # there.
+        if i: cache.setEntry(key, (str(i),), '')
+
     def run(self):
         imagePrefix = os.path.splitext(os.path.basename(self.importPath))[0]
-        # Split the PDF into images with Ghostscript
         imagesFolder = os.path.dirname(self.importPath)
         device = 'png16m'
         ext = PdfImporter.gsDevices[device]
-        dpi = '125'
-        cmd = ['gs', '-dSAFER', '-dNOPAUSE', '-dBATCH', '-sDEVICE=%s' % device,
-               '-r%s' % dpi, '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4',
-               '-sOutputFile=%s/%s%%d.%s' % (imagesFolder, imagePrefix, ext),
-               self.importPath]
-        executeCommand(cmd)
+        # Get the images from the cache, or split the PDF into images with
+        # Ghostscript.
+        cache = self.renderer.imageCache
+        key = None
+        if cache:
+            key = getKey('pdf', getFileDigest(self.importPath), device,
+                         PdfImporter.dpi)
+        if not key or \
+           not self.getCachedPages(key, imagesFolder, imagePrefix, ext):
+            self.rasterize(device, imagesFolder, imagePrefix, ext)
+            if key: self.setCachedPages(key, imagesFolder, imagePrefix, ext)
         # Check that at least one image was generated
-        succeeded = False
-        firstImage = '%s1.%s' % (imagePrefix, ext)
-        for fileName in os.listdir(imagesFolder):
-            if fileName == firstImage:
-                succeeded = True
-                break
-        if not succeeded: raise PodError(PDF_TO_IMG_ERROR)
+        firstImage = '%s/%s1.%s' % (imagesFolder, imagePrefix, ext)
+        if not os.path.exists(firstImage): raise PodError(PDF_TO_IMG_ERROR)
         # Insert images into the result
         noMoreImages = False
         i = 0
@@ -218,7 +319,8 @@ class PdfImporter(DocImporter):
             if os.path.exists(nextImage):
                 # Use internally an Image importer for doing this job
                 imgImporter= ImageImporter(None, nextImage, ext, self.renderer)
-                imgImporter.init('paragraph', True, None, None, None, True)
+                imgImporter.init('paragraph', True, None, None, None, True,
+                                 None)
                 self.res += imgImporter.run()
                 os.remove(nextImage)
             else:
@@ -256,15 +358,91 @@ class ConvertImporter(DocImporter):
         pdfImporter = PdfImporter(None, pdfFile, 'pdf', self.renderer)
         return pdfImporter.run()
 
+# ------------------------------------------------------------------------------
+def downloadImage(url, cache=None):
+    '''Performs a HTTP GET on p_url and returns a tuple (format, content, etag),
+       or None if the image could not be downloaded. If an ImageCache is given
+       in p_cache and the server gives an ETag for the image, the image is
+       cached: the next time, the server will only be asked if the image has
+       changed.'''
+    key = entry = None
+    headers = {}
+    if cache:
+        key = getKey('url', url)
+        entry = cache.getEntry(key)
+        if entry: headers['If-None-Match'] = entry[0][0]
+    try:
+        response = Resource(url).get(headers=headers)
+    except ResourceError:
+        return
+    if entry and (response.code == 304):
+        # The image did not change
+        (etag, format), content = entry
+        return format, content, etag
+    if response.code != 200: return
+    # Retrieve the image format
+    format = response.headers['Content-Type']
+    if format not in mimeTypesExts: return
+    format = mimeTypesExts[format]
+    etag = response.headers.get('ETag')
+    if etag and cache: cache.setEntry(key, (etag, format), response.body)
+    return format, response.body, etag
+
+class ImagePrefetcher:
+    '''Downloads, in a pool of threads, images from URLs that will be imported
+       into a POD result. The downloads run while the template is parsed and
+       rendered.'''
+    threads = 4
+
+    def __init__(self, urls, cache=None):
+        self.cache = cache
+        self.urls = Queue.Queue()
+        # Downloaded images, keyed by URL, as returned by m_downloadImage
+        self.images = {}
+        # For every URL, an event that is set once the image is downloaded
+        self.events = {}
+        for url in urls:
+            if url in self.events: continue
+            self.events[url] = threading.Event()
+            self.urls.put(url)
+        for i in range(min(self.threads, len(self.events))):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def work(self):
+        while True:
+            try:
+                url = self.urls.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.images[url] = downloadImage(url, self.cache)
+            except Exception:
+                self.images[url] = None
+            self.events[url].set()
+
+    def get(self, url):
+        '''Waits until the image at p_url is downloaded and returns it (see
+           m_downloadImage). Returns False if this image is not prefetched.'''
+        event = self.events.get(url)
+        if not event: return False
+        event.wait()
+        return self.images[url]
+
 # ------------------------------------------------------------------------------
 class Image:
     '''Represents an image on disk. This class is used to detect the image type
        and size.'''
     jpgTypes = ('jpg', 'jpeg')
 
-    def __init__(self, path, format):
+    def __init__(self, path, format, size=None):
         self.path = path # The image absolute path on disk
         self.format = format
+        if size:
+            # The format and size are already known (ie, from an ImageCache)
+            self.width, self.height = size
+            return
         if format == 'image':
             # Read its format by reading its first bytes
             self.format = imghdr.what(path)
@@ -323,40 +501,42 @@ class ImageImporter(DocImporter):
         return os.path.join(self.tempFolder, 'unzip', 'Pictures')
 
     def moveFile(self, at, importPath):
+        '''The image is imported by m_init (see m_importImage): the way to do
+           it depends on the parameters given to m_init.'''
+        return importPath
+
+    def importImage(self, at, importPath):
         '''Copies file at p_at into the ODT file at p_importPath.'''
-        # Has this image already been imported ?
-        for imagePath, imageAt in self.fileNames.iteritems():
-            if imageAt == at:
-                # Yes!
-                i = importPath.rfind(self.pictFolder) + 1
-                return importPath[:i] + imagePath
-        # The image has not already been imported: copy it.
         if not at.startswith('http'):
             shutil.copy(at, importPath)
             return importPath
+        # If the URL is one from the application server running this POD code
+        # and an image resolver has been given to POD, use it to retrieve the
+        # image: performing a HTTP GET to ourself could wait for a free worker
+        # thread forever.
+        renderer = self.renderer
+        if renderer.isSiteUrl(at) and self.getFieldName(at):
+            try:
+                return self.resolveImage(at, importPath)
+            except Exception:
+                # The object or field can't be found (ie, the URL is the one of
+                # a static resource): try a HTTP GET.
+                pass
         # The image must be retrieved via a URL. Try to perform a HTTP GET.
-        try:
-            response = Resource(at).get()
-        except ResourceError, re:
-            response = None # Can't get the distant image
-        if response and (response.code == 200):
-            # Retrieve the image format
-            format = response.headers['Content-Type']
-            if format in mimeTypesExts:
-                # At last, I can get the file format
-                self.format = mimeTypesExts[format]
-                importPath += self.format
-                f = file(importPath, 'wb')
-                f.write(response.body)
-                f.close()
-                return importPath
+        image = self.download(at)
+        if image:
+            self.format, content = image
+            importPath += self.format
+            f = file(importPath, 'wb')
+            f.write(content)
+            f.close()
+            return importPath
         # The HTTP GET did not work, maybe for security reasons (we probably
         # have no permission to get the file). But maybe the URL was a local
         # one, from an application server running this POD code. In this case,
         # if an image resolver has been given to POD, use it to retrieve the
         # image.
-        imageResolver = self.renderer.imageResolver
-        if not imageResolver:
+        if not renderer.imageResolver or not self.getFieldName(at):
             # Return some default image explaining that the image wasn't found
             import appy.pod
             podFolder = os.path.dirname(appy.pod.__file__)
@@ -370,23 +550,70 @@ class ImageImporter(DocImporter):
             f.write(imageContent)
             f.close()
         else:
-            # The imageResolver is a Zope application. From it, we will
-            # retrieve the object on which the image is stored and get
-            # the file to download.
-            urlParts = urlparse.urlsplit(at)
-            path = urlParts[2][1:].split('/')[:-1]
-            try:
-                obj = imageResolver.unrestrictedTraverse(path)
-            except KeyError:
-                # Maybe a rewrite rule as added some prefix to all URLs?
-                obj = imageResolver.unrestrictedTraverse(path[1:])
-            zopeFile = getattr(obj, urlParts[3].split('=')[1])
-            appyFile = FileWrapper(zopeFile)
+            importPath = self.resolveImage(at, importPath)
+        return importPath
+
+    def getFieldName(self, at):
+        '''If URL p_at is the one of a file stored in a field of an object,
+           of the form <object path>/<method>?name=<field name>, returns the
+           field name. Else, returns None.'''
+        urlParts = urlparse.urlsplit(at)
+        if urlParts[2].count('/') < 2: return
+        name = urlparse.parse_qs(urlParts[3]).get('name')
+        return name and name[0] or None
+
+    def resolveImage(self, at, importPath):
+        '''Retrieves the image at URL p_at through the image resolver and
+           copies it at p_importPath (completed with the image format).'''
+        # The imageResolver is a Zope application. From it, we will retrieve
+        # the object on which the image is stored and get the file to download.
+        imageResolver = self.renderer.imageResolver
+        path = urlparse.urlsplit(at)[2][1:].split('/')[:-1]
+        try:
+            obj = imageResolver.unrestrictedTraverse(path)
+        except KeyError:
+            # Maybe a rewrite rule as added some prefix to all URLs?
+            obj = imageResolver.unrestrictedTraverse(path[1:])
+        value = getattr(obj, self.getFieldName(at))
+        if value.__class__.__name__ == 'FileInfo':
+            # The file is in the database-controlled filesystem: copy it
+            self.format = mimeTypesExts[value.mimeType]
+            importPath += self.format
+            shutil.copy(value.getFilePath(obj.appy()), importPath)
+        else:
+            # A Zope file
+            appyFile = FileWrapper(value)
             self.format = mimeTypesExts[appyFile.mimeType]
             importPath += self.format
             appyFile.dump(importPath)
         return importPath
 
+    def download(self, at):
+        '''Performs a HTTP GET on p_at (see function m_downloadImage), or gets
+           its result from the renderer's ImagePrefetcher, and returns a tuple
+           (format, content), or None if the image could not be
+           downloaded.'''
+        prefetcher = self.renderer.prefetcher
+        res = False
+        if prefetcher: res = prefetcher.get(at)
+        if res is False:
+            # This image was not prefetched
+            res = downloadImage(at, self.renderer.imageCache)
+        if not res: return
+        format, content, etag = res
+        if etag: self.source = ('url', at, etag)
+        return format, content
+
+    def getSource(self):
+        '''Returns a tuple of strings identifying the imported image, or None
+           if it can't be identified.'''
+        at = self.at
+        if not at: return ('content', getFileDigest(self.importPath))
+        if at.startswith('http'): return self.source
+        stat = os.stat(at)
+        return ('file', os.path.abspath(at), repr(stat.st_mtime),
+                str(stat.st_size))
+
     def init(self, anchor, wrapInPara, size, sizeUnit, style, keepRatio,
              convertOptions):
         '''ImageImporter-specific constructor'''
@@ -409,25 +636,83 @@ class ImageImporter(DocImporter):
                 if value.endswith('px'): value = value[:-2]
                 if value.isdigit(): value=int(value)
                 self.cssAttrs[name.strip()] = value
-        # Call imagemagick to perform a custom conversion if required
-        options = self.convertOptions
+        # The identity of a downloaded image (see m_download)
+        self.source = None
+        # Has this image already been imported, with the same options ?
+        images = self.renderer.images
+        key = self.at and (self.at, convertOptions)
+        if key and (key in images):
+            self.importPath, self.format, self.image = images[key]
+            return
+        if self.at: self.importPath = self.importImage(self.at,self.importPath)
+        self.transform(convertOptions)
+        if key: images[key] = (self.importPath, self.format, self.image)
+
+    def transform(self, options):
+        '''Calls imagemagick to perform a custom conversion if required by
+           p_options (see m_init), computes the image size and, for a SVG
+           image, converts it to PNG. If the renderer has an image cache, the
+           result is cached.'''
         image = None
-        transformed = False
+        if callable(options): # It is a function
+            image = Image(self.importPath, self.format)
+            options = options(image)
+        svg = self.importPath.endswith('.svg')
+        if not options and not svg:
+            # There is nothing to transform
+            self.image = image or Image(self.importPath, self.format)
+            return
+        # Get the result from the cache if possible
+        cache = self.renderer.imageCache
+        key = None
+        if cache:
+            source = self.getSource()
+            if source:
+                key = getKey(options or '', str(self.format), *source)
+                entry = cache.getEntry(key)
+                if entry:
+                    self.setCachedImage(*entry)
+                    return
         if options:
-            if callable(options): # It is a function
-                image = Image(self.importPath, self.format)
-                options = self.convertOptions(image)
-            if options:
-                cmd = ['convert', self.importPath] + options.split() + \
-                      [self.importPath]
-                out, err = executeCommand(cmd)
-                if err: raise Exception(CONVERT_ERROR)
-                transformed = True
+            cmd = ['convert', self.importPath] + options.split() + \
+                  [self.importPath]
+            out, err = executeCommand(cmd)
+            if err: raise Exception(CONVERT_ERROR)
+            image = None
         # Avoid creating an Image instance twice if no transformation occurred
-        if image and not transformed:
-            self.image = image
-        else:
-            self.image = Image(self.importPath, self.format)
+        self.image = image or Image(self.importPath, self.format)
+        # In the case of SVG files, perform an image conversion to PNG
+        if svg:
+            newImportPath = os.path.splitext(self.importPath)[0] + '.png'
+            out, err = executeCommand(['convert', self.importPath,
+                                       newImportPath])
+            if err: raise Exception(CONVERT_ERROR)
+            os.remove(self.importPath)
+            self.importPath = newImportPath
+            self.format = 'png'
+        if key:
+            f = file(self.importPath, 'rb')
+            content = f.read()
+            f.close()
+            image = self.image
+            info = [os.path.splitext(self.importPath)[1][1:], self.format,
+                    image.format, image.width, image.height]
+            info = [(value is not None) and repr(value) or '' for value in info]
+            cache.setEntry(key, info, content)
+
+    def setCachedImage(self, info, content):
+        '''Replaces the image with its transformed version, from the image
+           cache.'''
+        # Info values are Python literals (strings or floats), or empty
+        ext, self.format, format, width, height = \
+          [value and literal_eval(value) or None for value in info]
+        path = '%s.%s' % (os.path.splitext(self.importPath)[0], ext)
+        f = file(path, 'wb')
+        f.write(content)
+        f.close()
+        if path != self.importPath: os.remove(self.importPath)
+        self.importPath = path
+        self.image = Image(path, format, size=(width, height))
 
     def getImageSize(self):
         '''Get or compute the image size and returns the corresponding ODF
@@ -482,16 +767,6 @@ class ImageImporter(DocImporter):
         i = self.importPath.rfind(self.pictFolder)
         imagePath = self.importPath[i+1:].replace('\\', '/')
         self.fileNames[imagePath] = self.at
-        # In the case of SVG files, perform an image conversion to PNG
-        if imagePath.endswith('.svg'):
-            newImportPath = os.path.splitext(self.importPath)[0] + '.png'
-            out, err = executeCommand(['convert', self.importPath,
-                                       newImportPath])
-            if err: raise Exception(CONVERT_ERROR)
-            os.remove(self.importPath)
-            self.importPath = newImportPath
-            imagePath = os.path.splitext(imagePath)[0] + '.png'
-            self.format = 'png'
         # Compute image alignment if CSS attr "float" is specified
         if 'float' in self.cssAttrs:
             floatValue = self.cssAttrs['float'].capitalize()
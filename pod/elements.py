@@ -20,6 +20,46 @@ from appy.shared.xml_parser import XmlElement
 from appy.pod.odf_parser import OdfEnvironment as ns
 from appy.pod import PodError
 
+# ------------------------------------------------------------------------------
+def compileExpr(expr):
+    '''Compiles Python expression p_expr (a string) into a code object that
+       can be evaluated many times via eval(code, context) without being
+       re-parsed. If p_expr can't be compiled, p_expr itself is returned: the
+       SyntaxError will then be raised, as usual, when evaluating it.'''
+    # Like eval, ignore leading blanks
+    try:
+        return compile(expr.lstrip(' \t'), '<string>', 'eval')
+    except SyntaxError:
+        return expr
+
+def compileExprs(expr):
+    '''p_expr can contain an error expression, in the form
+       "someExpr|errorExpr". This function returns a tuple (code, errorCode)
+       containing the compiled "normal" and "error" expressions. errorCode is
+       None if p_expr does not contain any error expression.'''
+    if '|' not in expr: return compileExpr(expr), None
+    expr, errorExpr = expr.rsplit('|', 1)
+    return compileExpr(expr), compileExpr(errorExpr)
+
+def evalExprs(codes, context):
+    '''Evaluates, with p_context, p_codes as produced by m_compileExprs. If
+       the "normal" code raises an error, the "error" code is evaluated
+       instead.'''
+    code, errorCode = codes
+    if errorCode is None: return eval(code, context)
+    try:
+        return eval(code, context)
+    except Exception:
+        return eval(errorCode, context)
+
+def getLocation(line, column):
+    '''px-only: returns the text locating, in an error message, the expression
+       or statement found at this p_line and p_column within a PX. Returns an
+       empty string if the location is unknown.'''
+    if line is None: return ''
+    if column is None: return '(line %d)' % line
+    return '(line %d, column %d)' % (line, column)
+
 # ------------------------------------------------------------------------------
 class PodElement:
     OD_TO_POD = {'p': 'Text', 'h': 'Title', 'section': 'Section',
@@ -74,6 +114,9 @@ class Table(PodElement):
 class Expression(PodElement):
     '''Represents a Python expression that is found in a pod or px.'''
     OD = None
+    # pod-only: the key, in the context, where an Attributes instance stores
+    # the result of its tied expression (see Attributes.evaluate).
+    tiedKey = '_tied_'
     def extractInfo(self, py):
         '''Within p_py, several elements can be included:
            - the fact that XML chars must be escaped or not (leading ":")
@@ -96,56 +139,58 @@ class Expression(PodElement):
             errorExpr = errorExpr.strip()
         return escapeXml, expr, errorExpr
 
-    def __init__(self, py, pod):
+    def __init__(self, py, pod, codes=None, line=None, column=None):
         # Extract parts from expression p_py.
         self.escapeXml, self.expr, self.errorExpr = self.extractInfo(py.strip())
+        # Compile the expressions once: evaluations will only run the code. If
+        # already compiled, p_codes is the tuple (code, errorCode).
+        if codes:
+            self.code, self.errorCode = codes
+        else:
+            self.code = compileExpr(self.expr)
+            self.errorCode = None
+            if self.errorExpr: self.errorCode = compileExpr(self.errorExpr)
         self.pod = pod # True if I work for pod, False if I work for px.
-        if self.pod:
-            # pod-only: store here the expression's true result (before being
-            # converted to a string).
-            self.result = None
-            # pod-only: the following bool indicates if this Expression instance
-            # has already been evaluated or not. Expressions which are tied to
-            # attribute hooks are already evaluated when the tied hook is
-            # evaluated: this boolean prevents the expression from being
-            # evaluated twice.
-            self.evaluated = False
-            # self.result and self.evaluated are not used by PX, because they
-            # are not thread-safe.
+        # px-only: the line and column of the expression within the PX,
+        # captured at parse time.
+        self.line = line
+        self.column = column
 
     def _eval(self, context):
         '''Evaluates self.expr with p_context. If self.errorExpr is defined,
            evaluate it if self.expr raises an error.'''
-        if self.errorExpr:
+        if self.errorCode is not None:
             try:
-                res = eval(self.expr, context)
+                res = eval(self.code, context)
             except Exception:
-                res = eval(self.errorExpr, context)
+                res = eval(self.errorCode, context)
         else:
-            res = eval(self.expr, context)
+            res = eval(self.code, context)
         return res
 
-    def evaluate(self, context):
+    def evaluate(self, context, result=None):
         '''Evaluates the Python expression (self.expr) with a given
            p_context, and returns the result. More precisely, it returns a
            tuple (result, escapeXml). Boolean escapeXml indicates if XML chars
-           must be escaped or not.'''
-        escapeXml = self.escapeXml
-        # Evaluate the expression, or get it from self.result if it has already
-        # been computed.
-        if self.pod and self.evaluated:
-            res = self.result
-            # It can happen only once, to ask to evaluate an expression that
-            # was already evaluated (from the tied hook). We reset here the
-            # boolean "evaluated" to allow for the next evaluation, probably
-            # with another context.
-            self.evaluated = False
+           must be escaped or not. px-only: if the expression produces a PX
+           and a p_result buffer is given, the PX is directly rendered into
+           it.'''
+        # pod-only: expressions tied to attribute hooks are already evaluated
+        # when the tied hook is evaluated. The result is stored in the context,
+        # and not on this instance, that may be shared by several renderings.
+        tied = self.pod and context.get(self.tiedKey)
+        if tied and (tied[0] is self):
+            del context[self.tiedKey]
+            res = tied[1]
         else:
             res = self._eval(context)
-            # pod-only: cache the expression result.
-            if self.pod: self.result = res
-        # Converts the expr result to a string that can be inserted in the
-        # pod/px result.
+        return self.convert(res, context, result)
+
+    def convert(self, res, context, result=None):
+        '''Converts p_res, the result of evaluating this expression, to a
+           string that can be inserted in the pod/px result, and returns a
+           tuple (result, escapeXml), like m_evaluate.'''
+        escapeXml = self.escapeXml
         resultType = res.__class__.__name__
         if resultType == 'NoneType':
             res = u''
@@ -156,7 +201,11 @@ class Expression(PodElement):
         elif resultType == 'Px':
             # A PX that must be called within the current PX. Call it with the
             # current context.
-            res = res(context, applyTemplate=False)
+            if result is not None:
+                res.render(result, context, applyTemplate=False)
+                res = u''
+            else:
+                res = res(context, applyTemplate=False)
             # Force escapeXml to False.
             escapeXml = False
         else:
@@ -169,46 +218,53 @@ class Attributes(PodElement):
     OD = None
     floatTypes = ('int', 'long', 'float')
     dateTypes = ('DateTime',)
+    # The key, in the context, of a dict storing the attributes computed so
+    # far, during the current rendering, by every Attributes instance.
+    # Because such an instance may be shared by several renderings, its
+    # attributes are not stored on it.
+    attrsKey = '_attrs_'
 
     def __init__(self, env):
-        self.attrs = {}
         # Depending on the result of a tied expression, we will dump, for
         # another tag, the series of attrs that this instance represents.
         self.tiedExpression = None
         # We will need the env to get the full names of attributes to dump.
         self.env = env
 
-    def computeAttributes(self, expr):
-        '''p_expr has been evaluated: its result is in expr.result. Depending
-           on its type, we will dump the corresponding attributes in
-           self.attrs.'''
-        exprType = expr.result.__class__.__name__
+    def computeAttributes(self, value, attrs):
+        '''Updates dict p_attrs with the attributes corresponding to the type
+           of p_value, the result of the tied expression.'''
+        exprType = value.__class__.__name__
         tags = self.env.tags
-        attrs = self.attrs
         if exprType in self.floatTypes:
             attrs[tags['value-type']] = 'float'
-            attrs[tags['value']] = str(expr.result)
+            attrs[tags['value']] = str(value)
         elif exprType in self.dateTypes:
             attrs[tags['value-type']] = 'date'
-            attrs[tags['value']] = expr.result.strftime('%Y-%m-%d')
+            attrs[tags['value']] = value.strftime('%Y-%m-%d')
         else:
             attrs[tags['value-type']] = 'string'
 
     def evaluate(self, context):
         # Evaluate first the tied expression, in order to determine its type.
+        expr = self.tiedExpression
         try:
-            self.tiedExpression.evaluate(context)
-            self.tiedExpression.evaluated = True
+            value = expr._eval(context)
+            # The buffer will evaluate the expression right after this
+            # instance: give it the result (see Expression.evaluate).
+            context[Expression.tiedKey] = (expr, value)
         except Exception, e:
-            # Don't set "evaluated" to True. This way, when the buffer will
-            # evaluate the expression directly, we will really evaluate it, so
-            # the error will be dumped into the pod result.
-            pass
-        # Analyse the return type of the expression.
-        self.computeAttributes(self.tiedExpression)
-        # Now, self.attrs has been populated. Transform it into a string.
+            # When the buffer will evaluate the expression directly, we will
+            # really evaluate it, so the error will be dumped into the pod
+            # result.
+            value = None
+        # Analyse the return type of the expression and transform the
+        # corresponding attributes into a string.
+        if self.attrsKey not in context: context[self.attrsKey] = {}
+        attrs = context[self.attrsKey].setdefault(self, {})
+        self.computeAttributes(value, attrs)
         res = ''
-        for name, value in self.attrs.iteritems():
+        for name, value in attrs.iteritems():
             res += ' %s=%s' % (name, quoteattr(value))
         return res
 
@@ -217,14 +273,15 @@ class Attribute(PodElement):
        px-only.'''
     OD = None
 
-    def __init__(self, name, expr):
+    def __init__(self, name, expr, code=None):
         # The name of the attribute
         self.name = name
         # The expression that will compute the attribute value
         self.expr = expr.strip()
+        self.code = code or compileExpr(self.expr)
 
     def evaluate(self, context):
         # If the expr evaluates to False, we do not dump the attribute at all.
-        if eval(self.expr, context): return ' %s="%s"' % (self.name, self.name)
+        if eval(self.code, context): return ' %s="%s"' % (self.name, self.name)
         return ''
 # ------------------------------------------------------------------------------
@@ -175,14 +175,20 @@ class PodEnvironment(OdfEnvironment):
         self.currentBuffer = subBuffer
         self.mode = self.ADD_IN_BUFFER
 
-    def propagateNamespaces(self):
-        '''Propagates the namespaces in all XML element definitions that are
-           used throughout POD.'''
+    def propagateElements(self):
+        '''Propagates the namespaces in the XML element definitions of all POD
+           elements.'''
         ns = self.namespaces
         for elemName in PodElement.POD_ELEMS:
             xmlElemDef = eval(elemName[0].upper() + elemName[1:]).OD
             elemFullName = xmlElemDef.getFullName(ns)
             xmlElemDef.__init__(elemFullName)
+
+    def propagateNamespaces(self):
+        '''Propagates the namespaces in all XML element definitions that are
+           used throughout POD.'''
+        self.propagateElements()
+        ns = self.namespaces
         # Create a table of names of used tags and attributes (precomputed,
         # including namespace, for performance).
         table = ns[self.NS_TABLE]
@@ -225,7 +231,7 @@ class PodParser(OdfParser):
         env.raiseOnError = caller.raiseOnError
 
     def endDocument(self):
-        self.env.currentBuffer.content.close()
+        self.env.currentBuffer.close()
 
     def startElement(self, elem, attrs):
         e = OdfParser.startElement(self, elem, attrs)
@@ -333,8 +339,8 @@ class PodParser(OdfParser):
                                 if isinstance(parent, FileBuffer):
                                     # Execute buffer action and delete the
                                     # buffer.
-                                    e.currentBuffer.action.execute(parent,
-                                                                   e.context)
+                                    parent.evaluateBuffer(e.currentBuffer,
+                                                          e.context)
                                     parent.removeLastSubBuffer()
                                 e.currentBuffer = parent
                             e.mode = e.ADD_IN_SUBBUFFER
@@ -0,0 +1,158 @@
+# ------------------------------------------------------------------------------
+# This file is part of Appy, a framework for building applications in the Python
+# language. Copyright (C) 2007 Gaetan Delannay
+
+# Appy is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option) any later
+# version.
+
+# Appy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# Appy. If not, see <http://www.gnu.org/licenses/>.
+
+# ------------------------------------------------------------------------------
+import time
+
+# ------------------------------------------------------------------------------
+REPORT_HEADER = '%8s %10s %10s  %-5s %s' % ('calls', 'cumul (ms)', 'self (ms)',
+                                            'kind', 'location / source')
+
+# ------------------------------------------------------------------------------
+class Profiler:
+    '''Measures, while rendering PXs or POD templates, the time spent in every
+       expression and statement (for, if, var...). For each one, it counts the
+       calls, the cumulative time (including the time spent in the
+       expressions, statements and sub-PXs it contains) and the self time.
+
+       Profiling is opt-in. For rendering a PX with profiling, put a Profiler in
+       the context, at key Profiler.contextKey (ie, do it, for a given request,
+       in the context of the main PX: sub-PXs share it). For a POD template,
+       give a Profiler to the Renderer (parameter "profiler").
+
+       Every measured element is identified by a key (location, kind, source):
+       * location is "<path>:<line>" for a PX, the line being computed from
+         the line where the PX is defined and the line of the element within
+         the PX (captured at parse time), or the path of a POD template;
+       * kind is "px", "pod", "expr" or the name of a statement;
+       * source is the Python source of the expression or statement (empty
+         for a PX, and the name of the rendered part for a POD template).
+
+       A Profiler is not thread-safe: use one per rendering or request.'''
+    contextKey = '_profiler_'
+
+    def __init__(self):
+        # Stats about every measured element, keyed by the element's key. Every
+        # value is a list [i_calls, f_cumulative, f_self, i_active], "active"
+        # being the number of times the element is currently being measured
+        # (only the outermost call of a recursive element counts in its
+        # cumulative time).
+        self.entries = {}
+        # The stack of elements currently measured. Every frame is a list
+        # [key, f_start, f_childrenTime].
+        self.stack = []
+        # The stack of PXs or templates being rendered, as tuples
+        # (s_path, i_line), used for computing locations (see m_getKey).
+        self.sources = []
+        # The self time spent in every stack of elements, keyed by the
+        # "folded" representation of the stack (see m_dumpStacks).
+        self.stacks = {}
+
+    def enable(self, context):
+        '''Enables profiling of PX renderings with this p_context'''
+        context[self.contextKey] = self
+
+    @staticmethod
+    def getLocation(path, first, line):
+        '''Returns the location of an element found at this p_line within a PX
+           or template defined at p_path, starting at line p_first.'''
+        if (line is None) or (first is None): return path
+        return '%s:%d' % (path, first + line - 1)
+
+    def getKey(self, kind, source, line=None):
+        '''Gets the key of an element of this p_kind, whose Python p_source is
+           found at this p_line within the current PX or template.'''
+        if not self.sources: return ('?', kind, source)
+        path, first = self.sources[-1]
+        return (self.getLocation(path, first, line), kind, source)
+
+    def enter(self, key):
+        '''Starts measuring the element having this p_key'''
+        entry = self.entries.get(key)
+        if not entry: entry = self.entries[key] = [0, 0.0, 0.0, 0]
+        entry[0] += 1
+        entry[3] += 1
+        self.stack.append([key, time.time(), 0.0])
+
+    def leave(self):
+        '''Stops measuring the last entered element'''
+        key, start, children = self.stack.pop()
+        spent = time.time() - start
+        entry = self.entries[key]
+        entry[3] -= 1
+        if not entry[3]: entry[1] += spent
+        entry[2] += spent - children
+        if self.stack: self.stack[-1][2] += spent
+        # Update the self time of the current stack
+        folded = ';'.join([self.getLabel(frame[0]) for frame in self.stack] + \
+                          [self.getLabel(key)])
+        self.stacks[folded] = self.stacks.get(folded, 0.0) + spent - children
+
+    def enterTemplate(self, kind, path, line, part=''):
+        '''Starts measuring the rendering of a PX or POD template (p_kind being
+           "px" or "pod") defined in the file at p_path, starting at p_line
+           (None for a POD template). The template is identified by its own
+           location: several PXs defined in the same file or class are
+           measured separately. For a POD template, p_part is the name of the
+           rendered part (ie, "content.xml").'''
+        self.sources.append((path, line))
+        self.enter((self.getLocation(path, line, 1), kind, part))
+
+    def leaveTemplate(self):
+        self.leave()
+        self.sources.pop()
+
+    def getLabel(self, key):
+        '''Returns the label representing the element having this p_key in a
+           stack file (see m_dumpStacks).'''
+        location, kind, source = key
+        source = ' '.join(source.split())
+        if len(source) > 60: source = source[:57] + '...'
+        res = '%s %s' % (kind, location)
+        if source: res = '%s %s' % (res, source)
+        return res.replace(';', ',')
+
+    def getReport(self, sortBy='self', limit=50):
+        '''Returns a text report about the measured elements, sorted by
+           decreasing p_sortBy ("self", "cumulative" or "calls") and limited
+           to the p_limit first ones (all if p_limit is None).'''
+        index = {'calls': 0, 'cumulative': 1, 'self': 2}[sortBy]
+        entries = self.entries.items()
+        entries.sort(key=lambda entry: entry[1][index], reverse=True)
+        if limit is not None: entries = entries[:limit]
+        res = [REPORT_HEADER]
+        for key, entry in entries:
+            location, kind, source = key
+            res.append('%8d %10.2f %10.2f  %-5s %s' % (entry[0],
+                       entry[1] * 1000, entry[2] * 1000, kind, location))
+            source = ' '.join(source.split())
+            if source: res.append('%36s%s' % ('', source))
+        return '\n'.join(res)
+
+    def dumpStacks(self, path):
+        '''Dumps, in the file at p_path, the self time spent in every stack of
+           measured elements, in the "folded" format understood by
+           FlameGraph (flamegraph.pl) or speedscope: one line per stack,
+           made of the elements' labels separated by semicolons, followed by
+           the time in microseconds.'''
+        f = file(path, 'w')
+        try:
+            for folded, spent in sorted(self.stacks.iteritems()):
+                if isinstance(folded, unicode): folded = folded.encode('utf-8')
+                f.write('%s %d\n' % (folded, int(spent * 1000000)))
+        finally:
+            f.close()
+# ------------------------------------------------------------------------------
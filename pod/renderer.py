@@ -17,22 +17,28 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
 
 # ------------------------------------------------------------------------------
-import zipfile, shutil, xml.sax, os, os.path, re, mimetypes, time
+import zipfile, shutil, xml.sax, os, os.path, re, mimetypes, time, threading
+import tempfile, sys, cPickle, marshal, types
+from cStringIO import StringIO
 from UserDict import UserDict
 import appy.pod
 from appy.pod import PodError
 from appy.shared import mimeTypes, mimeTypesExts
 from appy.shared.xml_parser import XmlElement
-from appy.shared.zip import unzip, zip
-from appy.shared.utils import FolderDeleter, executeCommand, FileWrapper
+from appy.shared.cache import DiskCache, getKey
+from appy.shared.zip import unzip, zip, readZip, zipFiles
+from appy.shared.utils import FolderDeleter, executeCommand, FileWrapper, \
+     getOsTempFolder
 from appy.pod.pod_parser import PodParser, PodEnvironment, OdInsert
-from appy.pod.converter import FILE_TYPES
-from appy.pod.buffers import FileBuffer
+from appy.pod.converter import FILE_TYPES, getResultPath
+from appy.pod.buffers import FileBuffer, TemplateBuffer
 from appy.pod.xhtml2odt import Xhtml2OdtConverter
 from appy.pod.doc_importers import \
-     OdtImporter, ImageImporter, PdfImporter, ConvertImporter, PodImporter
-from appy.pod.styles_manager import \
-     StylesManager, TableProperties, NumberedProperties, BulletedProperties
+     OdtImporter, ImageImporter, PdfImporter, ConvertImporter, PodImporter, \
+     ImagePrefetcher
+from appy.pod.styles_manager import StylesManager, TableProperties, \
+     NumberedProperties, BulletedProperties, getMappingKey
+from appy.pod.profiler import Profiler
 
 # ------------------------------------------------------------------------------
 BAD_CONTEXT = 'Context must be either a dict, a UserDict or an instance.'
@@ -80,14 +86,178 @@ for name in ('content', 'styles'):
     POD_STYLES[name] = f.read()
     f.close()
 
+def getInserts(name):
+    '''Returns the OdInsert instances defining the pod-specific fonts and
+       styles to insert into content.xml or styles.xml (depending on p_name,
+       that is "content" or "styles").'''
+    nso = PodEnvironment.NS_OFFICE
+    styleTag = (name == 'content') and 'automatic-styles' or 'styles'
+    return (OdInsert(POD_FONTS, XmlElement('font-face-decls', nsUri=nso)),
+            OdInsert(POD_STYLES[name], XmlElement(styleTag, nsUri=nso)))
+
+# ------------------------------------------------------------------------------
+def getCodeId(obj):
+    '''Used as "persistent_id" by the pickler of PodTemplate.dumpBuffers:
+       the code objects of compiled POD expressions, that can't be pickled,
+       are stored as marshalled data (read back with marshal.loads, as
+       "persistent_load" of the unpickler of PodTemplate.loadBuffers).'''
+    if isinstance(obj, types.CodeType): return marshal.dumps(obj)
+
+# ------------------------------------------------------------------------------
+class PodTemplate:
+    '''A POD template (an ODT or ODS file) that is parsed only once and can
+       then be rendered any number of times. Give an instance of this class,
+       instead of the template file name, as parameter "template" of the
+       Renderer constructor.
+
+       Indeed, when rendering a template given as a file name, the Renderer
+       produces the result while parsing the template. Here, parsing the
+       template produces, for content.xml and styles.xml, a TemplateBuffer,
+       that records static content and buffers (with their actions), and is
+       then evaluated for every rendering.'''
+    # If a folder is specified here, the parsed templates are stored in it. At
+    # the next start, every template file will be loaded from it instead of
+    # being parsed again, until the file is modified.
+    cacheFolder = None
+
+    def __init__(self, template, raiseOnError=False):
+        # p_template is the path to the template file or a StringIO instance
+        self.template = template
+        # Errors encountered while rendering the template are dumped into the
+        # result, or raised if p_raiseOnError is True (see the Renderer). For
+        # an ODS template, errors are always raised.
+        self.raiseOnError = raiseOnError
+        # The last modification date and size of the template file
+        self.stamp = self.getStamp()
+        # The TemplateBuffer instances for content.xml and styles.xml. The
+        # template is parsed the first time it is rendered.
+        self.buffers = None
+        # The files contained in the template (see appy.shared.zip.readZip)
+        self.files = None
+        # The buffers are shared by all renderings of this template, that may
+        # run concurrently: this lock only prevents several threads from
+        # parsing the template at the same time.
+        self.lock = threading.Lock()
+
+    def getStamp(self):
+        '''Returns the last modification date and size of the template file,
+           or None if the template is not a file.'''
+        if not isinstance(self.template, basestring): return
+        info = os.stat(self.template)
+        return info.st_mtime, info.st_size
+
+    def isUpToDate(self):
+        '''Returns False if the template file has changed since this instance
+           was created.'''
+        try:
+            return self.getStamp() == self.stamp
+        except OSError:
+            return False
+
+    def parse(self):
+        '''Reads the template and parses content.xml and styles.xml'''
+        files = readZip(self.template)
+        info = dict(files)
+        if info.get('mimetype') == mimeTypes['ods']:
+            # See the comment about ODS errors in Renderer.__init__
+            self.raiseOnError = True
+        # Try first to get the buffers from the cache
+        buffers = None
+        if self.cacheFolder and self.stamp:
+            cache = DiskCache(self.cacheFolder, 'podc')
+            # Pickled code objects can only be read by the Python version that
+            # wrote them.
+            key = getKey(sys.version, os.path.abspath(self.template),
+                         repr(self.stamp), str(self.raiseOnError))
+            buffers = self.loadBuffers(cache, key)
+        if not buffers:
+            buffers = {}
+            for name in ('content', 'styles'):
+                env = PodEnvironment(None, getInserts(name))
+                env.currentBuffer = buffers[name] = TemplateBuffer(env)
+                PodParser(env, self).parse(info['%s.xml' % name])
+                # The parser is not needed anymore: release it, with its
+                # locator and handler state.
+                env.parser = None
+                env.currentElem = None
+            if self.cacheFolder and self.stamp:
+                self.dumpBuffers(cache, key, buffers)
+        self.files = files
+        self.buffers = buffers
+
+    def loadBuffers(self, cache, key):
+        '''Loads, from the p_cache, the buffers stored at this p_key. Returns
+           None if they are not in the cache or can't be loaded.'''
+        data = cache.get(key)
+        if data is None: return
+        unpickler = cPickle.Unpickler(StringIO(data))
+        unpickler.persistent_load = marshal.loads
+        try:
+            res = unpickler.load()
+        except Exception:
+            # Corrupted data: the template will be parsed again
+            return
+        # Parsing the template would have propagated its namespaces into the
+        # definitions of POD elements, that are used while rendering it.
+        res['content'].env.propagateElements()
+        return res
+
+    def dumpBuffers(self, cache, key, buffers):
+        '''Stores these parsed p_buffers in the p_cache, at this p_key.'''
+        f = StringIO()
+        pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = getCodeId
+        try:
+            pickler.dump(buffers)
+        except (cPickle.PicklingError, TypeError, ValueError):
+            return # Something is not serializable: the template is not cached
+        data = f.getvalue()
+        try:
+            cache.set(key, data)
+        except (IOError, OSError):
+            pass # The cache folder may be read-only
+
+    def ensureParsed(self):
+        '''Parses the template if it has not been done yet'''
+        if self.buffers is not None: return
+        self.lock.acquire()
+        try:
+            if self.buffers is None: self.parse()
+        finally:
+            self.lock.release()
+
+    def render(self, name, env):
+        '''Renders the part of the template named p_name ("content" or
+           "styles") into the FileBuffer of this p_env, with its context.'''
+        buffer = self.buffers[name]
+        # Namespaces are only known after parsing
+        env.namespaces = buffer.env.namespaces
+        env.tags = buffer.env.tags
+        env.gotNamespaces = True
+        result = env.currentBuffer
+        try:
+            buffer.render(result, env.context)
+        finally:
+            result.close()
+
 # ------------------------------------------------------------------------------
 class Renderer:
     templateTypes = ('odt', 'ods') # Types of POD templates
+    # The parts of the result (content.xml, styles.xml) are rendered in memory,
+    # excepted those whose size exceeds this number of bytes: they are spooled
+    # to disk.
+    maxPartSize = 10 * 1024 * 1024
+    # Content is written into these parts by blocks of (at least) this number
+    # of chars (see appy.pod.buffers.FileBuffer).
+    bufferSize = 65536
 
     def __init__(self, template, context, result, pythonWithUnoPath=None,
                  ooPort=2002, stylesMapping={}, forceOoCall=False,
                  finalizeFunction=None, overwriteExisting=False,
-                 raiseOnError=False, imageResolver=None, stylesTemplate=None):
+                 raiseOnError=False, imageResolver=None, stylesTemplate=None,
+                 converterService=None, conversionCache=None,
+                 imageCache=None, prefetchUrls=None, pdfProcesses=1,
+                 profiler=None):
         '''This Python Open Document Renderer (PodRenderer) loads a document
            template (p_template) which is an ODT or ODS file with some elements
            written in Python. Based on this template and some Python objects
@@ -109,6 +279,21 @@ class Renderer:
            call LibreOffice. In both cases, we will try to connect to
            LibreOffice in server mode on port p_ooPort.
 
+         - If a converter service runs (see appy.pod.converter.
+           ConverterService), specify its address in p_converterService (a
+           port on localhost or the path to a Unix socket): LibreOffice will be
+           called through it, and p_pythonWithUnoPath and p_ooPort will be
+           ignored.
+
+         - p_conversionCache can be an appy.shared.cache.ConversionCache
+           instance: LibreOffice will not be called again for converting a
+           document that was already converted.
+
+         - p_imageCache can be an appy.shared.cache.ImageCache instance: images
+           downloaded from URLs (if the server gives them an ETag) or
+           transformed (by p_convertOptions in m_importDocument, or from SVG to
+           PNG) will not be downloaded or transformed again.
+
          - If you plan to make "XHTML to OpenDocument" conversions, you may
            specify a styles mapping in p_stylesMapping.
 
@@ -130,11 +315,47 @@ class Renderer:
          - p_imageResolver allows POD to retrieve images, from "img" tags within
            XHTML content. Indeed, POD may not be able (ie, may not have the
            permission to) perform a HTTP GET on those images. Currently, the
-           resolver can only be a Zope application object.
+           resolver can only be a Zope application object. Images whose URL
+           starts with the resolver's URL are retrieved through it, without
+           trying to perform a HTTP GET at all.
+
+         - If you know the URLs of the images that will be imported into the
+           result, give them in p_prefetchUrls: they will be downloaded in
+           threads, while the template is rendered.
+
+         - PDF files imported into the result are converted into images by
+           Ghostscript (with p_imageCache, these images are cached). For large
+           PDFs, p_pdfProcesses Ghostscript processes may run in parallel,
+           each one converting a range of pages.
 
          - p_stylesTemplate can be the path to a LibreOffice file (ie, a .ott
            file) whose styles will be imported within the result.
+
+         - p_result can also be a file-like object, into which the result is
+           written, or None: in this case, m_run returns the result as a
+           string. The result is then of the same type as the template (odt or
+           ods).
+
+         - The result is built in memory: the template is not unzipped on disk
+           and temp files are only created when needed (ie, for importing
+           images or calling LibreOffice). If a p_finalizeFunction is given,
+           the result is built in a temp folder, as this function requires.
+
+         - p_template can also be a PodTemplate instance, in order to avoid
+           parsing the same template again and again. In this case,
+           p_raiseOnError is ignored: the PodTemplate defines it.
+
+         - If p_profiler is an appy.pod.profiler.Profiler instance, the time
+           spent in every expression and statement of the template is
+           measured into it.
         '''
+        # Is the template already parsed?
+        self.podTemplate = None
+        if isinstance(template, PodTemplate):
+            template.ensureParsed()
+            raiseOnError = template.raiseOnError
+            self.podTemplate = template
+            template = template.template
         self.template = template
         self.result = result
         self.contentXml = None # Content (string) of content.xml
@@ -145,24 +366,61 @@ class Renderer:
         self.env = None
         self.pyPath = pythonWithUnoPath
         self.ooPort = ooPort
+        self.converterService = converterService
+        self.conversionCache = conversionCache
+        self.imageCache = imageCache
+        self.pdfProcesses = pdfProcesses
+        self.profiler = profiler
         self.forceOoCall = forceOoCall
         self.finalizeFunction = finalizeFunction
         self.overwriteExisting = overwriteExisting
         self.raiseOnError = raiseOnError
         self.imageResolver = imageResolver
+        # Start downloading images from p_prefetchUrls. Site-local images will
+        # be retrieved via the image resolver.
+        self.prefetcher = None
+        if prefetchUrls:
+            urls = [url for url in prefetchUrls \
+                    if url.startswith('http') and not self.isSiteUrl(url)]
+            if urls: self.prefetcher = ImagePrefetcher(urls, imageCache)
         self.stylesTemplate = stylesTemplate
         # Remember potential files or images that will be included through
         # "do ... from document" statements: we will need to declare them in
         # META-INF/manifest.xml. Keys are file names as they appear within the
         # ODT file (to dump in manifest.xml); values are original paths of
-        # included images (used for avoiding to create multiple copies of a file
-        # which is imported several times).
+        # included images.
         self.fileNames = {}
+        # The images already imported, keyed by tuples (at, convertOptions) (see
+        # m_importDocument), used for avoiding to create multiple copies of an
+        # image which is imported several times. Values are tuples
+        # (importPath, format, image) (see appy.pod.doc_importers.
+        # ImageImporter).
+        self.images = {}
+        # If p_result is not a file name, the result is written into this
+        # file-like object. If p_result is None, m_run returns the result.
+        self.stream = None
+        self.returnResult = result is None
         self.prepareFolders()
-        # Unzip template
+        # The folder where the result is unzipped (see below) or where files
+        # to add to the result (ie, images) are stored.
         self.unzipFolder = os.path.join(self.tempFolder, 'unzip')
-        os.mkdir(self.unzipFolder)
-        info = unzip(template, self.unzipFolder, odf=True)
+        # The template files. If a finalize function is given, they are
+        # unzipped in self.unzipFolder, because this function works on the
+        # unzipped result. Else, they stay in memory, in self.files (see
+        # appy.shared.zip.readZip), and the result is zipped from memory.
+        self.files = None
+        # With self.files, the content of content.xml and styles.xml will be
+        # rendered in this dict ~{s_fileName: SpooledTemporaryFile}~.
+        self.parts = {}
+        if finalizeFunction:
+            os.mkdir(os.path.join(self.getTempFolder(), 'unzip'))
+            info = unzip(template, self.unzipFolder, odf=True)
+        else:
+            if self.podTemplate:
+                self.files = self.podTemplate.files
+            else:
+                self.files = readZip(template)
+            info = dict(self.files)
         self.contentXml = info['content.xml']
         self.stylesXml = info['styles.xml']
         self.stylesManager = StylesManager(self)
@@ -171,15 +429,14 @@ class Renderer:
         # anymore within paragraphs. ODS files generated with pod and containing
         # error messages in annotations cause LibreOffice 3.5 and 4.0 to crash.
         # LibreOffice >= 4.1 simply does not show the annotation.
-        if info['mimetype'] == mimeTypes['ods']: self.raiseOnError = True
-        # Create the parsers for content.xml and styles.xml
-        nso = PodEnvironment.NS_OFFICE
+        if info.get('mimetype') == mimeTypes['ods']: self.raiseOnError = True
+        # Create the parsers for content.xml and styles.xml. With a
+        # PodTemplate, they will not parse anything: they are only used for
+        # creating and holding the environments in which the parsed template
+        # will be rendered.
         for name in ('content', 'styles'):
-            styleTag = (name == 'content') and 'automatic-styles' or 'styles'
-            inserts = (
-              OdInsert(POD_FONTS, XmlElement('font-face-decls', nsUri=nso)),
-              OdInsert(POD_STYLES[name], XmlElement(styleTag, nsUri=nso)))
-            parser = self.createPodParser('%s.xml' % name, context, inserts)
+            parser = self.createPodParser('%s.xml' % name, context,
+                                          getInserts(name))
             setattr(self, '%sParser' % name, parser)
         # Store the styles mapping
         self.setStylesMapping(stylesMapping)
@@ -188,6 +445,9 @@ class Renderer:
         # of tables generated from XHTML tables via xhtml2odt.py), or in the
         # "styles" section of styles.xml (ie, bullet styles).
         self.dynamicStyles = {'content': [], 'styles': []}
+        # The keys of the cached XHTML chunks whose dynamic styles were already
+        # added to self.dynamicStyles (see appy.pod.xhtml2odt.XhtmlChunk).
+        self.xhtmlChunks = set()
 
     def createPodParser(self, odtFile, context, inserts=None):
         '''Creates the parser with its environment for parsing the given
@@ -209,8 +469,14 @@ class Renderer:
             evalContext.update(context)
         else:
             raise PodError(BAD_CONTEXT)
+        if self.profiler: evalContext[Profiler.contextKey] = self.profiler
         env = PodEnvironment(evalContext, inserts)
-        fileBuffer = FileBuffer(env, os.path.join(self.tempFolder,odtFile))
+        if self.files is None:
+            result = os.path.join(self.tempFolder, odtFile)
+        else:
+            result = self.parts[odtFile] = \
+                tempfile.SpooledTemporaryFile(self.maxPartSize)
+        fileBuffer = FileBuffer(env, result, self.bufferSize)
         env.currentBuffer = fileBuffer
         return PodParser(env, self)
 
@@ -218,6 +484,7 @@ class Renderer:
         '''Method that can be used (under the name 'xhtml') into a pod template
            for converting a chunk of XHTML content (p_xhtmlString) into a chunk
            of ODT content.'''
+        mappingKey = getMappingKey(stylesMapping)
         stylesMapping = self.stylesManager.checkStylesMapping(stylesMapping)
         # xhtmlString can only be a chunk of XHTML. So we must surround it with
         # a tag in order to get a XML-compliant file (we need a root tag). We
@@ -227,8 +494,15 @@ class Renderer:
         s = '<p>%s</p>' % s.replace('\f', '').replace('\v', '')
         # This also removes problematic chars "\x0c" and "\x0b" which simply are
         # alternative ways to write (respectively) "\f" and "\v".
+        # The same chunk of XHTML, converted with the same styles, produces
+        # the same chunk of ODT: get it from the cache if it is there.
+        key = Xhtml2OdtConverter.getKey(s, encoding, mappingKey, keepWithNext,
+                                        self)
+        if key:
+            chunk = Xhtml2OdtConverter.chunks.get(key)
+            if chunk: return chunk.replay(self)
         return Xhtml2OdtConverter(s, encoding, self.stylesManager,
-                                  stylesMapping, keepWithNext, self).run()
+                                  stylesMapping, keepWithNext, self, key).run()
 
     def evalIfExpression(self, condition, ifTrue, ifFalse):
         '''This method implements the method 'test' which is proposed in the
@@ -367,6 +641,18 @@ class Renderer:
     def insertColumnBreak(self): return self._insertBreak('column')
 
     def prepareFolders(self):
+        if not isinstance(self.result, basestring):
+            # The result will be written into a file-like object, or returned
+            # by m_run if p_result is None. Temp files, if any, will be created
+            # in the OS temp folder.
+            if self.result is None:
+                self.stream = StringIO()
+            else:
+                self.stream = self.result
+            self.result = None
+            self.tempFolder = '%s.%d.%f' % \
+                (os.path.join(getOsTempFolder(), 'pod'), id(self), time.time())
+            return
         # Check if I can write the result
         if not self.overwriteExisting and os.path.exists(self.result):
             raise PodError(RESULT_FILE_EXISTS % self.result)
@@ -380,54 +666,89 @@ class Renderer:
             raise PodError(CANT_WRITE_RESULT % (self.result, ie))
         self.result = os.path.abspath(self.result)
         os.remove(self.result)
-        # Create a temp folder for storing temporary files
+        # The temp folder for storing temporary files, created when needed
         absResult = os.path.abspath(self.result)
         self.tempFolder = '%s.%f' % (absResult, time.time())
-        try:
-            os.mkdir(self.tempFolder)
-        except OSError, oe:
-            raise PodError(CANT_WRITE_TEMP_FOLDER % (self.result, oe))
 
-    def patchManifest(self):
+    def isSiteUrl(self, url):
+        '''Is p_url the URL of an object from the site whose image resolver was
+           given to this renderer?'''
+        resolver = self.imageResolver
+        if not resolver or not hasattr(resolver, 'absolute_url'): return
+        return url.startswith('%s/' % resolver.absolute_url())
+
+    def getTempFolder(self):
+        '''Returns the path to the temp folder, that is created the first time
+           this method is called.'''
+        if not os.path.isdir(self.tempFolder):
+            try:
+                os.mkdir(self.tempFolder)
+            except OSError, oe:
+                raise PodError(CANT_WRITE_TEMP_FOLDER % (self.result, oe))
+        return self.tempFolder
+
+    def patchManifest(self, manifestContent=None):
         '''Declares, in META-INF/manifest.xml, images or files included via the
-           "do... from document" statements if any.'''
-        if self.fileNames:
-            j = os.path.join
-            toInsert = ''
-            for fileName in self.fileNames.iterkeys():
-                if fileName.endswith('.svg'):
-                    fileName = os.path.splitext(fileName)[0] + '.png'
-                mimeType = mimetypes.guess_type(fileName)[0]
-                toInsert += ' <manifest:file-entry manifest:media-type="%s" ' \
-                            'manifest:full-path="%s"/>\n' % (mimeType, fileName)
-            manifestName = j(self.unzipFolder, j('META-INF', 'manifest.xml'))
-            f = file(manifestName)
-            manifestContent = f.read()
-            hook = '</manifest:manifest>'
-            manifestContent = manifestContent.replace(hook, toInsert+hook)
-            f.close()
-            # Write the new manifest content
-            f = file(manifestName, 'w')
-            f.write(manifestContent)
-            f.close()
+           "do... from document" statements if any. If p_manifestContent is
+           given, the patched content is returned. Else, the manifest file from
+           self.unzipFolder is patched.'''
+        if not self.fileNames: return manifestContent
+        j = os.path.join
+        toInsert = ''
+        for fileName in self.fileNames.iterkeys():
+            if fileName.endswith('.svg'):
+                fileName = os.path.splitext(fileName)[0] + '.png'
+            mimeType = mimetypes.guess_type(fileName)[0]
+            toInsert += ' <manifest:file-entry manifest:media-type="%s" ' \
+                        'manifest:full-path="%s"/>\n' % (mimeType, fileName)
+        hook = '</manifest:manifest>'
+        if manifestContent is not None:
+            return manifestContent.replace(hook, toInsert+hook)
+        manifestName = j(self.unzipFolder, j('META-INF', 'manifest.xml'))
+        f = file(manifestName)
+        manifestContent = f.read()
+        manifestContent = manifestContent.replace(hook, toInsert+hook)
+        f.close()
+        # Write the new manifest content
+        f = file(manifestName, 'w')
+        f.write(manifestContent)
+        f.close()
 
     # Public interface
     def run(self):
-        '''Renders the result'''
+        '''Renders the result. If the Renderer was created with p_result being
+           None, the result is returned, as a string.'''
         try:
-            # Remember which parser is running
-            self.currentParser = self.contentParser
-            # Create the resulting content.xml
-            self.currentParser.parse(self.contentXml)
-            self.currentParser = self.stylesParser
-            # Create the resulting styles.xml
-            self.currentParser.parse(self.stylesXml)
-            # Patch META-INF/manifest.xml
-            self.patchManifest()
+            profiler = self.profiler
+            for name in ('content', 'styles'):
+                # Remember which parser is running
+                self.currentParser = getattr(self, '%sParser' % name)
+                # Create the resulting content.xml or styles.xml
+                if profiler:
+                    profiler.enterTemplate('pod', self.getTemplatePath(), None,
+                                           '%s.xml' % name)
+                try:
+                    if self.podTemplate:
+                        self.podTemplate.render(name, self.currentParser.env)
+                    else:
+                        self.currentParser.parse(getattr(self, '%sXml' %name))
+                finally:
+                    if profiler: profiler.leaveTemplate()
+            # Patch META-INF/manifest.xml (in memory, it is done while zipping)
+            if self.files is None: self.patchManifest()
             # Re-zip the result
             self.finalize()
         finally:
-            FolderDeleter.delete(self.tempFolder)
+            for part in self.parts.itervalues(): part.close()
+            if os.path.isdir(self.tempFolder):
+                FolderDeleter.delete(self.tempFolder)
+        if self.returnResult: return self.stream.getvalue()
+
+    def getTemplatePath(self):
+        '''Returns the path to the template, or a string representing it if it
+           is not a file.'''
+        if isinstance(self.template, basestring): return self.template
+        return '<template>'
 
     def getStyles(self):
         '''Returns a dict of the styles that are defined into the template.'''
@@ -438,19 +759,38 @@ class Renderer:
            XHTML tags that will be found inside XHTML content given to POD,
            and, on the other hand, ODT styles found into the template.'''
         try:
+            self.stylesMappingKey = getMappingKey(stylesMapping)
             stylesMapping = self.stylesManager.checkStylesMapping(stylesMapping)
             self.stylesManager.setStylesMapping(stylesMapping)
         except PodError, po:
-            self.contentParser.env.currentBuffer.content.close()
-            self.stylesParser.env.currentBuffer.content.close()
+            self.contentParser.env.currentBuffer.close()
+            self.stylesParser.env.currentBuffer.close()
             if os.path.exists(self.tempFolder):
                 FolderDeleter.delete(self.tempFolder)
             raise po
 
     def callLibreOffice(self, resultName, resultType):
+        '''Call LibreOffice in server mode to convert or update the result,
+           excepted if the conversion cache already contains the result.'''
+        if not self.conversionCache:
+            return self.runLibreOffice(resultName, resultType)
+        return self.conversionCache.convert(resultName,
+          getResultPath(resultName, resultType),
+          lambda: self.runLibreOffice(resultName, resultType),
+          resultType, self.stylesTemplate) or ''
+
+    def runLibreOffice(self, resultName, resultType):
         '''Call LibreOffice in server mode to convert or update the result.'''
         loOutput = ''
         try:
+            if self.converterService:
+                from appy.pod.converter import callService, ConverterError
+                try:
+                    callService(self.converterService, resultName, resultType,
+                                self.stylesTemplate)
+                except ConverterError, ce:
+                    raise PodError(CONVERT_ERROR % str(ce))
+                return loOutput
             if (not isinstance(self.ooPort, int)) and \
                (not isinstance(self.ooPort, long)):
                 raise PodError(BAD_OO_PORT % str(self.ooPort))
@@ -503,46 +843,127 @@ class Renderer:
                 res = 'odt' # We suppose this is ODT
         return res
 
+    def getDynamicStyles(self, name):
+        '''Returns the dynamic styles to inject into content.xml or styles.xml,
+           depending on p_name ("content" or "styles").'''
+        ds = self.dynamicStyles[name]
+        # For styles.xml, complete dynamic styles with default styles for
+        # bulleted and numbered lists.
+        if name == 'styles':
+            env = self.stylesParser.env
+            n = {'text': env.ns(env.NS_TEXT), 'style': env.ns(env.NS_STYLE)}
+            ds.insert(0, NumberedProperties().dumpStyle('podNumberedList', n))
+            ds.insert(0, BulletedProperties().dumpStyle('podBulletedList', n))
+        return ''.join(ds)
+
+    def zipResult(self, f):
+        '''Zips the result, from self.files, into p_f, a file name or a
+           file-like object.'''
+        files = []
+        info = dict(self.files)
+        if 'mimetype' not in info:
+            files.append(('mimetype', mimeTypes[self.getTemplateType()]))
+        for name, content in self.files:
+            if name in self.parts:
+                content = self.getPart(name)
+                # A part spooled to disk is added from self.unzipFolder
+                if content is None: continue
+            elif name == 'META-INF/manifest.xml':
+                content = self.patchManifest(content)
+            files.append((name, content))
+        # Files added while rendering (ie, images) are in self.unzipFolder
+        zipFiles(f, files, self.unzipFolder, odf=True)
+
+    def getPart(self, name):
+        '''Returns the content of the rendered part named p_name, with dynamic
+           styles injected into it. If this part was spooled to disk (see
+           m_createPodParser), it is not loaded in memory: it is copied into
+           self.unzipFolder and None is returned.'''
+        part = self.parts[name]
+        styles = self.getDynamicStyles(name[:-4])
+        tag = '<!DYNAMIC_STYLES!>'
+        if part.tell() <= self.maxPartSize:
+            part.seek(0)
+            return part.read().replace(tag, styles)
+        self.getTempFolder()
+        if not os.path.isdir(self.unzipFolder): os.makedirs(self.unzipFolder)
+        f = file(os.path.join(self.unzipFolder, name), 'wb')
+        try:
+            # Only the part's head, until the dynamic styles, is read in memory
+            part.seek(0)
+            head = ''
+            while True:
+                chunk = part.read(65536)
+                head += chunk
+                if not chunk or (tag in head): break
+            f.write(head.replace(tag, styles))
+            shutil.copyfileobj(part, f)
+        finally:
+            f.close()
+
+    def writeStream(self, fileName):
+        '''Writes the content of file p_fileName into self.stream'''
+        f = file(fileName, 'rb')
+        try:
+            shutil.copyfileobj(f, self.stream)
+        finally:
+            f.close()
+
     def finalize(self):
         '''Re-zip the result and potentially call LibreOffice if target format
            is not among self.templateTypes or if forceOoCall is True.'''
         j = os.path.join
-        for name in ('content', 'styles'):
-            # Copy the [content|styles].xml file from the temp to the zip folder
-            fn = '%s.xml' % name
-            shutil.copy(j(self.tempFolder, fn), j(self.unzipFolder, fn))
-            # For styles.xml, complete dynamic styles with default styles for
-            # bulleted and numbered lists.
-            ds = self.dynamicStyles[name]
-            if name == 'styles':
-                env = self.stylesParser.env
-                n = {'text': env.ns(env.NS_TEXT), 'style': env.ns(env.NS_STYLE)}
-                ds.insert(0,NumberedProperties().dumpStyle('podNumberedList',n))
-                ds.insert(0,BulletedProperties().dumpStyle('podBulletedList',n))
-            # Get the file content and inject dynamic styles into it
-            fn = os.path.join(self.unzipFolder, fn)
-            f = file(fn)
-            content = f.read().replace('<!DYNAMIC_STYLES!>', ''.join(ds))
-            f.close()
-            # Write the updated content to the file
-            f = file(fn, 'w')
-            f.write(content)
-            f.close()
-        # Call the user-defined "finalize" function when present
-        if self.finalizeFunction:
+        resultExt = self.getTemplateType()
+        if self.result:
+            resultType = os.path.splitext(self.result)[1].strip('.')
+        else:
+            resultType = resultExt
+        mustConvert = (resultType not in self.templateTypes) or \
+                      self.forceOoCall
+        if self.files is not None:
+            # Zip the result from memory, directly into the result, excepted if
+            # LibreOffice must be called.
+            if not mustConvert:
+                if self.stream is None:
+                    self.zipResult(self.result)
+                elif hasattr(self.stream, 'seek'):
+                    self.zipResult(self.stream)
+                else:
+                    # zipfile can't write a zip into a non-seekable stream
+                    zipped = StringIO()
+                    self.zipResult(zipped)
+                    self.stream.write(zipped.getvalue())
+                return
+            resultName = j(self.getTempFolder(), 'result.%s' % resultExt)
+            self.zipResult(resultName)
+        else:
+            for name in ('content', 'styles'):
+                # Copy the [content|styles].xml file from the temp to the zip
+                # folder.
+                fn = '%s.xml' % name
+                shutil.copy(j(self.tempFolder, fn), j(self.unzipFolder, fn))
+                # Get the file content and inject dynamic styles into it
+                fn = os.path.join(self.unzipFolder, fn)
+                f = file(fn)
+                content = f.read().replace('<!DYNAMIC_STYLES!>',
+                                           self.getDynamicStyles(name))
+                f.close()
+                # Write the updated content to the file
+                f = file(fn, 'w')
+                f.write(content)
+                f.close()
+            # Call the user-defined "finalize" function
             try:
                 self.finalizeFunction(self.unzipFolder)
             except Exception, e:
                 print(WARNING_FINALIZE_ERROR % str(e))
-        # Re-zip the result, first as an OpenDocument file of the same type as
-        # the POD template (odt, ods...)
-        resultExt = self.getTemplateType()
-        resultName = os.path.join(self.tempFolder, 'result.%s' % resultExt)
-        zip(resultName, self.unzipFolder, odf=True)
-        resultType = os.path.splitext(self.result)[1].strip('.')
-        if (resultType in self.templateTypes) and not self.forceOoCall:
+            # Re-zip the result, first as an OpenDocument file of the same type
+            # as the POD template (odt, ods...)
+            resultName = os.path.join(self.tempFolder, 'result.%s' % resultExt)
+            zip(resultName, self.unzipFolder, odf=True)
+        if not mustConvert:
             # Simply move the ODT result to the result
-            os.rename(resultName, self.result)
+            finalResultName = resultName
         else:
             if resultType not in FILE_TYPES:
                 raise PodError(BAD_RESULT_TYPE % (
@@ -563,5 +984,8 @@ class Renderer:
                 finalResultName = '%s.%s' % (resPrefix, resultType)
             if not os.path.exists(finalResultName):
                 raise PodError(CONVERT_ERROR % output)
+        if self.stream is None:
             os.rename(finalResultName, self.result)
+        else:
+            self.writeStream(finalResultName)
 # ------------------------------------------------------------------------------
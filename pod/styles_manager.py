@@ -25,6 +25,7 @@ from appy.pod.odf_parser import OdfEnvironment, OdfParser
 from appy.pod.doc_importers import px2cm as px2cmRatio
 from appy.shared.css import parseStyleAttribute, CssStyles, CssValue
 from appy.shared.utils import getElementAt, formatNumber
+from appy.shared.cache import LruCache, getKey
 
 # Possible states for the parser
 READING = 0 # Default state
@@ -507,13 +508,23 @@ class StylesGenerator:
         # The names of the styles that were already generated, keyed by some
         # hash value
         self.generated = {}
+        # The definitions of the generated styles, as tuples (hash, target,
+        # definition), keyed by style name.
+        self.definitions = {}
+        # While converting a chunk of XHTML that will be cached (see
+        # appy.pod.xhtml2odt.XhtmlChunk), the names of the styles used by this
+        # chunk are collected in this dict, whose values are style hashes.
+        self.used = None
         self.stylesManager = stylesManager
 
-    def addStyle(self, style, target):
-        '''Adds the style definition to the renderer's dynamic styles.
-           Target is "styles" (styles.xml) or "content" (content.xml).'''
-        dynamicStyles = self.stylesManager.renderer.dynamicStyles[target]
-        dynamicStyles.append(style.encode('utf-8'))
+    def addStyle(self, name, style, target):
+        '''Adds the definition of style named p_name to the renderer's dynamic
+           styles. Target is "styles" (styles.xml) or "content"
+           (content.xml).'''
+        if isinstance(style, unicode): style = style.encode('utf-8')
+        hash = self.definitions[name][0]
+        self.definitions[name] = (hash, target, style)
+        self.stylesManager.renderer.dynamicStyles[target].append(style)
 
     def getStyleHash(self, xhtmlElem, odfAttrs):
         '''Returns a string uniquely representing the given set of ODF
@@ -538,14 +549,22 @@ class StylesGenerator:
             - "styleName" is the style name.'''
         # If the style hash corresponds to an existing style, simply return
         # its name
-        hash = self.getStyleHash(xhtmlElem, odfAttrs)
+        return self.getStyleNameFromHash(self.getStyleHash(xhtmlElem,odfAttrs))
+
+    def getStyleNameFromHash(self, hash):
+        '''Like m_getStyleName, but from the style p_hash'''
         if hash in self.generated:
-            return False, self.generated[hash]
-        # We must generate a new style
-        self.last += 1
-        res = '%s%d' % (self.prefix, self.last)
-        self.generated[hash] = res
-        return True, res
+            res = self.generated[hash]
+            createNew = False
+        else:
+            # We must generate a new style
+            self.last += 1
+            res = '%s%d' % (self.prefix, self.last)
+            self.generated[hash] = res
+            self.definitions[res] = (hash, None, None)
+            createNew = True
+        if self.used is not None: self.used[res] = hash
+        return createNew, res
 
     def flattenOdfAttributes(self, odfAttrs, forHash=False):
         '''Produce a string from the list of (name, value) pairs in
@@ -601,7 +620,7 @@ class StylesGenerator:
         # I could have added this style in content.xml. But in some cases it
         # does not work properly. For example, a percentage value for attribute
         # "fo-font-size" will be ignored if the style is dumped in content.xml.
-        self.addStyle(style, 'styles')
+        self.addStyle(styleName, style, 'styles')
         return styleName
     get_div = get_span = get_p
 
@@ -636,7 +655,7 @@ class StylesGenerator:
               (styleName, self.styleFamilies[xhtmlElem.elem],
                baseStyle.getOdfParentAttributes(names),
                ' '.join(self.flattenOdfAttributes(cellAttrs)))
-            self.addStyle(style, 'content')
+            self.addStyle(styleName, style, 'content')
             return styleName
     get_th = get_td
 
@@ -672,10 +691,37 @@ class StylesGenerator:
         if not styleName: return baseStyle
         return Style(styleName, self.styleFamilies[elem])
 
+# ------------------------------------------------------------------------------
+def getMappingKey(stylesMapping):
+    '''Returns a string representing p_stylesMapping, to be used as a key in
+       StylesManager.mappings, or None if p_stylesMapping can't be represented
+       that way (it will then be checked, and found wrong, by
+       StylesManager.checkStylesMapping).'''
+    try:
+        res = []
+        for name, value in stylesMapping.iteritems():
+            if not isinstance(value, basestring) and \
+               not isinstance(value, int):
+                # A [x]Properties instance
+                value = (value.__class__.__name__,
+                         sorted(value.__dict__.items()))
+            res.append((name, value))
+        res.sort()
+        return repr(res)
+    except Exception:
+        return
+
 # ------------------------------------------------------------------------------
 class StylesManager:
     '''Reads the paragraph styles from styles.xml within an ODT file, and
        updates styles.xml with some predefined POD styles.'''
+    # Parsing styles.xml and checking styles mappings is done once per
+    # process: for every styles.xml (keyed by its digest), the parsed styles
+    # are cached in "models", as tuples (styles, pageLayout). Checked styles
+    # mappings are cached in "mappings", keyed by the styles.xml digest and
+    # the styles mapping itself (see m_getMappingKey).
+    models = LruCache(100)
+    mappings = LruCache(1000)
     podSpecificStyles = {
       'ParaKWN': Style('ParaKWN', 'paragraph'),
       # This style is common to bullet and number items. Behind the scenes,
@@ -696,9 +742,14 @@ class StylesManager:
         self.pageLayout = None
         # Global styles mapping
         self.stylesMapping = None
-        self.stylesParser = StylesParser(StylesEnvironment(), self)
-        self.stylesParser.parse(self.stylesString)
-        # Now self.styles contains the styles.
+        self.stylesKey = getKey(self.stylesString)
+        model = self.models.get(self.stylesKey)
+        if model:
+            self.styles, self.pageLayout = model
+        else:
+            StylesParser(StylesEnvironment(), self).parse(self.stylesString)
+            # Now self.styles contains the styles
+            self.models.set(self.stylesKey, (self.styles, self.pageLayout))
         # Text styles from self.styles
         self.textStyles = self.styles.getStyles('text')
         # Paragraph styles from self.styles
@@ -769,7 +820,21 @@ class StylesManager:
                   form (cssAttribute, cssValue).
              (iii) an integer value (=(b));
              (iv) a [x]Properties instance if cases (5) or (6).
+
+           The result is cached in StylesManager.mappings: it must not be
+           modified.
         '''
+        key = getMappingKey(stylesMapping)
+        if key is not None:
+            key = (self.stylesKey, key)
+            res = self.mappings.get(key)
+            if res is not None: return res
+        res = self.getCheckedMapping(stylesMapping)
+        if key is not None: self.mappings.set(key, res)
+        return res
+
+    def getCheckedMapping(self, stylesMapping):
+        '''Performs the job of m_checkStylesMapping, without caching'''
         res = {}
         if not isinstance(stylesMapping, dict) and \
            not isinstance(stylesMapping, UserDict):
@@ -836,6 +901,7 @@ class StylesManager:
            entries are in it'''
         # The predefined styles below are currently ignored, because the
         # xhtml2odt parser does not take into account span tags.
+        stylesMapping = stylesMapping.copy()
         if 'span[font-weight=bold]' not in stylesMapping:
             stylesMapping['span[font-weight=bold]'] = 'podBold'
         if 'span[font-style=italic]' not in stylesMapping:
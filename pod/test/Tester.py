@@ -23,7 +23,7 @@ from appy.shared.test import Test as BaseTest
 from appy.shared.utils import FolderDeleter
 from appy.shared.xml_parser import escapeXml
 from appy.pod.odf_parser import OdfEnvironment, OdfParser
-from appy.pod.renderer import Renderer
+from appy.pod.renderer import Renderer, PodTemplate
 from appy.pod.styles_manager import \
      TableProperties, BulletedProperties, NumberedProperties
 
@@ -92,6 +92,10 @@ class Test(BaseTest):
     # 'text:style-name's can contained generated names base on time.time
     ignoreAttrs = ('draw:name', 'text:name', 'text:bullet-char',
                    'table:name', 'table:style-name', 'text:style-name')
+    # If not None (see option "-r" of the PodTester), every template is parsed
+    # once into a PodTemplate, stored in this dict, and shared by all the tests
+    # using it. Every test then renders it twice.
+    podTemplates = None
 
     def __init__(self, testData, testDescription, testFolder, config, flavour):
         BaseTest.__init__(self, testData, testDescription, testFolder, config,
@@ -115,6 +119,13 @@ class Test(BaseTest):
                 exec 'res[elem] = %s.%s' % (contextPkg, elem)
         return res
 
+    def getPodTemplate(self, template):
+        '''Gets the PodTemplate shared by all tests using p_template'''
+        res = self.podTemplates.get(template)
+        if not res:
+            res = self.podTemplates[template] = PodTemplate(template)
+        return res
+
     def do(self):
         tempFileName = '%s.%s' % (self.data['Name'], self.data['Result'])
         self.result = sjoin(self.tempFolder, tempFileName)
@@ -136,6 +147,15 @@ class Test(BaseTest):
         # Get the styles mapping. Dicts are not yet managed by the TablesParser
         stylesMapping = eval('{' + self.data['StylesMapping'] + '}')
         # Call the renderer
+        if self.podTemplates is not None:
+            template = self.getPodTemplate(template)
+            # Render the template a first time, into a result that is dropped:
+            # the result being checked must not depend on previous renderings.
+            first = sjoin(self.tempFolder, '%s.first.%s' % \
+                          (self.data['Name'], self.data['Result']))
+            Renderer(template, dict(context), first, ooPort=ooPort,
+                     pythonWithUnoPath=pythonWithUno,
+                     stylesMapping=stylesMapping).run()
         Renderer(template, context, self.result, ooPort=ooPort,
                  pythonWithUnoPath=pythonWithUno,
                  stylesMapping=stylesMapping).run()
@@ -220,6 +240,12 @@ class PodTestFactory(TestFactory):
 class PodTester(Tester):
     def __init__(self, testPlan):
         Tester.__init__(self, testPlan, [], PodTestFactory)
+        if self.options.reuse: Test.podTemplates = {}
+
+    def addOptions(self, optParser):
+        optParser.add_option('-r', '--reuse', action='store_true', help= \
+          'Render every template twice, through a PodTemplate shared by all '\
+          'the tests using it.')
 
 # ------------------------------------------------------------------------------
 if __name__ == '__main__': PodTester('Tests.odt').run()
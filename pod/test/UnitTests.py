@@ -0,0 +1,1173 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+'''Unit tests for the parts of pod and px that Tester.py does not check by
+   comparing results with expected ones: caches, reusable templates,
+   compiled PXs... Run them with "python UnitTests.py", from this folder.'''
+
+import os, os.path, re, sys, shutil, tempfile, threading, unittest, zipfile
+import subprocess, functools, socket, json, imghdr, BaseHTTPServer
+import appy.px
+from appy.px import Px
+from appy.pod.renderer import Renderer, PodTemplate
+from appy.pod.batch import BatchRenderer
+from appy.pod import converter
+from appy.pod.xhtml2odt import Xhtml2OdtConverter, SimpleConverter, \
+     XhtmlParser, XhtmlEnvironment
+from appy.pod import PodError
+from appy.pod.styles_manager import StylesManager
+from appy.shared.cache import DiskCache, LruCache, ConversionCache, \
+     ImageCache, getKey, getFileDigest
+
+# ------------------------------------------------------------------------------
+testFolder = os.path.dirname(os.path.abspath(__file__))
+
+def getTemplate(name):
+    '''Returns the path to the test template named p_name'''
+    if not name.endswith('.ods'): name = '%s.odt' % name
+    return os.path.join(testFolder, 'templates', name)
+
+def getContext(name):
+    '''Returns, as a dict, the test context named p_name (see Tester.py)'''
+    module = __import__('appy.pod.test.contexts.%s' % name, {}, {}, ['*'])
+    res = {}
+    for key, value in module.__dict__.iteritems():
+        if not key.startswith('__'): res[key] = value
+    return res
+
+# Dates of annotations differ from one rendering to the other
+rexDate = re.compile('<dc:date>.*?</dc:date>')
+
+def getPart(path, name='content.xml'):
+    '''Returns the content of part p_name from the ODF file at p_path'''
+    f = zipfile.ZipFile(path)
+    try:
+        return rexDate.sub('', f.read(name))
+    finally:
+        f.close()
+
+# ------------------------------------------------------------------------------
+class RenderingTest(unittest.TestCase):
+    '''Base class for tests rendering POD templates into a temp folder'''
+
+    def setUp(self):
+        self.tempFolder = tempfile.mkdtemp()
+        self.results = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tempFolder, True)
+
+    def render(self, template, context, extension='odt', **params):
+        '''Renders p_template with p_context and returns the path to the
+           result.'''
+        self.results += 1
+        result = os.path.join(self.tempFolder, 'result%d.%s' % \
+                              (self.results, extension))
+        Renderer(template, context, result, **params).run()
+        return result
+
+    def assertSameResults(self, result, expected):
+        for name in ('content.xml', 'styles.xml'):
+            self.assertEqual(getPart(result, name), getPart(expected, name))
+
+# ------------------------------------------------------------------------------
+class PodTemplateTests(RenderingTest):
+    '''Tests appy.pod.renderer.PodTemplate'''
+    # Tuples (template, context, extension)
+    cases = (('SimpleTest', 'SimpleTest', 'odt'),
+             ('ForCell', 'PersonsThree', 'odt'),
+             ('ForTableMinus', 'PersonsEight', 'odt'),
+             ('IfAndFors1', 'IfAndFors1', 'odt'),
+             ('XhtmlNominal', 'XhtmlNominal', 'odt'),
+             ('OdsSimple.ods', 'OdsSimple', 'ods'))
+
+    def testRenderings(self):
+        '''A PodTemplate produces, at every rendering, the same result as the
+           template file.'''
+        for template, context, extension in self.cases:
+            path = getTemplate(template)
+            expected = self.render(path, getContext(context), extension)
+            podTemplate = PodTemplate(path)
+            for i in range(2):
+                result = self.render(podTemplate, getContext(context),
+                                     extension)
+                self.assertSameResults(result, expected)
+
+    def testConcurrentRenderings(self):
+        '''Several threads may render the same PodTemplate at once'''
+        path = getTemplate('XhtmlNominal')
+        expected = self.render(path, getContext('XhtmlNominal'))
+        podTemplate = PodTemplate(path)
+        errors = []
+        def render(i):
+            try:
+                for j in range(3):
+                    result = os.path.join(self.tempFolder,
+                                          'thread%d.%d.odt' % (i, j))
+                    Renderer(podTemplate, getContext('XhtmlNominal'),
+                             result).run()
+                    self.assertSameResults(result, expected)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=render, args=(i,)) \
+                   for i in range(4)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(errors, [])
+
+    def testUpToDate(self):
+        '''A PodTemplate knows when its template file has changed'''
+        path = os.path.join(self.tempFolder, 'template.odt')
+        shutil.copy(getTemplate('SimpleTest'), path)
+        podTemplate = PodTemplate(path)
+        self.assertTrue(podTemplate.isUpToDate())
+        mtime = os.stat(path).st_mtime
+        os.utime(path, (mtime + 10, mtime + 10))
+        self.assertFalse(podTemplate.isUpToDate())
+        os.remove(path)
+        self.assertFalse(podTemplate.isUpToDate())
+
+# ------------------------------------------------------------------------------
+class DiskCacheTests(RenderingTest):
+    '''Tests appy.shared.cache.DiskCache and the on-disk caches of parsed PXs
+       and POD templates.'''
+
+    def testDiskCache(self):
+        cache = DiskCache(os.path.join(self.tempFolder, 'cache'), 'bin')
+        key = getKey('a', u'b\xe9')
+        self.assertNotEqual(key, getKey('ab', u'\xe9'))
+        self.assertEqual(cache.get(key), None)
+        cache.set(key, 'data')
+        self.assertEqual(cache.get(key), 'data')
+        cache.set(key, 'other data')
+        self.assertEqual(cache.get(key), 'other data')
+        # No temp file is left in the cache folder
+        self.assertEqual(os.listdir(cache.folder), ['%s.bin' % key])
+        cache.delete(key)
+        self.assertEqual(cache.get(key), None)
+        cache.delete(key)
+
+    def parsePx(self, content):
+        '''Parses a PX with this p_content and returns it, with the number of
+           times the PX parser was used.'''
+        base = appy.px.PxParser
+        class Parser(base):
+            uses = 0
+            def parse(self, *args):
+                Parser.uses += 1
+                return base.parse(self, *args)
+        appy.px.PxParser = Parser
+        try:
+            px = Px(content)
+            px.ensureParsed()
+        finally:
+            appy.px.PxParser = base
+        return px, Parser.uses
+
+    def testPxCache(self):
+        '''A parsed PX is stored in the cache and loaded from it'''
+        content = '<x var="v=1"><p for="i in items" class=":i">:i + v</p>' \
+                  '<b if="not items">Empty</b></x>'
+        context = {'items': range(3)}
+        expected = Px(content)(dict(context))
+        empty = Px(content)({'items': []})
+        Px.cacheFolder = os.path.join(self.tempFolder, 'pxcache')
+        try:
+            px, uses = self.parsePx(content)
+            self.assertEqual(uses, 1)
+            self.assertEqual(px(dict(context)), expected)
+            files = os.listdir(Px.cacheFolder)
+            self.assertEqual(len(files), 1)
+            px, uses = self.parsePx(content)
+            self.assertEqual(uses, 0)
+            self.assertEqual(px(dict(context)), expected)
+            self.assertEqual(px({'items': []}), empty)
+            # Corrupted data is ignored
+            f = file(os.path.join(Px.cacheFolder, files[0]), 'wb')
+            f.write('corrupted')
+            f.close()
+            px, uses = self.parsePx(content)
+            self.assertEqual(uses, 1)
+            self.assertEqual(px(dict(context)), expected)
+        finally:
+            Px.cacheFolder = None
+
+    # Renders, in another process, a template from the cache, and dumps its
+    # content.xml.
+    renderScript = '''import sys
+from appy.pod.renderer import Renderer, PodTemplate
+from appy.pod.test.UnitTests import getContext, getPart
+PodTemplate.cacheFolder = sys.argv[1]
+template = PodTemplate(sys.argv[2])
+# The template must be loaded from the cache, not parsed and dumped into it
+template.dumpBuffers = lambda cache, key, buffers: sys.exit(3)
+Renderer(template, getContext(sys.argv[3]), sys.argv[4]).run()
+sys.stdout.write(getPart(sys.argv[4]))'''
+
+    def testPodTemplateCache(self):
+        '''A parsed POD template is stored in the cache and loaded from it, in
+           this process or in another one.'''
+        folder = os.path.join(self.tempFolder, 'podcache')
+        path = os.path.join(self.tempFolder, 'ForCell.odt')
+        shutil.copy(getTemplate('ForCell'), path)
+        expected = self.render(path, getContext('PersonsThree'))
+        PodTemplate.cacheFolder = folder
+        try:
+            result = self.render(PodTemplate(path), getContext('PersonsThree'))
+            self.assertSameResults(result, expected)
+            self.assertEqual(len(os.listdir(folder)), 1)
+            template = PodTemplate(path)
+            template.dumpBuffers = lambda cache, key, buffers: \
+                                   self.fail('Not loaded from the cache')
+            result = self.render(template, getContext('PersonsThree'))
+            self.assertSameResults(result, expected)
+            # Load it from another process, that does not parse any template
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(sys.path)
+            result = os.path.join(self.tempFolder, 'other.odt')
+            process = subprocess.Popen([sys.executable, '-c',
+                self.renderScript, folder, path, 'PersonsThree', result],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+            out, err = process.communicate()
+            self.assertEqual(process.returncode, 0, err)
+            self.assertEqual(out, getPart(expected))
+            # Once the template file is modified, the cache is not used anymore
+            mtime = os.stat(path).st_mtime
+            os.utime(path, (mtime + 10, mtime + 10))
+            result = self.render(PodTemplate(path), getContext('PersonsThree'))
+            self.assertSameResults(result, expected)
+            self.assertEqual(len(os.listdir(folder)), 2)
+        finally:
+            PodTemplate.cacheFolder = None
+
+    def testCodePickling(self):
+        '''The POD templates cache does not make code objects picklable for the
+           whole process (ie, for the ZODB).'''
+        import cPickle, pickle
+        code = compile('1 + 1', '<expression>', 'eval')
+        for module in (cPickle, pickle):
+            self.assertRaises((TypeError, module.PicklingError), module.dumps,
+                              code, module.HIGHEST_PROTOCOL)
+
+# ------------------------------------------------------------------------------
+class StylesCacheTests(RenderingTest):
+    '''Tests appy.shared.cache.LruCache and the caches of parsed styles and
+       checked styles mappings (see appy.pod.styles_manager.StylesManager).'''
+
+    def testLruCache(self):
+        cache = LruCache(3)
+        self.assertEqual(cache.get('a'), None)
+        for key in 'abc': cache.set(key, key.upper())
+        self.assertEqual(cache.get('a'), 'A')
+        # "b" is now the least recently used entry
+        cache.set('d', 'D')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 'C')
+        # Replacing an entry does not make the cache grow
+        cache.set('d', 'DD')
+        self.assertEqual(cache.get('d'), 'DD')
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.getStats(), {'hits': 4, 'misses': 2,
+                         'hitRatio': 4 / 6.0, 'entries': 3})
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.getStats()['entries'], 0)
+
+    def testStylesCache(self):
+        '''Styles are parsed, and a styles mapping is checked, once for all
+           renderings of the same template.'''
+        template = getTemplate('XhtmlStyles')
+        mapping = {'h*': -1}
+        StylesManager.models.clear()
+        StylesManager.mappings.clear()
+        results = []
+        for i in range(2):
+            misses = StylesManager.models.misses, StylesManager.mappings.misses
+            results.append(self.render(template,
+                           getContext('XhtmlStylesMapping'),
+                           stylesMapping=mapping))
+            # At the second rendering, everything comes from the caches. The
+            # mappings include the local ones, given to xhtml().
+            self.assertEqual(StylesManager.models.misses - misses[0], 1 - i)
+            self.assertEqual(StylesManager.mappings.misses > misses[1], not i)
+        self.assertSameResults(results[1], results[0])
+        # The cached styles mapping was not modified by the renderer
+        for checked in StylesManager.mappings.entries.itervalues():
+            self.assertFalse('span[font-weight=bold]' in checked)
+        self.assertEqual(mapping, {'h*': -1})
+
+    def testWrongMappings(self):
+        '''A wrong styles mapping is never cached: it is refused at every
+           rendering.'''
+        template = getTemplate('XhtmlStyles')
+        for mapping in ('Hello', {'h*': 'Title 1'}, {'unknown': 'Title 1'}):
+            for i in range(2):
+                self.assertRaises(PodError, self.render, template,
+                                  getContext('XhtmlStylesMapping'),
+                                  stylesMapping=mapping)
+
+# ------------------------------------------------------------------------------
+class ConversionCacheTests(unittest.TestCase):
+    '''Tests appy.shared.cache.ConversionCache and its base class
+       BoundedDiskCache, with a fake conversion function.'''
+
+    def setUp(self):
+        self.tempFolder = tempfile.mkdtemp()
+        self.cacheFolder = os.path.join(self.tempFolder, 'cache')
+        # The number of conversions performed by m_getConverter's functions
+        self.conversions = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tempFolder, True)
+
+    def getPath(self, name, content=None):
+        '''Returns the path to file p_name in the temp folder, after having
+           written p_content into it if given.'''
+        res = os.path.join(self.tempFolder, name)
+        if content is not None:
+            f = file(res, 'wb')
+            f.write(content)
+            f.close()
+        return res
+
+    def getZip(self, name, content, date):
+        '''Creates, in the temp folder, a zip file named p_name, containing
+           one entry with this p_content and p_date.'''
+        res = self.getPath(name)
+        f = zipfile.ZipFile(res, 'w')
+        f.writestr(zipfile.ZipInfo('content.xml', date), content)
+        f.close()
+        return res
+
+    def getConverter(self, docPath, resultPath):
+        '''Returns a function converting the document at p_docPath by
+           upper-casing it, at p_resultPath.'''
+        def convert():
+            self.conversions += 1
+            f = file(docPath, 'rb')
+            self.getPath(resultPath, f.read().upper())
+            f.close()
+            return 'converted'
+        return convert
+
+    def convert(self, cache, docPath, resultType, templatePath=None):
+        '''Converts the document at p_docPath with p_cache. Returns the
+           content of the result and the value returned by m_convert.'''
+        resultPath = self.getPath('result.%s' % resultType)
+        res = cache.convert(docPath, resultPath,
+                            self.getConverter(docPath, resultPath),
+                            resultType, templatePath)
+        f = file(resultPath, 'rb')
+        content = f.read()
+        f.close()
+        return content, res
+
+    def testFileDigest(self):
+        '''The digest of a zip file does not depend on the dates of its
+           entries.'''
+        zip1 = self.getZip('doc1.odt', 'Content', (2010, 1, 1, 0, 0, 0))
+        zip2 = self.getZip('doc2.odt', 'Content', (2012, 5, 5, 10, 0, 0))
+        zip3 = self.getZip('doc3.odt', 'Other', (2010, 1, 1, 0, 0, 0))
+        self.assertEqual(getFileDigest(zip1), getFileDigest(zip2))
+        self.assertNotEqual(getFileDigest(zip1), getFileDigest(zip3))
+        self.assertNotEqual(getFileDigest(self.getPath('a.txt', 'A')),
+                            getFileDigest(self.getPath('b.txt', 'B')))
+
+    def testConvert(self):
+        for hardlink in (False, True):
+            cache = ConversionCache(os.path.join(self.tempFolder,
+                                    'cache%s' % hardlink), hardlink=hardlink)
+            self.conversions = 0
+            doc = self.getPath('doc.txt', 'Hello')
+            template = self.getPath('template.txt', 'Styles')
+            for resultType, templatePath, expected, conversions in (
+                ('pdf', None, ('HELLO', 'converted'), 1),
+                ('pdf', None, ('HELLO', None), 1),
+                ('doc', None, ('HELLO', 'converted'), 2),
+                ('pdf', template, ('HELLO', 'converted'), 3),
+                ('pdf', template, ('HELLO', None), 3)):
+                self.assertEqual(self.convert(cache, doc, resultType,
+                                 templatePath), expected)
+                self.assertEqual(self.conversions, conversions)
+            # The result is a hard link to the file in the cache, or a copy
+            result = self.getPath('result.pdf')
+            self.assertEqual(os.stat(result).st_nlink, hardlink and 2 or 1)
+            # The same content in another file is found in the cache
+            other = self.getPath('other.txt', 'Hello')
+            self.assertEqual(self.convert(cache, other, 'pdf'), ('HELLO',None))
+            self.assertEqual(cache.getStats()['hits'], 3)
+            self.assertEqual(cache.getStats()['misses'], 3)
+
+    def testFailedConversion(self):
+        '''Nothing is stored in the cache if the conversion fails'''
+        cache = ConversionCache(self.cacheFolder)
+        doc = self.getPath('doc.txt', 'Hello')
+        result = self.getPath('result.pdf')
+        for i in range(2):
+            self.assertEqual(cache.convert(doc, result, lambda: 'Error',
+                                           'pdf'), 'Error')
+        self.assertEqual(cache.getStats()['files'], 0)
+        self.assertEqual(cache.getStats()['misses'], 2)
+
+    def testEviction(self):
+        '''The least recently used files are removed when the cache is full,
+           until its size falls under its eviction target.'''
+        cache = ConversionCache(self.cacheFolder, maxSize=1000)
+        keys = []
+        for i in range(6):
+            key = getKey(str(i))
+            keys.append(key)
+            cache.setFile(key, self.getPath('doc.txt', str(i) * 300))
+            # Set increasing modification dates, in the past
+            os.utime(cache.getPath(key), (1000 + i, 1000 + i))
+            if i == 1:
+                # Use file 0: file 1 becomes the least recently used one
+                self.assertTrue(cache.getFile(keys[0], self.getPath('r.txt')))
+                os.utime(cache.getPath(keys[0]), (1001.5, 1001.5))
+        # From the 4th file, every new file makes the cache exceed its max
+        # size: the least recently used file is removed (file 1, then file 0,
+        # used after it, then file 2), to get back to 900 bytes.
+        remaining = [key for key in keys if os.path.exists(cache.getPath(key))]
+        self.assertEqual(remaining, keys[3:])
+        self.assertEqual(cache.size, 900)
+
+    def testRescan(self):
+        '''The cache folder is scanned at the first write, and then only every
+           BoundedDiskCache.rescanInterval writes, or when the cache seems
+           full.'''
+        cache = ConversionCache(self.cacheFolder, maxSize=1000)
+        cache.rescanInterval = 3
+        scans = []
+        getFiles = cache.getFiles
+        def countScans():
+            scans.append(None)
+            return getFiles()
+        cache.getFiles = countScans
+        doc = self.getPath('doc.txt', 'a' * 100)
+        for i in range(5):
+            cache.setFile(getKey(str(i)), doc)
+        self.assertEqual(len(scans), 2)
+        self.assertEqual(cache.size, 500)
+        # Another instance fills the cache: this one only notices it at its
+        # next scan, after 3 more writes, and then removes files.
+        other = ConversionCache(self.cacheFolder, maxSize=1000)
+        other.setFile(getKey('big'), self.getPath('big.txt', 'b' * 450))
+        self.assertEqual(len(os.listdir(self.cacheFolder)), 6)
+        for i in range(5, 9):
+            cache.setFile(getKey(str(i)), doc)
+        self.assertEqual(len(scans), 3)
+        self.assertTrue(cache.size <= 900)
+        self.assertEqual(cache.size, cache.getStats()['size'])
+
+# ------------------------------------------------------------------------------
+class ImageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves test image python.gif, with an ETag, for ImageServerTest'''
+    # The number of requests answered with the image or with a 304
+    downloads = 0
+    notModified = 0
+
+    def do_GET(self):
+        if self.path == '/notFound.gif':
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == '"v1"':
+            ImageHandler.notModified += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        ImageHandler.downloads += 1
+        f = file(os.path.join(testFolder, 'images', 'python.gif'), 'rb')
+        content = f.read()
+        f.close()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/gif')
+        self.send_header('Content-Length', str(len(content)))
+        if self.path != '/noetag.gif': self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args): pass
+
+class ImageServerTest(RenderingTest):
+    '''Base class for tests downloading images from a local HTTP server
+       (see ImageHandler).'''
+
+    def setUp(self):
+        RenderingTest.setUp(self)
+        self.server = None
+        ImageHandler.downloads = ImageHandler.notModified = 0
+
+    def tearDown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+        RenderingTest.tearDown(self)
+
+    def startServer(self):
+        '''Starts the HTTP server and returns its base URL'''
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), ImageHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+class ImageCacheTests(ImageServerTest):
+    '''Tests appy.shared.cache.ImageCache'''
+
+    def testEntries(self):
+        cache = ImageCache(self.tempFolder, maxSize=1000)
+        key = getKey('image')
+        self.assertEqual(cache.getEntry(key), None)
+        # Data may contain any byte
+        data = '\x89PNG\r\n\x1a\n\t\x00' * 10
+        cache.setEntry(key, ('png', '12.5', ''), data)
+        self.assertEqual(cache.getEntry(key), (['png', '12.5', ''], data))
+        cache.setEntry(key, ('gif',), '')
+        self.assertEqual(cache.getEntry(key), (['gif'], ''))
+        self.assertEqual(cache.getStats()['hits'], 2)
+        self.assertEqual(cache.getStats()['misses'], 1)
+        # Reading an entry marks it as recently used
+        other = getKey('other')
+        cache.setEntry(other, ('png',), 'a' * 400)
+        os.utime(cache.getPath(key), (1000, 1000))
+        os.utime(cache.getPath(other), (1001, 1001))
+        cache.getEntry(key)
+        cache.setEntry(getKey('third'), ('png',), 'b' * 600)
+        self.assertEqual(cache.getEntry(other), None)
+        self.assertEqual(cache.getEntry(key), (['gif'], ''))
+
+    def testDownload(self):
+        '''An image having an ETag is downloaded once, and then taken from
+           the cache as long as the server says it did not change.'''
+        from appy.pod.doc_importers import downloadImage
+        base = self.startServer()
+        cache = ImageCache(self.tempFolder)
+        results = []
+        for url in ('/python.gif', '/python.gif', '/noetag.gif', '/noetag.gif'):
+            results.append(downloadImage(base + url, cache))
+        self.assertEqual(ImageHandler.downloads, 3)
+        self.assertEqual(ImageHandler.notModified, 1)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][0], 'gif')
+        self.assertEqual(results[0][2], '"v1"')
+        self.assertEqual(results[2][1], results[0][1])
+        self.assertEqual(results[2][2], None)
+        # The image without ETag was not cached
+        self.assertEqual(cache.getStats()['files'], 1)
+
+# ------------------------------------------------------------------------------
+class BatchRendererTests(RenderingTest):
+    '''Tests appy.pod.batch.BatchRenderer'''
+
+    def getContexts(self):
+        '''Returns contexts for template SimpleTest: dicts, a loader and, at
+           index 5, a context producing an error.'''
+        res = [{'IWillTellYouWhatInAMoment': 'Value %d' % i,
+                'beingPaidForIt': bool(i % 2)} for i in range(4)]
+        res.append(functools.partial(getContext, 'SimpleTest'))
+        res.append({'beingPaidForIt': True})
+        return res
+
+    def testRun(self):
+        template = getTemplate('SimpleTest')
+        contexts = self.getContexts()
+        expected = []
+        for context in contexts[:5]:
+            if callable(context): context = context()
+            expected.append(self.render(template, context))
+        for processes in (0, 2):
+            folder = os.path.join(self.tempFolder, str(processes))
+            os.mkdir(folder)
+            getResult = lambda i, context: os.path.join(folder, '%d.odt' % i)
+            batch = BatchRenderer(PodTemplate(template, raiseOnError=True),
+                                  getResult, processes=processes)
+            results = {}
+            for result in batch.run(self.getContexts()):
+                results[result.index] = result
+            self.assertEqual(sorted(results.keys()), range(6))
+            for i in range(5):
+                self.assertEqual(results[i].error, None)
+                self.assertEqual(results[i].result, getResult(i, None))
+                self.assertSameResults(results[i].result, expected[i])
+            self.assertTrue('IWillTellYouWhatInAMoment' in results[5].error)
+
+    def testRendererParams(self):
+        '''Renderer parameters are passed to every Renderer, and may prevent
+           existing results from being overwritten.'''
+        template = getTemplate('SimpleTest')
+        contexts = self.getContexts()[:5]
+        for processes in (0, 2):
+            folder = os.path.join(self.tempFolder, str(processes))
+            os.mkdir(folder)
+            getResult = lambda i, context: os.path.join(folder, '%d.odt' % i)
+            for params, error in (({}, None),
+                                  ({'overwriteExisting': True}, None),
+                                  ({'overwriteExisting': False}, 'exists'),
+                                  ({'stylesMapping': 'Hello'}, 'mapping')):
+                batch = BatchRenderer(template, getResult, processes=processes,
+                                      **params)
+                results = list(batch.run(contexts))
+                self.assertEqual(len(results), 5)
+                for result in results:
+                    if error: self.assertTrue(error in result.error)
+                    else: self.assertEqual(result.error, None)
+        self.assertRaises(Exception, BatchRenderer, template, getResult,
+                          ooPort=2002)
+
+    def testOoPorts(self):
+        '''Documents are dispatched among LibreOffice ports'''
+        batch = BatchRenderer(getTemplate('SimpleTest'), lambda i, c: '',
+                              ooPorts=(2002, 2003, 2004), forceOoCall=True)
+        tasks = list(batch.getTasks(range(5)))
+        self.assertEqual([task[3] for task in tasks],
+                         [2002, 2003, 2004, 2002, 2003])
+        self.assertEqual(tasks[0][4], {'forceOoCall': True})
+
+    def testWrongTemplates(self):
+        '''Workers can only get the template from a file name'''
+        f = file(getTemplate('SimpleTest'), 'rb')
+        try:
+            for template in (f, PodTemplate(f), None):
+                self.assertRaises(Exception, BatchRenderer, template, None)
+        finally:
+            f.close()
+        self.assertRaises(Exception, BatchRenderer, getTemplate('SimpleTest'),
+                          None, ooPorts=())
+
+# ------------------------------------------------------------------------------
+class FakeInstance:
+    '''Replaces a LibreOffice instance (see appy.pod.converter.LoInstance) in
+       ConverterServiceTests: a document is "converted" by copying it.'''
+    def __init__(self):
+        # Jobs of type "slow" wait for this event
+        self.release = threading.Event()
+
+    def convert(self, job):
+        if job.resultType == 'wrong': return 'Wrong type'
+        if job.resultType == 'slow': self.release.wait()
+        shutil.copy(job.docPath,
+                    converter.getResultPath(job.docPath, job.resultType))
+
+class ConverterServiceTests(unittest.TestCase):
+    '''Tests appy.pod.converter.ConverterService and callService, with fake
+       LibreOffice instances.'''
+
+    def setUp(self):
+        self.tempFolder = tempfile.mkdtemp()
+        self.server = None
+        self.doc = os.path.join(self.tempFolder, 'doc.odt')
+        f = file(self.doc, 'wb')
+        f.write('Document')
+        f.close()
+
+    def tearDown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+        shutil.rmtree(self.tempFolder, True)
+
+    def startService(self, address, instances=2):
+        '''Starts, in threads, a ConverterService listening at p_address, like
+           ConverterService.run does. Returns the service address.'''
+        service = converter.ConverterService(address, ())
+        service.instances = [FakeInstance() for i in range(instances)]
+        for instance in service.instances:
+            worker = threading.Thread(target=service.work, args=(instance,))
+            worker.daemon = True
+            worker.start()
+        self.server = service.getServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.service = service
+        if self.server.address_family == socket.AF_INET:
+            return self.server.server_address[1]
+        return address
+
+    def checkConversions(self, address):
+        converter.callService(address, self.doc, 'pdf')
+        f = file(os.path.join(self.tempFolder, 'doc.pdf'), 'rb')
+        self.assertEqual(f.read(), 'Document')
+        f.close()
+        try:
+            converter.callService(address, self.doc, 'wrong')
+            self.fail('No error was raised')
+        except converter.ConverterError, e:
+            self.assertEqual(str(e), 'Wrong type')
+
+    def testUnixSocket(self):
+        self.checkConversions(self.startService(
+                              os.path.join(self.tempFolder, 'service')))
+
+    def testTcp(self):
+        self.checkConversions(self.startService('0'))
+
+    def testConcurrentCalls(self):
+        '''Several clients may call the service at once: their jobs are
+           dispatched among the instances.'''
+        address = self.startService(os.path.join(self.tempFolder, 'service'))
+        errors = []
+        def call(i):
+            try:
+                doc = os.path.join(self.tempFolder, 'doc%d.odt' % i)
+                shutil.copy(self.doc, doc)
+                converter.callService(address, doc, 'pdf')
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(6)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(errors, [])
+        for i in range(6):
+            path = os.path.join(self.tempFolder, 'doc%d.pdf' % i)
+            self.assertTrue(os.path.exists(path))
+
+    def testErrors(self):
+        address = os.path.join(self.tempFolder, 'service')
+        # No service is listening
+        self.assertRaises(converter.ConverterError, converter.callService,
+                          address, self.doc, 'pdf')
+        self.startService(address, instances=1)
+        # The service does not respond in time. It will fail to respond
+        # later, the client having closed the connection: do not log it.
+        self.server.handle_error = lambda request, clientAddress: None
+        try:
+            converter.callService(address, self.doc, 'slow', timeout=0.2)
+            self.fail('No error was raised')
+        except converter.ConverterError, e:
+            self.assertTrue('did not respond' in str(e))
+        self.service.instances[0].release.set()
+        # A wrong request gets an error response
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            sock.sendall('Wrong request\n')
+            response = sock.makefile('rb').readline()
+        finally:
+            sock.close()
+        self.assertTrue(json.loads(response)['error'])
+        # The service still works
+        self.checkConversions(address)
+
+    def testRestart(self):
+        '''A LibreOffice instance is restarted, and the conversion is tried a
+           second time, if an unexpected error occurs.'''
+        class Instance(converter.LoInstance):
+            starts = 0
+            def start(self):
+                self.starts += 1
+                self.desktop = object()
+            def isAlive(self):
+                return self.desktop is not None
+        Converter = converter.Converter
+        job = converter.ConversionJob(self.doc, 'pdf')
+        for errors, expected, starts in (
+            ([Exception('Crash')], None, 2),
+            ([Exception('Crash'), Exception('Crash again')], 'Crash again', 2),
+            ([converter.ConverterError('Wrong doc')], 'Wrong doc', 1)):
+            class FakeConverter:
+                def __init__(self, *args): pass
+                def run(self):
+                    if errors: raise errors.pop(0)
+            converter.Converter = FakeConverter
+            try:
+                instance = Instance(2002)
+                self.assertEqual(instance.convert(job), expected)
+                self.assertEqual(instance.starts, starts)
+            finally:
+                converter.Converter = Converter
+
+# ------------------------------------------------------------------------------
+class Chunk:
+    '''Gives a chunk of XHTML to template XhtmlNominal'''
+    def __init__(self, xhtml): self.xhtml = xhtml
+    def getAt1(self): return self.xhtml
+
+class SimpleConverterTests(RenderingTest):
+    '''Checks that appy.pod.xhtml2odt.SimpleConverter produces the same
+       results as the XhtmlParser, and leaves to it chunks it can't
+       convert.'''
+    simpleChunks = (
+      'Hello', '<p>Hello</p>', 'Hello <b>world</b>!', '<p>A<br/>B</p><p>C</p>',
+      '<ul><li>One</li><li>Two <b>2</b></li></ul>', 'Text<p>Para</p>Text',
+      '<p>  Spaces   <i>and</i>\n  lines </p>\n',
+      '<b><i>Nested</i> tags</b>', '<p>&eacute;&amp;&lt;&nbsp;</p>',
+      '<strong>S</strong><em>E</em>', '<p></p><ul></ul>',
+      'Caf\xc3\xa9 <p>\xe2\x82\xac</p>', '<ul><li>A<br/></li></ul>Text')
+    otherChunks = (
+      '<p class="x">A</p>', '<ol><li>A</li></ol>', '<p>&#233;</p>',
+      '<p>A<!-- Comment --></p>', '<ul><li><ul><li>A</li></ul></li></ul>',
+      '<ul><li><p>A</p></li></ul>', '<h1>Title</h1>', '<p>Unclosed',
+      '<b>Wrong</i>')
+
+    def convert(self, chunks):
+        '''Renders template XhtmlNominal with every chunk from p_chunks, and
+           returns a dict whose values are tuples (simple, full), "simple"
+           being the result of the SimpleConverter and "full" being the result
+           of the XhtmlParser (None if it could not parse it), keyed by
+           chunk.'''
+        res = {}
+        def convert(converter):
+            simple = SimpleConverter(converter).run()
+            try:
+                converter.xhtmlParser = XhtmlParser(
+                  XhtmlEnvironment(converter.renderer), converter)
+                converter.xhtmlParser.parse(converter.xhtmlString)
+                full = converter.xhtmlParser.env.res
+            except Exception:
+                full = None
+            res[converter.xhtmlString[3:-4]] = simple, full
+            return full or ''
+        Xhtml2OdtConverter.chunks.clear()
+        base = Xhtml2OdtConverter.convert
+        Xhtml2OdtConverter.convert = convert
+        try:
+            for chunk in chunks:
+                context = {'dummy': Chunk(chunk), 'titles': ''}
+                self.render(getTemplate('XhtmlNominal'), context)
+        finally:
+            Xhtml2OdtConverter.convert = base
+            Xhtml2OdtConverter.chunks.clear()
+        return res
+
+    def testSimpleChunks(self):
+        results = self.convert(self.simpleChunks)
+        for chunk in self.simpleChunks:
+            simple, full = results[chunk]
+            self.assertNotEqual(simple, None, chunk)
+            self.assertEqual(simple, full)
+
+    def testOtherChunks(self):
+        results = self.convert(self.otherChunks)
+        for chunk in self.otherChunks:
+            self.assertEqual(results[chunk][0], None, chunk)
+
+# ------------------------------------------------------------------------------
+class FileInfo:
+    '''A fake file stored in the database-controlled filesystem (see
+       appy.fields.file.FileInfo)'''
+    mimeType = 'image/png'
+    def getFilePath(self, obj):
+        return os.path.join(testFolder, 'images', 'plone.png')
+
+class SiteObject:
+    '''A fake object from the site, storing an image in field "photo"'''
+    photo = FileInfo()
+    def appy(self): return self
+
+class NotFound(Exception):
+    '''Raised by the fake image resolver, like Zope\'s traversal'''
+
+class ImageResolver:
+    '''A fake image resolver (a Zope application), whose only object is at
+       path "obj".'''
+    def __init__(self, url): self.url = url
+    def absolute_url(self): return self.url
+    def unrestrictedTraverse(self, path):
+        if path == ['obj']: return SiteObject()
+        raise NotFound('/'.join(path))
+
+class SiteImagesTests(ImageServerTest):
+    '''Tests the import of images from the site whose image resolver is
+       given to the renderer.'''
+
+    def getImages(self, path):
+        '''Returns the types of the images in the POD result at p_path'''
+        f = zipfile.ZipFile(path)
+        try:
+            return [imghdr.what(None, f.read(name)) for name in f.namelist() \
+                    if name.startswith('Pictures/')]
+        finally:
+            f.close()
+
+    def testResolver(self):
+        '''The URL of an image stored in a field of an object is resolved
+           without any HTTP request. Any other URL is downloaded.'''
+        base = self.startServer()
+        resolver = ImageResolver(base)
+        for url, images, downloads in (
+            ('/obj/download?name=photo', ['png'], 0),
+            # Static resources, that have no field name
+            ('/ui/logo.png', ['gif'], 1), ('/obj/download?v=2', ['gif'], 2),
+            # Objects or fields that do not exist
+            ('/missing/download?name=photo', ['gif'], 3),
+            ('/obj/download?name=unknown', ['gif'], 4),
+            # A static resource that can't be downloaded
+            ('/notFound.gif', ['jpeg'], 4)):
+            context = {'dummy': Chunk('<img src="%s%s"/>' % (base, url)),
+                       'titles': ''}
+            result = self.render(getTemplate('XhtmlNominal'), context,
+                                 imageResolver=resolver)
+            self.assertEqual(self.getImages(result), images, url)
+            self.assertEqual(ImageHandler.downloads, downloads, url)
+
+    def testPrefetch(self):
+        '''Images whose URLs are given to the renderer are downloaded while
+           the template is rendered, excepted images from the site.'''
+        base = self.startServer()
+        urls = [base + '/python.gif', base + '/obj/download?name=photo']
+        xhtml = ''.join(['<img src="%s"/>' % url for url in urls])
+        result = self.render(getTemplate('XhtmlNominal'),
+                             {'dummy': Chunk(xhtml), 'titles': ''},
+                             imageResolver=ImageResolver(base),
+                             prefetchUrls=urls)
+        self.assertEqual(sorted(self.getImages(result)), ['gif', 'png'])
+        self.assertEqual(ImageHandler.downloads, 1)
+
+# ------------------------------------------------------------------------------
+class XhtmlChunkTests(RenderingTest):
+    '''Tests the cache of XHTML chunks converted to ODT (see
+       appy.pod.xhtml2odt.XhtmlChunk).'''
+    # Chunks producing custom styles, and list and table styles
+    chunks = ('<p style="color:#ff0000">Red</p><ul><li>One</li></ul>',
+              '<p style="text-align:center">Centered</p>' \
+              '<p style="color:#ff0000">Red</p><ol><li>One</li></ol>',
+              '<table><tr><td style="background-color:#00ff00">Cell</td>' \
+              '</tr></table><p style="font-size:8pt">Small</p>')
+
+    # Custom styles are numbered in the order they are added to a renderer,
+    # that may differ when chunks are replayed. Tables have time-based names.
+    rexStyle = re.compile('<style:style style:name="(CS\d+)"(.*?)</style:style>',
+                          re.S)
+    rexStyleName = re.compile('style-name="(CS\d+)"')
+    rexTable = re.compile('Table\d+')
+
+    def getParts(self, path):
+        '''Returns content.xml and styles.xml from the result at p_path, where
+           custom styles are replaced with their definitions and table names
+           are removed.'''
+        parts = [getPart(path, name) for name in ('content.xml','styles.xml')]
+        styles = {}
+        for part in parts:
+            for name, definition in self.rexStyle.findall(part):
+                styles[name] = definition
+        res = []
+        for part in parts:
+            part = self.rexStyle.sub('', part)
+            part = self.rexStyleName.sub(lambda match: \
+                                     'style="%s"' % styles[match.group(1)], part)
+            res.append(self.rexTable.sub('Table', part))
+        return res
+
+    def getContext(self, order):
+        '''Gets a context for template XhtmlComplex2, containing self.chunks
+           in this p_order.'''
+        names = ('xhtmlInput', 'xhtmlInput2', 'xhtmlInput3')
+        res = {}
+        for i in range(3): res[names[i]] = self.chunks[order[i]]
+        return res
+
+    def testReplay(self):
+        '''Chunks converted by a renderer and replayed into other ones produce
+           the same results as chunks converted by these renderers.'''
+        cache = Xhtml2OdtConverter.chunks
+        template = getTemplate('XhtmlComplex2')
+        cache.clear()
+        self.render(template, self.getContext((0, 1, 2)))
+        # Custom styles are renamed when chunks are replayed in another order.
+        # The same chunk may also be replayed twice into the same renderer.
+        for order in ((1, 0, 2), (2, 0, 1), (2, 2, 1)):
+            hits = cache.hits
+            result = self.render(template, self.getContext(order))
+            self.assertEqual(cache.hits - hits, 3)
+            cache.clear()
+            expected = self.render(template, self.getContext(order))
+            self.assertEqual(self.getParts(result), self.getParts(expected))
+        cache.clear()
+
+# ------------------------------------------------------------------------------
+class PxCompilerTests(unittest.TestCase):
+    '''Checks that PXs compiled into Python functions (see
+       appy.px.px_compiler) produce the same results as interpreted PXs.'''
+    cases = (
+     # Expressions, escaped or not, with error expressions
+     '<p>:text</p><p>::text</p><p>:number</p><p>:none</p><p>:undefined|"d"</p>',
+     # Attributes
+     '<a href=":url" class="link" title=":text">:url</a>',
+     # Loops, with the loop object, on lists and generators
+     '<ul><li for="i in items" class=":loop.i.odd and \'o\' or \'e\'">:"%d/%d' \
+     ' %s %s" % (loop.i.nb, loop.i.length, loop.i.first, loop.i.last)</li>' \
+     '</ul><b for="i in gen()">:"%s %s" % (i, loop.i.last)</b>',
+     # Nested loops hiding variables, empty loops
+     '<x for="i in items"><x for="j in items[:i]">:"%s.%s" % (i,j)</x>' \
+     '</x><p>:i</p><p for="i in []">Never</p><p>:i</p>',
+     # Conditions and variables, including global ones
+     '<x var="a=1; b=a+1" var2="c=a+b"><p if="c == 3">:c</p>' \
+     '<p if="c != 3">Never</p></x><x var="@g=5"></x><p>:g</p>',
+     # Actions combined on a single tag
+     '<p for="i in items" if="i % 2" var="d=i*2">:d</p>',
+     # Sub-PXs
+     '<div for="i in items">:sub</div>')
+
+    def getContext(self):
+        return {'text': u'<b>&amp;</b>', 'number': 12, 'none': None,
+                'url': 'http://x.org/?a=1&b=2', 'items': [1, 2, 3], 'i': 'I',
+                'gen': lambda: (x for x in 'abc'),
+                'sub': Px('<i>:i * 2</i>')}
+
+    def getPxs(self, content):
+        '''Returns a compiled and an interpreted PX with this p_content'''
+        res = []
+        for useCompiler in (True, False):
+            Px.useCompiler = useCompiler
+            try:
+                px = Px(content)
+                px.ensureParsed()
+            finally:
+                Px.useCompiler = True
+            self.assertEqual(px.renderFunction is not None, useCompiler)
+            res.append(px)
+        return res
+
+    def testResults(self):
+        for content in self.cases:
+            compiled, interpreted = self.getPxs(content)
+            self.assertEqual(compiled(self.getContext()),
+                             interpreted(self.getContext()))
+
+    def testErrors(self):
+        '''Compiled and interpreted PXs raise the same errors'''
+        from appy.pod.actions import EvaluationError
+        for content in ('<p>\n<b>:1/0</b></p>', '<p for="i in 3">:i</p>',
+                        '<p if="undefined">Never</p>'):
+            errors = []
+            for px in self.getPxs(content):
+                try:
+                    px(self.getContext())
+                    self.fail('No error was raised')
+                except EvaluationError, e:
+                    errors.append(e.message)
+            self.assertEqual(errors[0], errors[1])
+
+# ------------------------------------------------------------------------------
+class PxRenderToTests(unittest.TestCase):
+    '''Tests appy.px.Px.renderTo'''
+
+    def testTemplate(self):
+        '''A PX based on a template PX is dumped in the sink with the type of
+           the template's result, like when the PX is called.'''
+        for unicode, expected in ((False, str), (True, type(u''))):
+            template = Px('<html><div>:content</div></html>', unicode=unicode)
+            page = Px('<p>:name</p>', template=template, hook='content',
+                      unicode=not unicode)
+            result = page({'name': u'\xe9'})
+            self.assertEqual(type(result), expected)
+            for bufferSize in (0, 8192):
+                sink = []
+                page.renderTo(sink, {'name': u'\xe9'}, bufferSize=bufferSize)
+                for chunk in sink: self.assertEqual(type(chunk), expected)
+                self.assertEqual(''.join(sink), result)
+
+# ------------------------------------------------------------------------------
+class PxOutputCacheTests(unittest.TestCase):
+    '''Checks the caching of PX results in Px.outputCache'''
+
+    def setUp(self):
+        Px.outputCache.clear()
+        # The number of evaluations of the tested PXs
+        self.evaluations = 0
+
+    def getPx(self, content, cacheKey):
+        '''Returns a PX with this p_content and p_cacheKey, that counts its
+           evaluations into self.evaluations.'''
+        test = self
+        def count(context):
+            test.evaluations += 1
+            return ''
+        return Px('<x>:count(_ctx_)</x>%s' % content, cacheKey=cacheKey), count
+
+    def testCacheKey(self):
+        px, count = self.getPx('<p>:name</p>', lambda ctx: ctx.get('key'))
+        for key, name, expected, evaluations in (
+            ('a', 'A', '<p>A</p>', 1),
+            # Same key: the cached result is dumped, even if the context differs
+            ('a', 'B', '<p>A</p>', 1),
+            ('b', 'B', '<p>B</p>', 2),
+            # No key: nothing is cached
+            (None, 'C', '<p>C</p>', 3), (None, 'D', '<p>D</p>', 4),
+            ('b', 'D', '<p>B</p>', 4)):
+            context = {'key': key, 'name': name, 'count': count}
+            self.assertEqual(px(context), expected)
+            self.assertEqual(self.evaluations, evaluations)
+
+    def testObjectKey(self):
+        class Object:
+            def __init__(self, id, modified):
+                self.id = id
+                self.modified = modified
+        px, count = self.getPx('<p>:o.id</p><p>:lang</p>',
+                               Px.objectKey(get='o', names=('extra',)))
+        o1 = Object('o1', 1)
+        for o, lang, extra, expected, evaluations in (
+            (o1, 'en', None, '<p>o1</p><p>en</p>', 1),
+            (o1, 'en', None, '<p>o1</p><p>en</p>', 1),
+            (o1, 'fr', None, '<p>o1</p><p>fr</p>', 2),
+            (o1, 'fr', 'x', '<p>o1</p><p>fr</p>', 3),
+            (Object('o2', 1), 'fr', None, '<p>o2</p><p>fr</p>', 4),
+            # The object has changed
+            (Object('o1', 2), 'en', None, '<p>o1</p><p>en</p>', 5),
+            # No language: nothing is cached
+            (o1, None, None, '<p>o1</p><p></p>', 6),
+            (o1, None, None, '<p>o1</p><p></p>', 7)):
+            context = {'o': o, 'lang': lang, 'extra': extra, 'count': count}
+            self.assertEqual(px(context), expected)
+            self.assertEqual(self.evaluations, evaluations)
+
+    def testOverride(self):
+        '''Overriding a PX invalidates its cached results, but not those of
+           other PXs.'''
+        key = lambda ctx: 'k'
+        px, count = self.getPx('<p>Old</p>', key)
+        other = self.getPx('<p>Other</p>', key)[0]
+        context = {'count': count}
+        self.assertEqual(px(context), '<p>Old</p>')
+        self.assertEqual(other(context), '<p>Other</p>')
+        px.override('<x>:count(_ctx_)</x><p>New</p>')
+        self.assertEqual(px(context), '<p>New</p>')
+        self.assertEqual(px(context), '<p>New</p>')
+        self.assertEqual(other(context), '<p>Other</p>')
+        self.assertEqual(self.evaluations, 3)
+
+    def testMaxCachedLength(self):
+        px, count = self.getPx('<p>:text</p>', lambda ctx: 'k')
+        context = {'text': 'a' * Px.maxCachedLength, 'count': count}
+        for i in range(2): px(context)
+        self.assertEqual(self.evaluations, 2)
+        px = self.getPx('<p>:text</p>', lambda ctx: 'k')[0]
+        context['text'] = 'a' * 10
+        for i in range(2): px(context)
+        self.assertEqual(self.evaluations, 3)
+
+    def testNested(self):
+        '''A cached PX may be called from an uncached one, whatever the way
+           the latter is rendered.'''
+        inner, count = self.getPx('<i>:name</i>', lambda ctx: ctx['name'])
+        outer = Px('<div><x>:inner</x><p>:name</p></div>')
+        context = {'inner': inner, 'name': u'\xe9', 'count': count}
+        expected = u'<div><i>\xe9</i><p>\xe9</p></div>'
+        self.assertEqual(outer(dict(context)), expected)
+        sink = []
+        outer.renderTo(sink, dict(context), bufferSize=0)
+        self.assertEqual(u''.join(sink), expected)
+        self.assertEqual(self.evaluations, 1)
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__': unittest.main()
+# ------------------------------------------------------------------------------
@@ -6,15 +6,17 @@
 # Contributors: Gauthier Bastien, Fabio Marcuzzi, IMIO.
 
 # ------------------------------------------------------------------------------
-import xml.sax, time, random
+import xml.sax, time, random, re
 from appy.pod import *
 from appy.pod.odf_parser import OdfEnvironment
 from appy.pod.styles_manager import \
-     Style, BulletedProperties, NumberedProperties
+     Style, BulletedProperties, NumberedProperties, StylesGenerator
 from appy.pod.doc_importers import px2cm
-from appy.shared.xml_parser import XmlEnvironment, XmlParser, escapeXml
+from appy.shared.xml_parser import XmlEnvironment, XmlParser, escapeXml, \
+     XML_ENTITIES, HTML_ENTITIES
 from appy.shared.utils import WhitespaceCruncher, formatNumber, addPair
 from appy.shared.css import CssStyles, CssValue
+from appy.shared.cache import LruCache, getKey
 
 # To which ODT tags do HTML tags correspond ?
 HTML_2_ODT = {
@@ -928,24 +930,331 @@ class XhtmlParser(XmlParser):
         for name, props in env.listProperties.iteritems():
             ds.append(props.dumpStyle(name, ns))
 
+# ------------------------------------------------------------------------------
+class SimpleConverter:
+    '''Converts, in a single pass, a chunk of XHTML made of a simple subset of
+       XHTML: paragraphs, bulleted lists, and tags b, i, strong, em and br,
+       without any attribute. For such a chunk, it produces exactly the same
+       result as the XhtmlParser, without the machinery required for managing
+       the whole XHTML language: it only implements the parts of it that are
+       relevant for the subset.'''
+    # Start, end or empty tags without attributes
+    rexTag = re.compile('<(/?)([a-zA-Z]+)\s*(/?)>')
+    rexEntity = re.compile('&([a-zA-Z][a-zA-Z0-9]*);')
+    # Chars that are forbidden in XML
+    rexWrongChar = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+    # Tags from the subset, with the tags they may be found in. "root" is the
+    # paragraph surrounding any chunk (see Renderer.renderXhtml).
+    inline = ('root', 'p', 'li', 'b', 'i', 'strong', 'em')
+    parents = {'p': ('root',), 'ul': ('root',), 'li': ('ul',), 'b': inline,
+               'i': inline, 'strong': inline, 'em': inline, 'br': inline}
+
+    def __init__(self, converter):
+        self.converter = converter
+        self.textNs = converter.renderer.currentParser.env.namespaces[\
+                                                        OdfEnvironment.NS_TEXT]
+        self.res = []
+        # The stack of currently walked elements, as lists
+        # [s_tag, s_rawTag, b_contentDumped, b_innerParagraph, b_reopenRoot]
+        self.elements = []
+        # The content (crunched) being collected since the last walked tag
+        self.content = u''
+        # The tag of the last closed element
+        self.lastElem = None
+        # Is the root paragraph conflictual, ie interrupted by a paragraph or a
+        # list ?
+        self.conflictual = False
+        # The ODF attributes of the tags, computed on demand
+        self.attributes = {}
+
+    def getAttributes(self, tag):
+        '''Returns the ODF attributes to dump in the start tag corresponding to
+           p_tag.'''
+        if tag in self.attributes: return self.attributes[tag]
+        style = self.converter.findStyle(HtmlElement(tag, {}))
+        res = self.attributes[tag] = style and style.getOdfAttributes() or ''
+        return res
+
+    def dump(self, s): self.res.append(s)
+
+    def removeEnd(self, tag):
+        '''Removes p_tag from the end of the result and returns True, if the
+           result ends with it.'''
+        res = self.res
+        if not res or not res[-1].endswith(tag): return
+        last = res.pop()
+        if len(last) > len(tag): res.append(last[:-len(tag)])
+        return True
+
+    def addText(self, text):
+        '''Adds p_text, found between 2 tags, to self.content. Returns False if
+           p_text can't be managed.'''
+        if ('<' in text) or (']]>' in text): return
+        try:
+            text = text.decode('utf-8')
+        except UnicodeDecodeError:
+            return
+        if self.rexWrongChar.search(text): return
+        if '&' in text:
+            # Like the XmlParser, replace HTML entities with their value and
+            # any other entity with a question mark.
+            if '&' in self.rexEntity.sub('', text): return
+            text = self.rexEntity.sub(self.getEntityValue, text)
+        self.content += WhitespaceCruncher.crunch(text, self.content)
+        return True
+
+    def getEntityValue(self, match):
+        name = match.group(1)
+        if name in XML_ENTITIES: return XML_ENTITIES[name]
+        if name in HTML_ENTITIES: return HTML_ENTITIES[name].decode('utf-8')
+        return u'?'
+
+    def addInnerParagraph(self, elem):
+        '''Dumps the paragraph into which the content of a "li" is dumped, if
+           not done yet (see HtmlElement.addInnerParagraph).'''
+        if elem[3]: return
+        style = self.converter.findStyle(HtmlElement.protos['p'])
+        name = style and style.name or XhtmlEnvironment.itemStyles['ul']
+        self.dump('<text:p %s:style-name="%s">' % (self.textNs, name))
+        elem[3] = True
+
+    def dumpContent(self, place, tag):
+        '''Dumps self.content (see XhtmlEnvironment.dumpCurrentContent)'''
+        content = self.content
+        if not content: return
+        if (place == 'start') and content.endswith(' ') and \
+           ((tag not in INNER_TAGS) or (tag == 'br')):
+            content = content[:-1]
+        if content.startswith(' '):
+            last = self.lastElem
+            if not last or (last not in INNER_TAGS) or (last == 'br'):
+                content = content[1:]
+        if content:
+            elem = self.elements[-1]
+            if elem[0] == 'li': self.addInnerParagraph(elem)
+            self.dump(escapeXml(content))
+            elem[2] = True
+        self.content = u''
+
+    def getRootTag(self):
+        return '<text:p%s>' % self.getAttributes('p')
+
+    def startElement(self, rawTag):
+        '''Manages the start of p_rawTag. Returns False if it can't be
+           managed.'''
+        tag = rawTag.lower()
+        if not self.elements:
+            # The root paragraph
+            if (tag != 'p') or self.res: return
+            self.elements.append(['root', rawTag, False, False, False])
+            self.dump(self.getRootTag())
+            return True
+        parent = self.elements[-1]
+        if (tag not in self.parents) or (parent[0] not in self.parents[tag]):
+            return
+        if tag == 'ul':
+            # A list style may be found in a styles mapping
+            if self.converter.findStyle(HtmlElement.protos['ul']): return
+        self.dumpContent('start', tag)
+        reopen = False
+        if tag in ('p', 'ul'):
+            # The root paragraph must be closed, and reopened after this tag
+            if not self.removeEnd(self.getRootTag()): self.dump('</text:p>')
+            self.conflictual = reopen = True
+        elif parent[0] == 'li':
+            self.addInnerParagraph(parent)
+        self.elements.append([tag, rawTag, False, False, reopen])
+        # Dump the start tag
+        ns = self.textNs
+        if tag == 'ul':
+            self.dump('<%s:list %s:style-name="%s">' % \
+                      (ns, ns, XhtmlEnvironment.defaultListStyles['ul']))
+        elif tag == 'li':
+            self.dump('<%s:list-item>' % ns)
+        else:
+            self.dump('<%s%s>' % (HTML_2_ODT[tag], self.getAttributes(tag)))
+        return True
+
+    def endElement(self, rawTag):
+        '''Manages the end of p_rawTag. Returns False if it can't be
+           managed.'''
+        elements = self.elements
+        if not elements or (elements[-1][1] != rawTag): return
+        tag = rawTag.lower()
+        self.dumpContent('end', tag)
+        elem = elements.pop()
+        # LibreOffice does not support multiple inner tags surrounding the same
+        # text (see XhtmlEnvironment.onElementEnd).
+        zeroWidthSpace = (tag in STYLED_INNER_TAGS) and \
+           (elements[-1][0] in STYLED_INNER_TAGS) and not elements[-1][2]
+        if elem[3]:
+            # Close the inner paragraph of a "li"
+            if not self.removeEnd(self.getRootTag()):
+                self.dump('</text:p>')
+        self.lastElem = tag
+        # Dump the end tag
+        if elem[0] == 'root':
+            if not self.conflictual or not self.removeEnd(self.getRootTag()):
+                self.dump('</text:p>')
+        elif tag == 'ul':
+            self.dump('</%s:list>' % self.textNs)
+        elif tag == 'li':
+            self.dump('</%s:list-item>' % self.textNs)
+        else:
+            self.dump('</%s>' % HTML_2_ODT[tag])
+        if zeroWidthSpace: self.dump(u'\u200B')
+        if elem[4]: self.dump(self.getRootTag())
+        return True
+
+    def run(self):
+        '''Returns the chunk of ODT, or None if the chunk of XHTML is not
+           within the subset.'''
+        s = self.converter.xhtmlString
+        i = 0
+        for match in self.rexTag.finditer(s):
+            if match.start() > i:
+                if not self.elements: return
+                if not self.addText(s[i:match.start()]): return
+            i = match.end()
+            end, tag, empty = match.groups()
+            if end:
+                if empty or not self.endElement(tag): return
+            else:
+                if not self.startElement(tag): return
+                if empty and not self.endElement(tag): return
+        # Nothing may follow the root paragraph
+        if self.elements or (i != len(s)) or not self.res: return
+        return u''.join(self.res)
+
+# ------------------------------------------------------------------------------
+class XhtmlChunk:
+    '''A chunk of ODT content produced from a chunk of XHTML, as stored in the
+       cache of Xhtml2OdtConverter. It also stores the dynamic styles that were
+       added to the renderer while producing it, in order to add them again to
+       any other renderer using it.'''
+    # Custom styles are referenced in the ODT content with attributes like this
+    rexCustomStyle = re.compile(':style-name="(%s\d+)"' % \
+                                StylesGenerator.prefix)
+
+    def __init__(self, key, odt, renderer, sizes):
+        self.key = key
+        self.odt = odt
+        # The custom styles used by the chunk, as tuples (name, hash, target,
+        # definition). Custom style names are incremental per renderer (see
+        # appy.pod.styles_manager.StylesGenerator): when replayed into another
+        # renderer, they must be renamed.
+        generator = renderer.stylesManager.stylesGenerator
+        self.customStyles = []
+        definitions = set()
+        for name, hash in generator.used.iteritems():
+            hash, target, definition = generator.definitions[name]
+            self.customStyles.append((name, hash, target, definition))
+            definitions.add(definition)
+        # The other dynamic styles (tables and lists), as tuples (target,
+        # definition). p_sizes gives, for every target, the number of dynamic
+        # styles the renderer had before the chunk was produced.
+        self.dynamicStyles = []
+        for target, styles in renderer.dynamicStyles.iteritems():
+            for definition in styles[sizes[target]:]:
+                if definition in definitions: continue
+                self.dynamicStyles.append((target, definition))
+
+    def isComplete(self):
+        '''A custom style used by the chunk may not have been defined, ie if
+           an error occurred while generating it. Such a chunk can't be
+           cached.'''
+        for name, hash, target, definition in self.customStyles:
+            if definition is None: return
+        return True
+
+    def replay(self, renderer):
+        '''Adds the dynamic styles of this chunk to p_renderer and returns the
+           ODT content to insert into its result.'''
+        generator = renderer.stylesManager.stylesGenerator
+        names = {}
+        for name, hash, target, definition in self.customStyles:
+            createNew, newName = generator.getStyleNameFromHash(hash)
+            if newName != name:
+                names[name] = newName
+                if createNew:
+                    definition = definition.replace('style:name="%s"' % name,
+                                                    'style:name="%s"' % newName)
+            if createNew: generator.addStyle(newName, definition, target)
+        # Table and list styles have unique names: they must be added only once
+        # into a given renderer.
+        if self.key not in renderer.xhtmlChunks:
+            renderer.xhtmlChunks.add(self.key)
+            for target, definition in self.dynamicStyles:
+                renderer.dynamicStyles[target].append(definition)
+        if not names: return self.odt
+        return self.rexCustomStyle.sub(lambda match: ':style-name="%s"' % \
+            names.get(match.group(1), match.group(1)), self.odt)
+
 # ------------------------------------------------------------------------------
 class Xhtml2OdtConverter:
     '''Converts a chunk of XHTML into a chunk of ODT'''
+    # The produced chunks, as XhtmlChunk instances, keyed by m_getKey
+    chunks = LruCache(1000)
+    # XHTML chunks containing images can't be cached: converting them imports
+    # the images into the result.
+    rexImage = re.compile('<img[\s/>]', re.I)
+
+    @staticmethod
+    def getKey(xhtmlString, encoding, mappingKey, keepWithNext,
+               renderer):
+        '''Returns the key of the chunk produced by converting p_xhtmlString
+           in Xhtml2OdtConverter.chunks, or None if this chunk can't be cached.
+           p_mappingKey is the key of the local styles mapping, as produced by
+           appy.pod.styles_manager.getMappingKey.'''
+        if (mappingKey is None) or (renderer.stylesMappingKey is None) or \
+           Xhtml2OdtConverter.rexImage.search(xhtmlString): return
+        namespaces = renderer.currentParser.env.namespaces
+        return getKey(xhtmlString, encoding, keepWithNext and '1' or '0',
+                      mappingKey, renderer.stylesMappingKey,
+                      renderer.stylesManager.stylesKey,
+                      repr(sorted(namespaces.items())))
+
     def __init__(self, xhtmlString, encoding, stylesManager, localStylesMapping,
-                 keepWithNext, renderer):
+                 keepWithNext, renderer, key=None):
         self.renderer = renderer
+        # If p_key is given, the produced chunk is stored in self.chunks
+        self.key = key
         self.xhtmlString = xhtmlString
         self.encoding = encoding # Todo: manage encoding that is not utf-8
         self.stylesManager = stylesManager
         self.localStylesMapping = localStylesMapping
         self.odtChunk = None
-        self.xhtmlParser = XhtmlParser(XhtmlEnvironment(renderer), self)
+        self.xhtmlParser = None
         if keepWithNext: self.xhtmlString = self.applyKeepWithNext()
 
-    def run(self):
+    def convert(self):
+        '''Converts self.xhtmlString and returns the chunk of ODT. Chunks made
+           of simple XHTML are converted by a SimpleConverter.'''
+        res = SimpleConverter(self).run()
+        if res is not None: return res
+        self.xhtmlParser = XhtmlParser(XhtmlEnvironment(self.renderer), self)
         self.xhtmlParser.parse(self.xhtmlString)
         return self.xhtmlParser.env.res
 
+    def run(self):
+        if not self.key: return self.convert()
+        # Collect the dynamic styles added while converting the chunk
+        renderer = self.renderer
+        generator = self.stylesManager.stylesGenerator
+        sizes = {}
+        for target, styles in renderer.dynamicStyles.iteritems():
+            sizes[target] = len(styles)
+        generator.used = {}
+        try:
+            res = self.convert()
+            chunk = XhtmlChunk(self.key, res, renderer, sizes)
+        finally:
+            generator.used = None
+        if chunk.isComplete():
+            self.chunks.set(self.key, chunk)
+            renderer.xhtmlChunks.add(self.key)
+        return res
+
     def applyKeepWithNext(self):
         '''This method is called prior to parsing self.xhtmlString in order to
            add specific CSS classes to some XHTML tags, implementing the
@@ -3,22 +3,43 @@
    Python and XML.'''
 
 # ------------------------------------------------------------------------------
-import xml.sax
+import xml.sax, threading, marshal, sys
 from px_parser import PxParser, PxEnvironment
-from appy.pod.buffers import MemoryBuffer
+from px_compiler import PxCompiler, CompilerError
+from appy.pod.buffers import StreamBuffer
+from appy.pod.profiler import Profiler
+from appy.shared.cache import DiskCache, LruCache, getKey
 from appy.shared.xml_parser import xmlPrologue, xhtmlPrologue
 
 # Exception class --------------------------------------------------------------
 class PxError(Exception): pass
 
+# PXs are parsed on first use. This lock prevents several threads from parsing
+# the same PX at the same time.
+parseLock = threading.Lock()
+
 # ------------------------------------------------------------------------------
 class Px:
     '''Represents a (chunk of) PX code.'''
     xmlPrologue = xmlPrologue
     xhtmlPrologue = xhtmlPrologue
+    # Once parsed, PXs are compiled into Python functions (see
+    # px_compiler.PxCompiler). Set this to False to always use the AST
+    # interpreter instead.
+    useCompiler = True
+    # If a folder is specified here, the ASTs of parsed PXs are stored in it.
+    # At the next start, every PX will be loaded from it instead of being
+    # parsed again.
+    cacheFolder = None
+    # The results of PXs having a cache key (see the constructor), shared by
+    # all PXs of this process. Results longer than maxCachedLength chars are
+    # not cached.
+    outputCache = LruCache(1000)
+    maxCachedLength = 20000
 
     def __init__(self, content, isFileName=False, partial=True,
-                 template=None, hook=None, prologue=None, unicode=True):
+                 template=None, hook=None, prologue=None, unicode=True,
+                 cacheKey=None):
         '''p_content is the PX code, as a string, or a file name if p_isFileName
            is True. If this code represents a complete XML file, p_partial is
            False. Else, we must surround p_content with a root tag to be able
@@ -33,14 +54,35 @@ class Px:
 
            By default, a PX's result will be a unicode. If you want to get an
            encoded str instead, use p_unicode=False.
+
+           If p_cacheKey is given, the result of this PX is cached in
+           Px.outputCache. p_cacheKey is a function that, given the rendering
+           context, returns a hashable key identifying the result (or None if
+           the result must not be cached). The PX is evaluated once per key:
+           subsequent renderings with the same key dump the cached result. Use
+           it only for PXs whose result is entirely determined by the key and
+           that do not modify the context (see m_objectKey for a standard
+           key).
+
+           The PX is not parsed here: parsing occurs the first time the PX is
+           rendered.
         '''
         # Get the PX content
         if isFileName:
             f = file(content)
             self.content = f.read()
             f.close()
+            # Where this PX is defined, as a tuple (path, line), used by the
+            # profiler (see appy.pod.profiler).
+            self.location = (content, 1)
         else:
             self.content = content
+            # The PX is defined by the caller. Its source code ends at the
+            # line of the call, or a few lines before if other args follow.
+            frame = sys._getframe(1)
+            code = frame.f_code
+            self.location = (code.co_filename,
+                             max(frame.f_lineno - content.count('\n'), 1))
         # It this content a complete XML file, or just some part of it?
         self.partial = partial
         # Is this PX based on a template PX?
@@ -50,29 +92,181 @@ class Px:
         self.prologue = prologue
         # Will the result be unicode or str?
         self.unicode = unicode
-        self.parse()
+        # The function computing the key of the cached result, if any. The
+        # version of this PX is part of the key: it is incremented every time
+        # the PX is overridden, making its previous results unreachable.
+        self.cacheKey = cacheKey
+        self.version = 0
+        # The environment containing the AST, created by m_parse
+        self.env = None
+        self.parsed = False
+        # The function rendering the PX while measuring its expressions and
+        # actions, compiled when the PX is rendered with a profiler.
+        self.profiledFunction = None
 
     def parse(self):
         '''Parses self.content and create the structure corresponding to this
            PX.'''
+        content = self.content
         if self.partial:
             # Surround the partial chunk with a root tag: it must be valid XML.
-            self.content = '<x>%s</x>' % self.content
-        # Create a PX parser
-        self.parser = PxParser(PxEnvironment(), self)
-        # Parses self.content (a PX code in a string) with self.parser, to
-        # produce a tree of memory buffers.
+            content = '<x>%s</x>' % content
+        # Try first to get the AST from the cache
+        env = None
+        if self.cacheFolder:
+            cache = DiskCache(self.cacheFolder, 'pxc')
+            # Marshalled data can only be read by the Python version that wrote
+            # it.
+            key = getKey(sys.version, content)
+            env = self.loadAst(cache, key)
+        if not env:
+            # Create a PX parser
+            parser = PxParser(PxEnvironment(), self)
+            env = parser.env
+            # Parses p_content (a PX code in a string) with the parser, to
+            # produce a tree of memory buffers.
+            try:
+                parser.parse(content)
+            except xml.sax.SAXParseException, spe:
+                self.completeErrorMessage(spe, content)
+                raise spe
+            # The AST will not change anymore: freeze it into ordered lists of
+            # nodes, for faster evaluations.
+            env.ast.freeze()
+            if self.cacheFolder: self.dumpAst(cache, key, env.ast)
+            # The parser is not needed anymore: errors are located thanks to
+            # the line and column stored, at parse time, in every expression
+            # and action. Release it, with its locator and handler state.
+            env.parser = None
+            env.currentBuffer = env.ast
+            env.currentElem = None
+        # Compile it into a Python function if possible. Else, the AST will be
+        # interpreted.
+        renderFunction = None
+        if self.useCompiler:
+            try:
+                renderFunction = PxCompiler(env.ast).run()
+            except (CompilerError, SyntaxError):
+                pass
+        # Everything is ready: renderings (including those currently running
+        # in other threads, if the PX is overridden) may use the result.
+        self.env = env
+        self.renderFunction = renderFunction
+        self.profiledFunction = None
+        self.parsed = True
+
+    def loadAst(self, cache, key):
+        '''Loads, from the p_cache, the AST stored at this p_key. Returns the
+           PxEnvironment containing the AST, or None if the AST is not in the
+           cache or can't be loaded.'''
+        data = cache.get(key)
+        if data is None: return
+        env = PxEnvironment()
         try:
-            self.parser.parse(self.content)
-        except xml.sax.SAXParseException, spe:
-            self.completeErrorMessage(spe)
-            raise spe
+            env.ast.loadFrozenData(marshal.loads(data))
+        except (ValueError, EOFError, TypeError):
+            # Corrupted data: the PX will be parsed again
+            return
+        return env
 
-    def completeErrorMessage(self, parsingError):
+    def dumpAst(self, cache, key, ast):
+        '''Stores this (frozen) p_ast in the p_cache, at this p_key.'''
+        try:
+            data = marshal.dumps(ast.getFrozenData())
+        except ValueError:
+            return # Something is not serializable: the PX will not be cached
+        try:
+            cache.set(key, data)
+        except (IOError, OSError):
+            pass # The cache folder may be read-only
+
+    def ensureParsed(self):
+        '''Parses this PX if it has not been done yet.'''
+        if self.parsed: return
+        parseLock.acquire()
+        try:
+            # Another thread may have parsed it in the meanwhile
+            if not self.parsed: self.parse()
+        finally:
+            parseLock.release()
+
+    def getProfiledFunction(self):
+        '''Returns the function rendering this PX while measuring its
+           expressions and actions (see m_parse and PxCompiler), or None if
+           the PX must be interpreted.'''
+        if not self.useCompiler or not self.renderFunction: return
+        if not self.profiledFunction:
+            parseLock.acquire()
+            try:
+                if not self.profiledFunction:
+                    compiler = PxCompiler(self.env.ast, self.location)
+                    self.profiledFunction = compiler.run()
+            finally:
+                parseLock.release()
+        return self.profiledFunction
+
+    def evaluate(self, result, context):
+        '''Produces the PX content into p_result'''
+        profiler = context.get(Profiler.contextKey)
+        if not profiler:
+            if self.renderFunction:
+                self.renderFunction(result, context)
+            else:
+                self.env.ast.evaluate(result, context)
+            return
+        path, line = self.location
+        profiler.enterTemplate('px', path, line)
+        try:
+            render = self.getProfiledFunction()
+            if render:
+                render(result, context)
+            else:
+                self.env.ast.evaluate(result, context)
+        finally:
+            profiler.leaveTemplate()
+
+    def evaluateCached(self, result, context):
+        '''Produces the PX content into p_result, from Px.outputCache if
+           possible.'''
+        key = self.cacheKey(context)
+        if key is None:
+            self.evaluate(result, context)
+            return
+        key = (self, self.version, key)
+        res = self.outputCache.get(key)
+        if res is None:
+            chunks = []
+            self.evaluate(StreamBuffer(self.env, chunks), context)
+            res = u''.join(chunks)
+            if len(res) <= self.maxCachedLength: self.outputCache.set(key, res)
+        result.write(res)
+
+    @staticmethod
+    def objectKey(get='zobj', names=()):
+        '''Returns a function that can be used as cache key (see the
+           constructor) for a PX whose result only depends on an object, the
+           user language and the layout type, found in the context at keys
+           "lang" and "layoutType", and the context variables whose p_names are
+           given. The object is the one found in the context at key p_get, or
+           the one returned by p_get if it is a function accepting the
+           context. Because the key includes the object's id and modification
+           date, the cached result is reused until the object changes. Nothing
+           is cached if there is no object or language.'''
+        def getKey(context):
+            if callable(get): obj = get(context)
+            else: obj = context.get(get)
+            lang = context.get('lang')
+            if (obj is None) or not lang: return
+            res = [obj.id, obj.modified, lang, context.get('layoutType')]
+            for name in names: res.append(context.get(name))
+            return tuple(res)
+        return getKey
+
+    def completeErrorMessage(self, parsingError, content):
         '''A p_parsingError occurred. Complete the error message with the
-           erroneous line from self.content.'''
-        # Split lines from self.content
-        splitted = self.content.split('\n')
+           erroneous line from the parsed p_content.'''
+        # Split lines from p_content
+        splitted = content.split('\n')
         i = parsingError.getLineNumber() - 1
         # Get the erroneous line, and add a subsequent line for indicating
         # the erroneous column.
@@ -83,8 +277,9 @@ class Px:
         if i < len(splitted)-1: lines.append(splitted[i+1])
         parsingError._msg += '\n%s' % '\n'.join(lines)
 
-    def __call__(self, context, applyTemplate=True):
-        '''Renders the PX.
+    def render(self, result, context, applyTemplate=True):
+        '''Renders the PX into p_result, a buffer having (at least) methods
+           "write" and "dumpContent".
 
            If the PX is based on a template PX, we have 2 possibilities.
            1. p_applyTemplate is True. This case corresponds to the initial
@@ -95,30 +290,67 @@ class Px:
               as is, without re-applying the template (else, an infinite
               recursion would occur).
         '''
+        self.ensureParsed()
         # Developer, forget the following line forever
         if '_ctx_' not in context: context['_ctx_'] = context
 
         if self.hook and applyTemplate:
             # Call the template PX, filling the hook with the current PX
             context[self.hook] = self
-            return self.template(context)
+            self.template.render(result, context)
         else:
-            # Create a Memory buffer for storing the result.
-            env = self.parser.env
-            result = MemoryBuffer(env, None)
-            env.ast.evaluate(result, context)
-            res = result.content
-            if self.prologue:
-                res = self.prologue + res
-            if not self.unicode:
-                res = res.encode('utf-8')
-            return res
+            if self.prologue: result.write(self.prologue)
+            if self.cacheKey:
+                self.evaluateCached(result, context)
+            else:
+                self.evaluate(result, context)
+
+    def __call__(self, context, applyTemplate=True):
+        '''Renders the PX and returns the result, as a unicode or str,
+           depending on self.unicode (see m_render for more details).'''
+        self.ensureParsed()
+        # Collect the result as a list of chunks, joined at the end
+        chunks = []
+        self.render(StreamBuffer(self.env, chunks), context,
+                    applyTemplate=applyTemplate)
+        res = u''.join(chunks)
+        # The type of the result is determined by the PX being rendered: the
+        # template PX if applied.
+        px = self
+        if applyTemplate:
+            while px.hook: px = px.template
+        if not px.unicode:
+            res = res.encode('utf-8')
+        return res
+
+    def renderTo(self, sink, context, bufferSize=8192):
+        '''Renders the PX, but instead of returning the result, dumps it, as it
+           is produced, into p_sink, being a file-like object (ie, a Zope
+           RESPONSE) or a list. Chunks of the result are passed to p_sink in
+           blocks of p_bufferSize chars (every chunk is passed individually if
+           p_bufferSize is 0). Like in m___call__, the type of the result is
+           determined by the template PX, if any: if its attribute "unicode" is
+           False, every block is encoded in utf-8.'''
+        self.ensureParsed()
+        px = self
+        while px.hook: px = px.template
+        encoding = None
+        if not px.unicode: encoding = 'utf-8'
+        result = StreamBuffer(self.env, sink, encoding, bufferSize)
+        self.render(result, context)
+        result.flush()
 
     def override(self, content, partial=True):
         '''Overrides the content of this PX with a new p_content (as a
            string).'''
-        self.partial = partial
-        self.content = content
-        # Parse again, with new content.
-        self.parse()
+        parseLock.acquire()
+        try:
+            self.partial = partial
+            self.content = content
+            # Parse again, with new content.
+            self.parse()
+            # Cached results of the old content may not be reused
+            self.version += 1
+        finally:
+            parseLock.release()
 # ------------------------------------------------------------------------------
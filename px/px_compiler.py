@@ -0,0 +1,293 @@
+# ------------------------------------------------------------------------------
+import sys
+from appy.shared.xml_parser import escapeXml
+from appy.pod.buffers import MemoryBuffer
+from appy.pod.elements import getLocation
+from appy.pod.actions import IfAction, ForAction, VariablesAction, \
+     EvaluationError, EVAL_ERROR, WRONG_SEQ_TYPE, lookAhead
+from appy.pod.buffers import EVAL_EXPR_ERROR
+from appy.pod.profiler import Profiler
+
+# Error-related constants ------------------------------------------------------
+UNCOMPILABLE_ACTION = 'PX action "%s" can\'t be compiled.'
+
+class CompilerError(Exception): pass
+
+# ------------------------------------------------------------------------------
+def evalError(action, expr, result, context, e):
+    '''Manages error p_e that occurred while evaluating p_expr from p_action,
+       exactly like BufferAction.evaluateExpression does.'''
+    message = EVAL_ERROR % (expr, action.getExceptionLine(e))
+    action.manageError(result, context, message, e)
+
+# ------------------------------------------------------------------------------
+class PxCompiler:
+    '''Converts the (frozen) p_ast of a PX into the Python source code of a
+       function, and compiles it. The function produces the same result as
+       the evaluation of the AST (see MemoryBuffer.evaluateNodes and the
+       BufferAction classes), but:
+       - consecutive chunks of static content are dumped at once, as string
+         constants;
+       - the action chains (for, if, var) are inlined: there are no more
+         BufferIterator, BufferAction.execute or evaluateBuffer calls, neither
+         any test about the type of the node to evaluate.
+
+       Expressions are still evaluated (as compiled code objects) with the PX
+       context as globals: sub-PXs called from this PX must see the variables
+       defined by its "for" and "var" statements.
+
+       If a p_location is given, as a tuple (path, line) telling where the PX
+       is defined, the function measures every expression and action with the
+       Profiler found in the context (see appy.pod.profiler).'''
+
+    def __init__(self, ast, location=None):
+        # The root buffer of the PX AST
+        self.ast = ast
+        self.location = location
+        # The lines of Python code being generated
+        self.lines = []
+        # The namespace in which the generated code will be executed: it will
+        # contain the PX-specific objects (expressions' code objects, actions,
+        # etc) that are used by the generated code.
+        self.namespace = {'EvaluationError': EvaluationError,
+          'sys': sys, 'EVAL_EXPR_ERROR': EVAL_EXPR_ERROR,
+          'WRONG_SEQ_TYPE': WRONG_SEQ_TYPE, 'evalError': evalError,
+          'escapeXml': escapeXml, 'lookAhead': lookAhead}
+        # A counter used to produce unique names
+        self.counter = 0
+        # The lines of the functions rendering sub-buffers
+        self.functions = []
+
+    def getName(self, prefix, value=None):
+        '''Returns a new unique name starting with p_prefix. If p_value is
+           given, it is added into the namespace under this name.'''
+        self.counter += 1
+        res = '%s%d' % (prefix, self.counter)
+        if value is not None: self.namespace[res] = value
+        return res
+
+    def add(self, indent, line):
+        self.lines.append('%s%s' % ('    ' * indent, line))
+
+    def addEval(self, indent, target, codes):
+        '''Adds the code evaluating compiled expressions p_codes (see
+           appy.pod.elements.compileExprs), storing the result in p_target.'''
+        code, errorCode = codes
+        code = self.getName('c', code)
+        if errorCode is None:
+            self.add(indent, '%s = eval(%s, context)' % (target, code))
+        else:
+            errorCode = self.getName('c', errorCode)
+            self.add(indent, 'try:')
+            self.add(indent+1, '%s = eval(%s, context)' % (target, code))
+            self.add(indent, 'except Exception:')
+            self.add(indent+1, '%s = eval(%s, context)' % (target, errorCode))
+
+    def addActionEval(self, indent, target, action, expr, codes):
+        '''Adds the code evaluating the expression p_expr (compiled in
+           p_codes) of an p_action.'''
+        if not expr:
+            # Like in BufferAction.execute, an empty expression is not evaluated
+            self.add(indent, '%s = None' % target)
+            return
+        self.add(indent, 'try:')
+        self.addEval(indent+1, target, codes)
+        self.add(indent, 'except Exception, e:')
+        self.add(indent+1, 'evalError(%s, %s, result, context, e)' % \
+                 (action, repr(expr)))
+
+    def addNodes(self, indent, buffer):
+        '''Adds the code corresponding to the nodes of this (frozen) p_buffer'''
+        text = None # The currently collected static content
+        for kind, value in buffer.nodes:
+            if kind == MemoryBuffer.TEXT:
+                text = (text or u'') + value
+                continue
+            if text:
+                self.add(indent, 'w(%s)' % repr(text))
+                text = None
+            if kind == MemoryBuffer.EXPRESSION:
+                self.addExpression(indent, value)
+            elif kind == MemoryBuffer.ATTRIBUTE:
+                code = self.getName('c', value.code)
+                self.add(indent, 'if eval(%s, context): w(%s)' % \
+                         (code, repr(' %s="%s"' % (value.name, value.name))))
+            else:
+                # A sub-buffer, with an action: it is generated as a separate
+                # function, to avoid too many statically nested blocks.
+                self.add(indent, '%s(result, context)' % self.addBuffer(value))
+        if text:
+            self.add(indent, 'w(%s)' % repr(text))
+        if not buffer.nodes:
+            self.add(indent, 'pass')
+
+    def startProfiling(self, indent, kind, source, line):
+        '''If profiling is enabled, adds the code starting to measure an element
+           (an expression or action) and returns the indentation of the code
+           to measure.'''
+        if not self.location: return indent
+        path, first = self.location
+        key = (Profiler.getLocation(path, first, line), kind, source)
+        self.add(indent, 'p.enter(%s)' % self.getName('k', key))
+        self.add(indent, 'try:')
+        return indent + 1
+
+    def endProfiling(self, indent):
+        '''If profiling is enabled, adds the code ending the measure started by
+           m_startProfiling.'''
+        if not self.location: return
+        self.add(indent, 'finally:')
+        self.add(indent+1, 'p.leave()')
+
+    def addExpression(self, indent, expr):
+        '''Adds the code evaluating p_expr (an Expression instance) and dumping
+           its result, like in MemoryBuffer.evaluateExpression.'''
+        outer = indent
+        indent = self.startProfiling(indent, 'expr', expr.expr, expr.line)
+        name = self.getName('x', expr)
+        self.add(indent, 'try:')
+        self.addEval(indent+1, 'r', (expr.code, expr.errorCode))
+        # The most frequent case, an unicode result, is managed here. Others
+        # are converted by the Expression itself.
+        self.add(indent+1, 'if r.__class__ is unicode: e = %s' % \
+                 repr(expr.escapeXml))
+        self.add(indent+1, 'else: r, e = %s.convert(r, context, result)' %name)
+        self.add(indent+1, 'if e: w(escapeXml(r))')
+        self.add(indent+1, 'elif r: w(r)')
+        self.add(indent, 'except EvaluationError, e:')
+        self.add(indent+1, 'raise e')
+        self.add(indent, 'except Exception, e:')
+        location = getLocation(expr.line, expr.column)
+        self.add(indent+1, "raise EvaluationError(e, EVAL_EXPR_ERROR %% " \
+                 "(%s.expr, %s), sys.exc_info(), 5)" % (name, repr(location)))
+        self.endProfiling(outer)
+
+    def addAction(self, indent, action):
+        '''Adds the code performing p_action, followed by its sub-actions and,
+           finally, the evaluation of the action's buffer.'''
+        name = self.getName('a', action)
+        outer = indent
+        indent = self.startProfiling(indent, action.kind,
+                                     action.getStatement(), action.line)
+        if action.__class__ == IfAction:
+            target = self.getName('r')
+            self.addActionEval(indent, target, name, action.expr, action.codes)
+            self.add(indent, 'if %s:' % target)
+            self.addActionBody(indent+1, action)
+            # In PX, the "else" part of an IfAction, only relevant for ODF
+            # table cells, never does anything.
+        elif action.__class__ == ForAction:
+            self.addFor(indent, name, action)
+        elif action.__class__ == VariablesAction:
+            self.addVariables(indent, name, action)
+        else:
+            raise CompilerError(UNCOMPILABLE_ACTION % action.name)
+        self.endProfiling(outer)
+
+    def addActionBody(self, indent, action):
+        if action.subAction:
+            self.addAction(indent, action.subAction)
+        else:
+            self.addNodes(indent, action.buffer)
+
+    def addFor(self, indent, name, action):
+        '''Adds the code of a ForAction, like ForAction.do'''
+        i = indent
+        add = self.add
+        elems, loop, outer, hidden, nb, item, ahead = [self.getName(n) for n \
+                 in ('elems', 'loop', 'outer', 'h', 'i', 'item', 'ahead')]
+        var = repr(action.iter)
+        self.addActionEval(i, elems, name, action.expr, action.codes)
+        add(i, 'try:')
+        add(i+1, 'iter(%s)' % elems)
+        add(i, 'except TypeError, te:')
+        add(i+1, '%s.manageError(result, context, WRONG_SEQ_TYPE %% %s.expr, ' \
+                 'te)' % (name, name))
+        add(i+1, 'return')
+        # Remember variable hidden by the iterator if any
+        add(i, '%s = %s in context' % (hidden, var))
+        add(i, 'if %s: %sv = context[%s]' % (hidden, hidden, var))
+        add(i, '%s, %s = %s.initialiseLoop(context, %s)' % \
+               (loop, outer, name, elems))
+        # Elements without a length are walked one element ahead, in order to
+        # know if the current one is the last one (see LoopState).
+        add(i, '%s = %s.isLast is not None' % (ahead, loop))
+        add(i, 'if %s: %s = lookAhead(%s)' % (ahead, elems, elems))
+        add(i, '%s = -1' % nb)
+        add(i, 'for %s in %s:' % (item, elems))
+        add(i+1, '%s += 1' % nb)
+        add(i+1, '%s.nb = %s' % (loop, nb))
+        add(i+1, 'if %s: %s, %s.isLast = %s' % (ahead, item, loop, item))
+        add(i+1, 'context[%s] = %s' % (var, item))
+        self.addActionBody(i+1, action)
+        # Delete the current loop object and restore the overridden one if any
+        add(i, 'try:')
+        add(i+1, "delattr(context['loop'], %s)" % var)
+        add(i, 'except AttributeError:')
+        add(i+1, 'pass')
+        add(i, "if %s: setattr(context['loop'], %s, %s)" % (outer, var, outer))
+        # Restore the hidden variable if any
+        add(i, 'if %s: context[%s] = %sv' % (hidden, var, hidden))
+        add(i, 'elif (%s != -1) and (%s in context): del context[%s]' % \
+               (nb, var, var))
+
+    def addVariables(self, indent, name, action):
+        '''Adds the code of a VariablesAction, like VariablesAction.do'''
+        i = indent
+        add = self.add
+        hidden = self.getName('h')
+        add(i, '%s = None' % hidden)
+        names = []
+        for varName, expr, codes in action.compiled:
+            value = self.getName('v')
+            self.addActionEval(i, value, name, expr, codes)
+            # Replace the value of global variables
+            if varName.startswith('@'):
+                add(i, 'context[%s] = %s' % (repr(varName[1:]), value))
+                continue
+            varName = repr(varName)
+            names.append(varName)
+            # Remember the variable previous value if already in the context
+            add(i, 'if %s in context:' % varName)
+            add(i+1, 'if not %s: %s = {}' % (hidden, hidden))
+            add(i+1, '%s[%s] = context[%s]' % (hidden, varName, varName))
+            add(i, 'context[%s] = %s' % (varName, value))
+        self.addActionBody(i, action)
+        # Restore hidden variables if any
+        add(i, 'if %s: context.update(%s)' % (hidden, hidden))
+        # Delete not-hidden variables
+        for varName in names:
+            add(i, 'if not %s or (%s not in %s): del context[%s]' % \
+                   (hidden, varName, hidden, varName))
+
+    def addBuffer(self, buffer):
+        '''Adds a function rendering this p_buffer (with an action) and
+           returns its name.'''
+        # Generate the function in a separate list of lines
+        lines = self.lines
+        self.lines = []
+        name = self.getName('b')
+        self.add(0, 'def %s(result, context):' % name)
+        self.add(1, 'w = result.write')
+        if self.location: self.add(1, 'p = context[%s]' % \
+                                   repr(Profiler.contextKey))
+        self.addAction(1, buffer.action)
+        self.functions.extend(self.lines)
+        self.lines = lines
+        return name
+
+    def getSource(self):
+        '''Returns the Python source code of the function rendering the PX'''
+        self.add(0, 'def render(result, context):')
+        self.add(1, 'w = result.write')
+        if self.location: self.add(1, 'p = context[%s]' % \
+                                   repr(Profiler.contextKey))
+        self.addNodes(1, self.ast)
+        return '\n'.join(self.functions + self.lines)
+
+    def run(self):
+        '''Returns the function rendering the PX. The function accepts 2 args:
+           the result buffer and the context.'''
+        exec compile(self.getSource(), '<px>', 'exec') in self.namespace
+        return self.namespace['render']
+# ------------------------------------------------------------------------------
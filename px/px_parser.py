@@ -24,6 +24,9 @@ class PxEnvironment(XmlEnvironment):
         # Else, we will directly dump the parsed content into the current
         # buffer.
         self.currentContent = ''
+        # The line and column where the expression in self.currentContent
+        # starts.
+        self.currentLine = self.currentColumn = None
         # The currently walked element. We redefine it here. This attribute is
         # normally managed by the parent XmlEnvironment, but we do not use the
         # standard machinery from this environmment and from the default
@@ -58,6 +61,18 @@ class PxParser(XmlParser):
 
     def __init__(self, env, caller=None):
         XmlParser.__init__(self, env, caller)
+        # A partial PX is surrounded by a root tag (see Px.parse), that shifts
+        # the columns of its first line.
+        self.shift = 0
+        if caller and caller.partial: self.shift = 3
+
+    def getLocation(self):
+        '''Returns the current line and column within the PX'''
+        line = self.locator.getLineNumber()
+        column = self.locator.getColumnNumber()
+        if (line == 1) and (column is not None):
+            column = max(column - self.shift, 0)
+        return line, column
 
     def startElement(self, elem, attrs):
         '''A start p_elem with p_attrs is encountered in the PX.'''
@@ -72,8 +87,10 @@ class PxParser(XmlParser):
                     # Create a sub-buffer with an action.
                     e.addSubBuffer()
                     found = True
-                # Add the action.
-                e.currentBuffer.createPxAction(elem, name, attrs[name])
+                # Add the action, with its location within the PX
+                line, column = self.getLocation()
+                e.currentBuffer.createPxAction(elem, name, attrs[name],
+                                               line, column)
         if e.isActionElem(elem):
             # Add a temp element in the buffer (that will be unreferenced
             # later). This way, when encountering the corresponding end element,
@@ -100,7 +117,8 @@ class PxParser(XmlParser):
         # Manage the potentially collected Python expression in
         # e.currentContent.
         if e.currentContent:
-            e.currentBuffer.addExpression(e.currentContent)
+            e.currentBuffer.addExpression(e.currentContent,
+                             line=e.currentLine, column=e.currentColumn)
             e.currentContent = ''
         # Dump the end element into the current buffer
         if (elem != 'x') and (elem not in self.noEndTags):
@@ -122,6 +140,7 @@ class PxParser(XmlParser):
             # This content is not static content to dump as-is into the result:
             # it is a Python expression.
             e.currentContent += content[1:]
+            e.currentLine, e.currentColumn = self.getLocation()
         elif e.currentContent:
             # We continue to dump the Python expression.
             e.currentContent += content
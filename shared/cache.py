@@ -0,0 +1,370 @@
+# ------------------------------------------------------------------------------
+# Appy is a framework for building applications in the Python language.
+# Copyright (C) 2007 Gaetan Delannay
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
+
+# ------------------------------------------------------------------------------
+import os, os.path, hashlib, shutil, zipfile, threading
+from collections import OrderedDict
+import appy.version
+
+# ------------------------------------------------------------------------------
+def getKey(*parts):
+    '''Computes a key (a hexadecimal string) from the given p_parts (strings or
+       unicodes). The Appy version is always part of the key: cached data
+       produced by another Appy version will never be reused.'''
+    res = hashlib.sha1(appy.version.verbose)
+    for part in parts:
+        if isinstance(part, unicode): part = part.encode('utf-8')
+        res.update('\x00%s' % part)
+    return res.hexdigest()
+
+def getFileDigest(path):
+    '''Returns a digest (a hexadecimal string) of the content of the file at
+       p_path. For a zip file (ie, an OpenDocument file), the digest is
+       computed from the names and uncompressed content of its entries: it
+       does not depend on the dates stored in the zip, that change every time
+       the same document is produced.'''
+    res = hashlib.sha1()
+    if zipfile.is_zipfile(path):
+        zipFile = zipfile.ZipFile(path)
+        try:
+            for info in zipFile.infolist():
+                res.update('%s\x00%d\x00' % (info.filename, info.file_size))
+                res.update(zipFile.read(info.filename))
+        finally:
+            zipFile.close()
+    else:
+        f = file(path, 'rb')
+        try:
+            while True:
+                chunk = f.read(65536)
+                if not chunk: break
+                res.update(chunk)
+        finally:
+            f.close()
+    return res.hexdigest()
+
+# ------------------------------------------------------------------------------
+class LruCache:
+    '''An in-memory cache storing at most p_maxSize entries. When it is full,
+       adding an entry removes the least recently used one. It can be shared
+       by several threads.'''
+
+    def __init__(self, maxSize=100):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''Returns the value stored for this p_key, or None if no value is in
+           the cache for it.'''
+        self.lock.acquire()
+        try:
+            res = self.entries.pop(key, None)
+            if res is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                # Re-insert the entry at the end: it is the most recently used
+                self.entries[key] = res
+            return res
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        '''Stores this p_value for this p_key'''
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def getStats(self):
+        '''Returns a dict of statistics about the cache usage'''
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hitRatio': total and (float(self.hits) / total) or 0.0,
+                'entries': len(self.entries)}
+
+# ------------------------------------------------------------------------------
+class DiskCache:
+    '''A cache storing data (strings) in files, within a given folder. Keys are
+       strings as produced by m_getKey. Because data may be written in the
+       cache folder by several processes or threads at once, every file is
+       written under a temp name and then renamed.'''
+
+    def __init__(self, folder, extension='bin'):
+        self.folder = folder
+        self.extension = extension
+        if not os.path.isdir(folder): os.makedirs(folder)
+
+    def getPath(self, key):
+        '''Gets the path to the file storing data for this p_key'''
+        return os.path.join(self.folder, '%s.%s' % (key, self.extension))
+
+    def get(self, key):
+        '''Returns the data stored for this p_key, or None if no data is in the
+           cache for it.'''
+        path = self.getPath(key)
+        try:
+            f = file(path, 'rb')
+        except IOError:
+            return
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def set(self, key, data):
+        '''Stores p_data for this p_key'''
+        path = self.getPath(key)
+        tempPath = '%s.%d.%d.tmp' % (path, os.getpid(),
+                                     threading.currentThread().ident)
+        f = file(tempPath, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tempPath, path)
+
+    def delete(self, key):
+        '''Removes, from the cache, data stored for this p_key'''
+        try:
+            os.remove(self.getPath(key))
+        except OSError:
+            pass
+
+# ------------------------------------------------------------------------------
+class BoundedDiskCache(DiskCache):
+    '''A DiskCache whose total size can't exceed p_maxSize (in bytes): once
+       exceeded, the least recently used files are removed. It also counts
+       cache hits and misses.'''
+    # Listing the cache folder is costly. The total size of the cache is thus
+    # maintained in memory, from the sizes of the files written by this
+    # instance, and the folder is scanned again only when this total exceeds
+    # the max size, or after this number of writes (to take into account
+    # files written or removed by other processes).
+    rescanInterval = 100
+    # Once the max size is exceeded, files are removed until the total size
+    # falls under this fraction of it: this leaves room for several writes
+    # before the folder needs to be scanned again.
+    evictionTarget = 0.9
+
+    def __init__(self, folder, extension='bin', maxSize=500*1024*1024):
+        DiskCache.__init__(self, folder, extension)
+        self.maxSize = maxSize
+        # The estimated total size of the cache (None if unknown yet), and the
+        # number of writes since the last scan of the cache folder.
+        self.size = None
+        self.writes = 0
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def touch(self, path):
+        '''Marks the file at p_path as recently used'''
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def getFiles(self):
+        '''Returns a list of tuples (mtime, size, path) for all the files in
+           the cache.'''
+        res = []
+        suffix = '.%s' % self.extension
+        for name in os.listdir(self.folder):
+            if not name.endswith(suffix): continue
+            path = os.path.join(self.folder, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            res.append((stat.st_mtime, stat.st_size, path))
+        return res
+
+    def evict(self, added):
+        '''A file of p_added bytes has just been written into the cache. If
+           the total size of the cache may now exceed self.maxSize, the least
+           recently used files are removed (see self.evictionTarget).'''
+        self.lock.acquire()
+        try:
+            if (self.size is not None) and \
+               (self.writes < self.rescanInterval):
+                self.size += added
+                self.writes += 1
+                if self.size <= self.maxSize: return
+            # Scan the cache folder to get its real size
+            files = self.getFiles()
+            size = sum([f[1] for f in files])
+            if size > self.maxSize:
+                target = self.maxSize * self.evictionTarget
+                files.sort()
+                for mtime, fileSize, path in files:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    size -= fileSize
+                    if size <= target: break
+            self.size = size
+            self.writes = 0
+        finally:
+            self.lock.release()
+
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self.lock.release()
+
+    def getStats(self):
+        '''Returns a dict of statistics about the cache usage'''
+        files = self.getFiles()
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hitRatio': total and (float(self.hits) / total) or 0.0,
+                'files': len(files), 'size': sum([f[1] for f in files])}
+
+# ------------------------------------------------------------------------------
+class ConversionCache(BoundedDiskCache):
+    '''A cache storing documents converted by LibreOffice. Keys are computed
+       from the content of the converted document, the result type and the
+       content of the styles template, if any. Once the total size of the
+       cache folder exceeds p_maxSize (in bytes), the least recently used
+       files are removed. Because any path mentioned in a document is part of
+       its content, a document including other files by linking them (ie, an
+       ODT produced by POD, with sections linked to imported documents) can't
+       be served from the cache if the paths are different.'''
+
+    def __init__(self, folder, maxSize=500*1024*1024, hardlink=False):
+        BoundedDiskCache.__init__(self, folder, 'bin', maxSize)
+        # If p_hardlink is True, results are hard links to files in the cache,
+        # instead of copies. Modifying such a result in place would corrupt
+        # the cache.
+        self.hardlink = hardlink
+
+    def getConversionKey(self, docPath, resultType, templatePath=None):
+        parts = [getFileDigest(docPath), resultType]
+        if templatePath: parts.append(getFileDigest(templatePath))
+        return getKey(*parts)
+
+    def getFile(self, key, path):
+        '''Copies, at p_path, the file stored for this p_key. Returns False if
+           no file is in the cache for it.'''
+        cachePath = self.getPath(key)
+        if not os.path.exists(cachePath): return False
+        if os.path.exists(path): os.remove(path)
+        linked = False
+        if self.hardlink and hasattr(os, 'link'):
+            try:
+                os.link(cachePath, path)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            try:
+                shutil.copyfile(cachePath, path)
+            except (OSError, IOError):
+                # The file may have been removed in the meanwhile
+                return False
+        self.touch(cachePath)
+        return True
+
+    def setFile(self, key, path):
+        '''Stores, for this p_key, a copy of the file at p_path'''
+        cachePath = self.getPath(key)
+        tempPath = '%s.%d.%d.tmp' % (cachePath, os.getpid(),
+                                     threading.currentThread().ident)
+        shutil.copyfile(path, tempPath)
+        size = os.path.getsize(tempPath)
+        os.rename(tempPath, cachePath)
+        self.evict(size)
+
+    def convert(self, docPath, resultPath, convert, resultType,
+                templatePath=None):
+        '''Produces, at p_resultPath, the result of the conversion of the
+           document at p_docPath into p_resultType (with styles from
+           p_templatePath if given), either from the cache, or by calling
+           p_convert, a function accepting no arg that performs the
+           conversion. Returns what p_convert returns (None if the cache was
+           hit).'''
+        key = self.getConversionKey(docPath, resultType, templatePath)
+        if self.getFile(key, resultPath):
+            self.count('hits')
+            return
+        self.count('misses')
+        res = convert()
+        # Store the result, if the conversion succeeded
+        if os.path.exists(resultPath): self.setFile(key, resultPath)
+        return res
+
+# ------------------------------------------------------------------------------
+class ImageCache(BoundedDiskCache):
+    '''A cache storing images imported into POD results (see
+       appy.pod.doc_importers.ImageImporter), in order to avoid downloading or
+       transforming them again and again. Every entry stores an image, with a
+       list of strings giving information about it: the ETag of a downloaded
+       image, or the format and size of a transformed image.'''
+
+    def __init__(self, folder, maxSize=200*1024*1024):
+        BoundedDiskCache.__init__(self, folder, 'img', maxSize)
+
+    def getEntry(self, key):
+        '''Returns a tuple (info, data) for this p_key, "info" being a list of
+           strings and "data" being the image content, or None if no entry
+           is in the cache for it.'''
+        data = self.get(key)
+        if data is None:
+            self.count('misses')
+            return
+        self.count('hits')
+        self.touch(self.getPath(key))
+        info, data = data.split('\n', 1)
+        return info.split('\t'), data
+
+    def setEntry(self, key, info, data):
+        '''Stores, for this p_key, image content p_data with p_info, a list of
+           strings that may not contain tabs or carriage returns.'''
+        cachePath = self.getPath(key)
+        tempPath = '%s.%d.%d.tmp' % (cachePath, os.getpid(),
+                                     threading.currentThread().ident)
+        info = '%s\n' % '\t'.join(info)
+        f = file(tempPath, 'wb')
+        try:
+            f.write(info)
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tempPath, cachePath)
+        self.evict(len(info) + len(data))
+# ------------------------------------------------------------------------------
@@ -224,7 +224,9 @@ class Tester:
         optParser.add_option('-s', '--testSuite', dest="testSuite", default='',
           metavar="TESTSUITE", help='Run only a specified test suite.',
           type='string')
+        self.addOptions(optParser)
         (options, args) = optParser.parse_args()
+        self.options = options
         if self.flavours:
             if len(args) != 1:
                 raise TesterError(WRONG_ARGS % self.flavours)
@@ -240,6 +242,10 @@ class Tester:
         if self.singleTest and self.singleSuite:
             raise TesterError(TEST_AND_SUITE)
 
+    def addOptions(self, optParser):
+        '''Override this method for adding, to p_optParser, options that are
+           specific to your tests. Their values are in self.options.'''
+
     def runSuite(self, suite):
         self.report.say('*' * 79)
         self.report.say('* Suite %s.' % suite['Name'])
@@ -215,15 +215,17 @@ def addPair(name, value, d=None):
 class Traceback:
     '''Dumps the last traceback into a string'''
     @staticmethod
-    def get(last=None):
+    def get(last=None, excInfo=None):
         '''Gets the traceback as a string. If p_last is given (must be an
            integer value), only the p_last lines of the traceback will be
            included. It can be useful for pod/px tracebacks: when an exception
            occurs while evaluating a complex tree of buffers, most of the
            traceback lines concern uninteresting buffer/action-related recursive
-           calls.'''
+           calls. The traceback is the one of the exception currently being
+           handled, or the one described in p_excInfo, a tuple as returned by
+           sys.exc_info.'''
         res = []
-        excType, excValue, tb = sys.exc_info()
+        excType, excValue, tb = excInfo or sys.exc_info()
         tbLines = traceback.format_tb(tb)
         for tbLine in tbLines: res.append(' %s' % tbLine)
         # Get the error message
@@ -277,6 +279,11 @@ fileNameIgnore = charsIgnore + u' $£€/\r\n'
 extractIgnore = charsIgnore + '/()'
 alphaRex = re.compile('[a-zA-Z]')
 alphanumRex = re.compile('[a-zA-Z0-9]')
+# Regular expressions and tables used by m_normalizeString
+extractIgnoreRex = re.compile(u'[%s]' % re.escape(extractIgnore), re.U)
+fileNameIgnoreAscii = fileNameIgnore.encode('ascii', 'ignore')
+normalizeRexes = {'alpha': re.compile('[^a-zA-Z]'),
+                  'alphanum': re.compile('[^a-zA-Z0-9]')}
 
 def normalizeString(s, usage='fileName'):
     '''Returns a version of string p_s whose special chars (like accents) have
@@ -296,25 +303,17 @@ def normalizeString(s, usage='fileName'):
     elif not isinstance(s, unicode): s = unicode(s)
     # For extracted text, replace any unwanted char with a blank
     if usage == 'extractedText':
-        res = u''
-        for char in s:
-            if char not in extractIgnore: res += char
-            else: res += ' '
-        s = res
+        s = extractIgnoreRex.sub(u' ', s)
     # Standardize special chars like accents
     s = unicodedata.normalize('NFKD', s).encode('ascii', 'ignore')
     # Remove any other char, depending on p_usage
     if usage == 'fileName':
         # Remove any char that can't be found within a file name under Windows
-        # or that could lead to problems with LibreOffice.
-        res = ''
-        for char in s:
-            if char not in fileNameIgnore: res += char
+        # or that could lead to problems with LibreOffice. p_s is now an ASCII
+        # str: non-ASCII chars from fileNameIgnore can't be found in it.
+        res = s.translate(None, fileNameIgnoreAscii)
     elif usage.startswith('alpha'):
-        exec 'rex = %sRex' % usage
-        res = ''
-        for char in s:
-            if rex.match(char): res += char
+        res = normalizeRexes[usage].sub('', s)
     elif usage == 'noAccents':
         res = s
     else:
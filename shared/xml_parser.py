@@ -76,42 +76,48 @@ def escapeXml(s, format='xml', nsText='text'):
        their ODF counterparts. In this case, it is needed to give the name of
        the "text" namespace (p_nsText) as defined in the ODF document where the
        line breaks and tabs must be inserted.'''
-    if isinstance(s, unicode):
-        res = u''
-    else:
+    # Chars are replaced by calling s.replace once for every special char
+    # found in p_s, which is much faster than walking p_s char by char. "&"
+    # must be escaped first, and ODF tags must be inserted last.
+    if not isinstance(s, basestring):
+        # p_s is another sequence (ie, an exception, whose args are walked):
+        # escape it item by item.
+        odf = format == 'odf'
         res = ''
-    odf = format == 'odf'
-    for c in s:
-        if XML_SPECIAL_CHARS_NO_APOS.has_key(c):
-            # We do not escape 'apos': there is no particular need for that
-            res += XML_SPECIAL_CHARS_NO_APOS[c]
-        elif odf and (c == '\n'):
-            res += '<%s:line-break/>' % nsText
-        elif odf and (c == '\t'):
-            res += '<%s:tab/>' % nsText
-        elif odf and (c == '\r'):
-            pass
-        else:
-            res += c
-    return res
+        for c in s:
+            if XML_SPECIAL_CHARS_NO_APOS.has_key(c):
+                res += XML_SPECIAL_CHARS_NO_APOS[c]
+            elif odf and (c == '\n'):
+                res += '<%s:line-break/>' % nsText
+            elif odf and (c == '\t'):
+                res += '<%s:tab/>' % nsText
+            elif odf and (c == '\r'):
+                pass
+            else:
+                res += c
+        return res
+    # We do not escape 'apos': there is no particular need for that
+    if '&' in s: s = s.replace('&', '&amp;')
+    if '<' in s: s = s.replace('<', '&lt;')
+    if '>' in s: s = s.replace('>', '&gt;')
+    if '"' in s: s = s.replace('"', '&quot;')
+    if format == 'odf':
+        if '\n' in s: s = s.replace('\n', '<%s:line-break/>' % nsText)
+        if '\t' in s: s = s.replace('\t', '<%s:tab/>' % nsText)
+        if '\r' in s: s = s.replace('\r', '')
+    return s
 
 def escapeXhtml(s):
     '''Return p_s, whose XHTML special chars and carriage return chars have
        been replaced with corresponding XHTML entities.'''
-    if isinstance(s, unicode):
-        res = u''
-    else:
-        res = ''
-    for c in s:
-        if XML_SPECIAL_CHARS_NO_APOS.has_key(c):
-            res += XML_SPECIAL_CHARS_NO_APOS[c]
-        elif c == '\n':
-            res += '<br/>'
-        elif c == '\r':
-            pass
-        else:
-            res += c
-    return res
+    # See the comment about the approach in m_escapeXml
+    if '&' in s: s = s.replace('&', '&amp;')
+    if '<' in s: s = s.replace('<', '&lt;')
+    if '>' in s: s = s.replace('>', '&gt;')
+    if '"' in s: s = s.replace('"', '&quot;')
+    if '\n' in s: s = s.replace('\n', '<br/>')
+    if '\r' in s: s = s.replace('\r', '')
+    return s
 
 # ------------------------------------------------------------------------------
 class XmlElement:
@@ -51,6 +51,18 @@ def unzip(f, folder, odf=False):
     zipFile.close()
     return res
 
+# ------------------------------------------------------------------------------
+def readZip(f):
+    '''Returns the content of zip file p_f (anything accepted by the
+       zipfile.ZipFile constructor), as a list of tuples (name, content), in
+       the order of the zip entries. Names of folders end with a slash; their
+       content is the empty string.'''
+    zipFile = zipfile.ZipFile(f)
+    try:
+        return [(name, zipFile.read(name)) for name in zipFile.namelist()]
+    finally:
+        zipFile.close()
+
 # ------------------------------------------------------------------------------
 def zip(f, folder, odf=False):
     '''Zips the content of p_folder into the zip file whose (preferably)
@@ -91,4 +103,44 @@ def zip(f, folder, odf=False):
             zInfo.external_attr = 48
             zipFile.writestr(zInfo, '')
     zipFile.close()
+
+# ------------------------------------------------------------------------------
+def zipFiles(f, files, folder=None, odf=False):
+    '''Creates zip file p_f (a file name or a file-like object) from p_files,
+       a list of tuples (name, content) like the one returned by m_readZip.
+       The zip is built in memory: no file is written on disk, excepted p_f.
+
+       If a p_folder is given, the files it contains are added to the zip,
+       excepted those whose names are in p_files. If p_odf is True, file
+       "mimetype" is inserted first, uncompressed (see m_zip).'''
+    try:
+        zipFile = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+    except RuntimeError:
+        zipFile = zipfile.ZipFile(f, 'w')
+    names = set()
+    if odf:
+        for name, content in files:
+            if name == 'mimetype':
+                zipFile.writestr(name, content, zipfile.ZIP_STORED)
+                names.add(name)
+                break
+    now = time.localtime()[:6]
+    for name, content in files:
+        if name in names: continue
+        if name.endswith('/'):
+            # A folder
+            zInfo = zipfile.ZipInfo(name, now)
+            zInfo.external_attr = 48
+            zipFile.writestr(zInfo, '')
+        else:
+            zipFile.writestr(name, content)
+        names.add(name)
+    if folder and os.path.isdir(folder):
+        for dir, dirnames, filenames in os.walk(folder):
+            folderName = dir[len(folder)+1:].replace(os.sep, '/')
+            for name in filenames:
+                zName = folderName and ('%s/%s' % (folderName, name)) or name
+                if zName in names: continue
+                zipFile.write(os.path.join(dir, name), zName)
+    zipFile.close()
 # ------------------------------------------------------------------------------